@@ -0,0 +1,112 @@
+'''
+Change report benchmark.
+
+Runs the ChangeReportPoller against the myicomfort stand-in while zones change
+at random between polls, with events delivered to the event gateway stand-in.
+Reports upstream calls per poll, ChangeReports sent against actual changes, and
+the poll interval the poller settled on. For comparison it also reports the
+calls that Alexa polling ReportState for every endpoint would have made over
+the same simulated time.
+
+    python benchmarks/change_reports.py --gateways 4 --zones 3 --polls 200 --change-rate 0.1
+'''
+import argparse
+import os
+import random
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from event_gateway_standin import EventGatewayStandin
+from myicomfort_standin import StandinServer, StandinState
+
+
+def change_zone(lambda_function, state, rng):
+    '''
+    Changes the temperature, a setpoint or the mode of a random zone, as
+    someone at the thermostat would. Returns the zone's endpoint ID, or None if
+    the change is not visible to Alexa (e.g. the heat setpoint while cooling).
+    '''
+    zones = [zone for zones in state.zones.values() for zone in zones]
+    with state.lock:
+        zone = rng.choice(zones)
+        before = lambda_function.getStateProperties(zone)
+        field = rng.choice(['Indoor_Temp', 'Heat_Set_Point', 'Cool_Set_Point', 'Operation_Mode'])
+        if field == 'Operation_Mode':
+            zone[field] = (zone[field] + rng.randint(1, 3)) % 4
+        else:
+            zone[field] += rng.choice([-1, 1])
+        if lambda_function.getStateProperties(zone) == before:
+            return None
+        return zone['GatewaySN'] + ':' + str(zone['Zone_Number'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ChangeReport poller against the myicomfort stand-in')
+    parser.add_argument('--gateways', type=int, default=2)
+    parser.add_argument('--zones', type=int, default=2)
+    parser.add_argument('--polls', type=int, default=100)
+    parser.add_argument('--change-rate', type=float, default=0.1, help='Chance of a zone changing before each poll')
+    parser.add_argument('--min-interval', type=float, default=15)
+    parser.add_argument('--max-interval', type=float, default=300)
+    parser.add_argument('--backoff', type=float, default=2)
+    parser.add_argument('--alexa-interval', type=float, default=60, help='Assumed ReportState polling interval per endpoint without ChangeReports')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    state = StandinState(args.gateways, args.zones, 'standin')
+    server = StandinServer(state)
+    gateway = EventGatewayStandin()
+    os.environ['MYICOMFORT_URL'] = server.start()
+    os.environ.setdefault('USERID', state.userid)
+    os.environ.setdefault('PASSWORD', 'standin')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['CHANGE_REPORTS'] = 'true'
+
+    import lambda_function
+
+    poller = lambda_function.ChangeReportPoller(
+        lambda_function.EventGatewaySink(gateway.start(), 'standin'), lambda_function.current_tenant(),
+        args.min_interval, args.max_interval, args.backoff)
+    rng = random.Random(args.seed)
+
+    poller.poll_once()
+    gateway.take_events()
+    state.reset_counters()
+    elapsed = 0.0
+    changes = 0
+    reported = 0
+    missed = 0
+    for i in range(args.polls):
+        elapsed += poller.interval
+        changed = set()
+        if rng.random() < args.change_rate:
+            endpointId = change_zone(lambda_function, state, rng)
+            if endpointId is not None:
+                changed.add(endpointId)
+        poller.poll_once()
+        events = gateway.take_events()
+        got = set(event['event']['endpoint']['endpointId'] for event in events)
+        changes += len(changed)
+        reported += len(events)
+        missed += len(changed - got)
+    server.shutdown()
+    gateway.shutdown()
+
+    calls = sum(state.counters()['calls'].values())
+    endpoints = len(state.endpoint_ids())
+    alexa_calls = endpoints * elapsed / args.alexa_interval
+    print('Simulated time        %10.0f s' % elapsed)
+    print('Polls                 %10d' % args.polls)
+    print('Mean poll interval    %10.1f s' % (elapsed / args.polls))
+    print('Upstream calls        %10d (%.2f per poll)' % (calls, calls / float(args.polls)))
+    print('Zone changes          %10d' % changes)
+    print('ChangeReports sent    %10d' % reported)
+    print('Changes missed        %10d' % missed)
+    print('ReportState polling   %10.0f calls (%d endpoints every %.0f s)' % (alexa_calls, endpoints, args.alexa_interval))
+
+
+if __name__ == '__main__':
+    main()
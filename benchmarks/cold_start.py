@@ -0,0 +1,75 @@
+'''
+Cold-start benchmark for the skill.
+
+Each run starts a fresh Python process, imports lambda_function and sends it one
+directive against the myicomfort stand-in, the way a cold Lambda container
+handles its first request. Reports import time and first-invocation time
+percentiles, and the startup timing report from the last run.
+
+    python benchmarks/cold_start.py --runs 20 --directive Discover
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from myicomfort_standin import StandinServer, StandinState
+from run_benchmark import DIRECTIVE_ORDER, load_directives, make_request, percentile
+
+# Runs in the child process. Only time, json and sys are loaded before the import
+# being measured.
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+lambda_function.lambda_handler(json.loads(sys.argv[1]), None)
+done = time.perf_counter()
+sys.stderr.write(json.dumps({
+    'import_ms': (imported - start) * 1000.0,
+    'first_invocation_ms': (done - imported) * 1000.0,
+    'startup_timings': lambda_function.startup_timings,
+}) + '\\n')
+'''
+
+
+def run_child(request, env):
+    result = subprocess.run(
+        [sys.executable, '-c', CHILD, json.dumps(request)],
+        cwd=os.path.dirname(BENCHMARK_DIR), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    # The timing line is the last thing the child writes
+    return json.loads(result.stderr.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure lambda_function import and first-invocation time in fresh processes')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--directive', choices=DIRECTIVE_ORDER, default='ReportState')
+    parser.add_argument('--directives', default=os.path.join(BENCHMARK_DIR, 'directives.json'))
+    parser.add_argument('--gateways', type=int, default=2)
+    parser.add_argument('--zones', type=int, default=2)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    state = StandinState(args.gateways, args.zones, 'standin', args.latency_ms)
+    server = StandinServer(state)
+    env = dict(os.environ, MYICOMFORT_URL=server.start(), USERID=state.userid, PASSWORD='standin')
+    request = make_request(load_directives(args.directives), args.directive, 0, state.endpoint_ids())
+
+    results = [run_child(request, env) for i in range(args.runs)]
+    server.shutdown()
+
+    print('%-22s %8s %8s %8s' % ('', 'p50 ms', 'p95 ms', 'max ms'))
+    for key in ('import_ms', 'first_invocation_ms'):
+        samples = [r[key] for r in results]
+        print('%-22s %8.1f %8.1f %8.1f' % (key, percentile(samples, 50), percentile(samples, 95), max(samples)))
+    print('Startup timing report (last run): %s' % json.dumps(results[-1]['startup_timings']))
+
+
+if __name__ == '__main__':
+    main()
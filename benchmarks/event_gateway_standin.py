@@ -0,0 +1,105 @@
+'''
+Local stand-in for the Alexa event gateway. Accepts POSTed events at /v3/events
+and keeps them in memory, so ChangeReport delivery can be checked without
+sending anything to Amazon. Also stands in for the Login With Amazon token
+endpoint at /auth/o2/token, issuing "access-<code>" for a grant code.
+
+Point the skill at it with CHANGE_REPORT_URL=http://127.0.0.1:<port>/v3/events
+and LWA_TOKEN_URL=http://127.0.0.1:<port>/auth/o2/token
+'''
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+EVENTS_PATH = '/v3/events'
+TOKEN_PATH = '/auth/o2/token'
+
+
+class EventGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.path == TOKEN_PATH:
+            self.issue_tokens(dict(parse_qsl(body.decode('utf-8'))))
+        elif self.path != EVENTS_PATH:
+            self.send_status(404)
+        elif not self.headers.get('Authorization', '').startswith('Bearer '):
+            self.send_status(401)
+        else:
+            with self.server.lock:
+                self.server.events.append(json.loads(body))
+                self.server.tokens.append(self.headers['Authorization'][len('Bearer '):])
+            self.send_status(202)
+
+    def issue_tokens(self, form):
+        if form.get('grant_type') == 'authorization_code':
+            grant = form.get('code')
+        elif form.get('grant_type') == 'refresh_token':
+            grant = form.get('refresh_token', '').replace('refresh-', '', 1)
+        else:
+            grant = None
+        if not grant or not form.get('client_id'):
+            self.send_status(400)
+            return
+        with self.server.lock:
+            self.server.token_requests.append(form)
+        data = json.dumps({
+            'access_token': 'access-' + grant,
+            'refresh_token': 'refresh-' + grant,
+            'token_type': 'bearer',
+            'expires_in': 3600,
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_status(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class EventGatewayStandin(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), EventGatewayHandler)
+        self.lock = threading.Lock()
+        self.events = []
+        # The bearer token each event was sent with, and the token requests made
+        self.tokens = []
+        self.token_requests = []
+
+    @property
+    def url(self):
+        return 'http://%s:%d%s' % (self.server_address[0], self.server_address[1], EVENTS_PATH)
+
+    @property
+    def token_url(self):
+        return 'http://%s:%d%s' % (self.server_address[0], self.server_address[1], TOKEN_PATH)
+
+    def start(self):
+        '''
+        Serves requests on a background thread and returns the events URL.
+        '''
+        threading.Thread(target=self.serve_forever, name='event-gateway-standin', daemon=True).start()
+        return self.url
+
+    def take_events(self):
+        '''
+        Returns the events received so far and forgets them.
+        '''
+        with self.lock:
+            events = self.events
+            self.events = []
+            self.tokens = []
+        return events
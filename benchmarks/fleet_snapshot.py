@@ -0,0 +1,123 @@
+'''
+Fleet snapshot benchmark.
+
+Reads the state of every zone in a large stand-in account three ways: by
+collecting every gateway's tStatInfo list before using any of it (as discovery
+does), with iterFleetState() and with iterFleetStateAsync(). Reports the time
+to the first zone and to the last, and the peak memory allocated while the
+snapshot was being consumed.
+
+    python benchmarks/fleet_snapshot.py --gateways 200 --zones 4 --latency-ms 50
+'''
+import argparse
+import importlib.util
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from myicomfort_standin import StandinServer, StandinState
+
+
+def consume(snapshot):
+    '''
+    Consumes an iterable of zones and returns (zones, seconds to the first).
+    '''
+    start = time.perf_counter()
+    first = None
+    zones = 0
+    for zone in snapshot:
+        if first is None:
+            first = time.perf_counter() - start
+        zones += 1
+    return (zones, first)
+
+
+def measure(snapshot):
+    '''
+    Runs a snapshot and returns (zones, ms to first, ms to last, peak KiB
+    allocated).
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    (zones, first) = snapshot()
+    elapsed = time.perf_counter() - start
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (zones, first * 1000.0, elapsed * 1000.0, peak / 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark streaming fleet snapshots against the myicomfort stand-in')
+    parser.add_argument('--gateways', type=int, default=100)
+    parser.add_argument('--zones', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=4, help='FLEET_MAX_CONCURRENCY')
+    args = parser.parse_args()
+
+    state = StandinState(args.gateways, args.zones, 'standin', args.latency_ms, args.jitter_ms, seed=1)
+    server = StandinServer(state)
+    os.environ['MYICOMFORT_URL'] = server.start()
+    os.environ.setdefault('USERID', state.userid)
+    os.environ.setdefault('PASSWORD', 'standin')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['FLEET_MAX_CONCURRENCY'] = str(args.concurrency)
+    # Keep the state cache out of the memory comparison
+    os.environ['STATE_CACHE_TTL'] = '0'
+
+    import lambda_function
+
+    def collected():
+        # Every gateway's response is held until the last one arrives.
+        def zones():
+            systemsInfo = lambda_function.getSystemsInfo(lambda_function.current_tenant().auth)
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                tStatInfoLists = list(executor.map(lambda_function.getSystemTStatInfo, systemsInfo))
+            for system, tStatInfo in zip(systemsInfo, tStatInfoLists):
+                yield from lambda_function.getZoneStates(system, tStatInfo)
+        return consume(zones())
+
+    def streamed():
+        return consume(lambda_function.iterFleetState())
+
+    def streamed_async():
+        # The async iterator is consumed on the async client's loop.
+        async def consume_async():
+            start = time.perf_counter()
+            first = None
+            zones = 0
+            async for zone in lambda_function.iterFleetStateAsync():
+                if first is None:
+                    first = time.perf_counter() - start
+                zones += 1
+            return (zones, first)
+        return lambda_function.run_async(consume_async())
+
+    lambda_function.get_session()
+    async_client = has_aiohttp()
+    if async_client:
+        # Imported up front so the import is not timed as part of the async snapshot
+        importlib.import_module('aiohttp')
+    print('%-22s %8s %12s %12s %12s' % ('', 'zones', 'first ms', 'total ms', 'peak KiB'))
+    for (name, snapshot) in [('collect then build', collected), ('iterFleetState', streamed)] + (
+            [('iterFleetStateAsync', streamed_async)] if async_client else []):
+        state.reset_counters()
+        (zones, first, total, peak) = measure(snapshot)
+        calls = sum(state.counters()['calls'].values())
+        print('%-22s %8d %12.1f %12.1f %12.1f   (%d upstream calls)' % (name, zones, first, total, peak, calls))
+    lambda_function.shutdown()
+    server.shutdown()
+
+
+def has_aiohttp():
+    return importlib.util.find_spec('aiohttp') is not None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+'''
+Local stand-in for the parts of the myicomfort DBAcessService.svc API that the
+skill uses: GetSystemsInfo, GetTStatInfoList, SetTStatInfo, and the program
+(schedule) calls GetProgramInfo, SetProgramInfo and SetProgramInfoNewString.
+
+Serves any number of gateways and zones from memory, with configurable latency,
+jitter and error injection, and counts calls and bytes per operation so that
+benchmarks can report upstream usage.
+
+Run standalone with:
+    python benchmarks/myicomfort_standin.py --gateways 3 --zones 4 --latency-ms 80
+then point the skill at it with MYICOMFORT_URL=http://127.0.0.1:8080/DBAcessService.svc/
+'''
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+SERVICE_PATH = '/DBAcessService.svc/'
+
+# Every day of the default program: (start minute, heat setpoint, cool setpoint)
+# for the Wake, Leave, Return and Sleep periods
+DEFAULT_PROGRAM_DAY = [(360, 68, 76), (480, 62, 85), (1080, 68, 76), (1320, 64, 78)]
+
+
+class StandinState:
+    '''
+    In-memory account: systems, zone state and call counters.
+    '''
+    def __init__(self, gateways=1, zones=1, userid='standin', latency_ms=0, jitter_ms=0, error_rate=0.0, seed=None):
+        self.userid = userid
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.systems = []
+        self.zones = {}
+        self.programs = {}
+        for g in range(gateways):
+            gatewaysn = 'STANDIN%04d' % g
+            self.systems.append({
+                'Gateway_SN': gatewaysn,
+                'System_Name': 'System %d' % g,
+                'SystemID': 1000 + g,
+                'Firmware_Ver': '02.08.0151',
+                'Status': 'GOOD',
+            })
+            self.zones[gatewaysn] = [self.new_zone(gatewaysn, z, zones) for z in range(zones)]
+            self.programs[(gatewaysn, 0)] = self.new_program()
+
+    def new_zone(self, gatewaysn, zone_number, zones_installed):
+        return {
+            'GatewaySN': gatewaysn,
+            'Zone_Number': zone_number,
+            'Zone_Name': 'Zone %d' % (zone_number + 1),
+            'Zone_Enabled': 1,
+            'Zones_Installed': zones_installed,
+            'Indoor_Temp': 70,
+            'Indoor_Humidity': 45,
+            'Heat_Set_Point': 66,
+            'Cool_Set_Point': 74,
+            'Operation_Mode': 3,
+            'Fan_Mode': 0,
+            'Pref_Temp_Units': '0',
+            'System_Status': 0,
+            'Away_Mode': 0,
+            'Program_Schedule_Mode': '0',
+            'Program_Schedule_Selection': 0,
+        }
+
+    def new_program(self):
+        '''
+        Returns a program with the same four periods every day. Days of the
+        week are numbered from 0 for Sunday; start times are minutes after
+        midnight.
+        '''
+        return [{
+            'Day_Of_Week': day,
+            'Period_Number': number,
+            'Start_Time': start,
+            'Heat_Set_Point': heat,
+            'Cool_Set_Point': cool,
+            'Fan_Mode': 0,
+        } for day in range(7) for number, (start, heat, cool) in enumerate(DEFAULT_PROGRAM_DAY)]
+
+    def endpoint_ids(self):
+        return [zone['GatewaySN'] + ':' + str(zone['Zone_Number']) for zones in self.zones.values() for zone in zones]
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.errors.clear()
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def counters(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'errors': dict(self.errors),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+
+    def delay(self):
+        seconds = (self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000.0
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def should_fail(self):
+        return self.error_rate > 0 and self.random.random() < self.error_rate
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, Nagle's algorithm
+    # adds delayed-ACK stalls that the real service does not have.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        operation = url.path[len(SERVICE_PATH):] if url.path.startswith(SERVICE_PATH) else None
+        # Query parameter names are case-insensitive in the real service
+        query = {k.lower(): v for k, v in parse_qsl(url.query, keep_blank_values=True)}
+        if operation == 'GetSystemsInfo':
+            self.handle_call(operation, lambda: {'Systems': self.state.systems})
+        elif operation == 'GetTStatInfoList':
+            self.handle_call(operation, lambda: self.get_tstat_info_list(query))
+        elif operation == 'GetProgramInfo':
+            self.handle_call(operation, lambda: self.get_program_info(query))
+        else:
+            self.send_body(404, {'error': 'Unknown operation'})
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        with self.state.lock:
+            self.state.bytes_in += length
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+        if url.path == SERVICE_PATH + 'SetTStatInfo':
+            self.handle_call('SetTStatInfo', lambda: self.set_tstat_info(json.loads(body)))
+        elif url.path == SERVICE_PATH + 'SetProgramInfo':
+            self.handle_call('SetProgramInfo', lambda: self.set_program_info(json.loads(body)))
+        elif url.path == SERVICE_PATH + 'SetProgramInfoNewString':
+            self.handle_call('SetProgramInfoNewString', lambda: self.set_program_mode(query))
+        else:
+            self.send_body(404, {'error': 'Unknown operation'})
+
+    def handle_call(self, operation, fn):
+        state = self.state
+        with state.lock:
+            state.calls[operation] += 1
+            fail = state.should_fail()
+        state.delay()
+        if fail:
+            with state.lock:
+                state.errors[operation] += 1
+            self.send_body(500, {'error': 'Injected failure'})
+            return
+        try:
+            self.send_body(200, fn())
+        except LookupError as e:
+            self.send_body(404, {'error': str(e)})
+
+    def get_tstat_info_list(self, query):
+        zones = self.state.zones.get(query.get('gatewaysn'))
+        if zones is None:
+            raise LookupError('Unknown gateway')
+        zone_number = query.get('zone_number')
+        with self.state.lock:
+            if zone_number:
+                zones = [zone for zone in zones if str(zone['Zone_Number']) == zone_number]
+            return {'tStatInfo': [dict(zone) for zone in zones]}
+
+    def set_tstat_info(self, data):
+        with self.state.lock:
+            for zone in self.state.zones.get(data.get('GatewaySN'), []):
+                if zone['Zone_Number'] == data.get('Zone_Number'):
+                    zone.update(data)
+                    return {}
+        raise LookupError('Unknown zone')
+
+    def get_program_info(self, query):
+        with self.state.lock:
+            program = self.state.programs.get((query.get('gatewaysn'), int(query.get('schedulenum') or 0)))
+            if program is None:
+                raise LookupError('Unknown program')
+            return {'ProgramInfo': [dict(period) for period in program]}
+
+    def set_program_info(self, data):
+        with self.state.lock:
+            key = (data.get('GatewaySN'), int(data.get('Schedule_Number') or 0))
+            if key[0] not in self.state.zones:
+                raise LookupError('Unknown gateway')
+            self.state.programs[key] = [dict(period) for period in data['ProgramInfo']]
+            return {}
+
+    def set_program_mode(self, query):
+        with self.state.lock:
+            for zone in self.state.zones.get(query.get('GatewaySN'), []):
+                if str(zone['Zone_Number']) == query.get('ZoneNumber'):
+                    zone['Program_Schedule_Selection'] = int(query['Program_Schedule_Selection'])
+                    zone['Program_Schedule_Mode'] = query['Program_Schedule_Mode']
+                    zone['Operation_Mode'] = int(query['Operation_Mode'])
+                    if zone['Program_Schedule_Mode'] == '1':
+                        self.apply_program(zone)
+                    return {}
+        raise LookupError('Unknown zone')
+
+    def apply_program(self, zone):
+        '''
+        Sets a zone's setpoints to those of its program's period in effect now
+        (UTC), as the thermostat does when it resumes its program.
+        '''
+        now = datetime.now(timezone.utc)
+        minute = (now.isoweekday() % 7) * 1440 + now.hour * 60 + now.minute
+        program = self.state.programs.get((zone['GatewaySN'], zone['Program_Schedule_Selection']), [])
+        started = [p for p in program if p['Day_Of_Week'] * 1440 + p['Start_Time'] <= minute] or program
+        if started:
+            period = max(started, key=lambda p: p['Day_Of_Week'] * 1440 + p['Start_Time'])
+            zone['Heat_Set_Point'] = period['Heat_Set_Point']
+            zone['Cool_Set_Point'] = period['Cool_Set_Point']
+
+    def send_body(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        with self.state.lock:
+            self.state.bytes_out += len(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 resets connections when many clients connect at once
+    request_queue_size = 128
+
+    def __init__(self, state, host='127.0.0.1', port=0):
+        super().__init__((host, port), StandinHandler)
+        self.state = state
+
+    @property
+    def url(self):
+        return 'http://%s:%d%s' % (self.server_address[0], self.server_address[1], SERVICE_PATH)
+
+    def start(self):
+        '''
+        Serves requests on a background thread and returns the service URL.
+        '''
+        threading.Thread(target=self.serve_forever, name='myicomfort-standin', daemon=True).start()
+        return self.url
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the myicomfort service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--gateways', type=int, default=1)
+    parser.add_argument('--zones', type=int, default=1)
+    parser.add_argument('--userid', default='standin')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    state = StandinState(args.gateways, args.zones, args.userid, args.latency_ms, args.jitter_ms, args.error_rate)
+    server = StandinServer(state, args.host, args.port)
+    print('Serving myicomfort stand-in at %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+Microbenchmark for building and serializing large multi-zone Discover.Response
+payloads.
+
+Compares encoding the response with a plain json.dumps against
+ResponseDict.to_json(), which reuses the pre-serialized text of the discovery
+capabilities. to_json() is what server.py writes out and what the log uses; in
+Lambda the runtime encodes the returned dict itself, so there only a sampled
+log line benefits.
+
+    python benchmarks/response_microbench.py --zones 50 100 400
+'''
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lambda_function
+
+
+def make_systems(zones, zones_per_gateway=4):
+    systemsInfo = []
+    tStatInfoLists = []
+    for g in range((zones + zones_per_gateway - 1) // zones_per_gateway):
+        gatewaysn = 'BENCH%06d' % g
+        systemsInfo.append({'Gateway_SN': gatewaysn, 'System_Name': 'System %d' % g, 'SystemID': g, 'Firmware_Ver': '02.08.0151'})
+        count = min(zones_per_gateway, zones - g * zones_per_gateway)
+        tStatInfoLists.append([{
+            'GatewaySN': gatewaysn,
+            'Zone_Number': z,
+            'Zone_Name': 'Zone %d' % (z + 1),
+            'Zone_Enabled': 1,
+            'Zones_Installed': count,
+        } for z in range(count)])
+    return systemsInfo, tStatInfoLists
+
+
+def bench(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Discover.Response building and serialization')
+    parser.add_argument('--zones', type=int, nargs='+', default=[10, 100, 400])
+    parser.add_argument('--number', type=int, default=50)
+    args = parser.parse_args()
+
+    print('%6s %10s %12s %12s %12s %8s' % ('zones', 'bytes', 'build us', 'dumps us', 'to_json us', 'gain'))
+    for zones in args.zones:
+        systemsInfo, tStatInfoLists = make_systems(zones)
+        build = lambda: lambda_function.buildDiscoveryResponse(systemsInfo, tStatInfoLists)
+        response = build().get()
+        assert json.loads(response.to_json()) == json.loads(json.dumps(response))
+
+        build_us = bench(build, args.number)
+        dumps_us = bench(lambda: json.dumps(response), args.number)
+        to_json_us = bench(response.to_json, args.number)
+        print('%6d %10d %12.1f %12.1f %12.1f %7.1fx' % (
+            zones, len(response.to_json()), build_us, dumps_us, to_json_us, dumps_us / to_json_us))
+
+if __name__ == '__main__':
+    main()
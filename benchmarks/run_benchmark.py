@@ -0,0 +1,161 @@
+'''
+Latency and round-trip benchmark for the skill.
+
+Starts the myicomfort stand-in, points lambda_function at it and drives
+lambda_handler with the recorded directives in directives.json. For each
+directive type reports p50/p95/p99 latency, upstream calls and bytes
+transferred per directive, and from the skill's own metrics (METRICS=memory)
+the time spent outside upstream calls, retries and state cache hit rate.
+
+    python benchmarks/run_benchmark.py --gateways 4 --zones 3 --latency-ms 80 --jitter-ms 20
+'''
+import argparse
+import copy
+import io
+import json
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from myicomfort_standin import StandinServer, StandinState
+
+DIRECTIVE_ORDER = ['Discover', 'ReportState', 'SetTargetTemperature', 'AdjustTargetTemperature', 'SetThermostatMode']
+MODES = ['HEAT', 'COOL', 'AUTO']
+
+
+class LambdaContext:
+    '''
+    Minimal stand-in for the Lambda context object, counting down from the
+    function timeout.
+    '''
+    def __init__(self, timeout_ms):
+        self.deadline = time.monotonic() + timeout_ms / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def percentile(samples, pct):
+    '''
+    Nearest-rank percentile of a list of samples.
+    '''
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def load_directives(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def make_request(recorded, name, iteration, endpoint_ids):
+    '''
+    Returns a copy of a recorded directive aimed at the next endpoint in turn.
+    '''
+    request = copy.deepcopy(recorded[name])
+    directive = request['directive']
+    if 'endpoint' in directive:
+        directive['endpoint']['endpointId'] = endpoint_ids[iteration % len(endpoint_ids)]
+    if name == 'SetThermostatMode':
+        directive['payload']['thermostatMode']['value'] = MODES[iteration % len(MODES)]
+    if name == 'AdjustTargetTemperature':
+        directive['payload']['targetSetpointDelta']['value'] = 1.0 if iteration % 2 == 0 else -1.0
+    return request
+
+
+def run(lambda_function, state, recorded, names, iterations, cold_cache, timeout_ms):
+    from lennox import observability
+    endpoint_ids = state.endpoint_ids()
+    results = []
+    # lambda_handler logs every request and response; keep that out of the report
+    # but still pay for writing it
+    observability._log_handler.setStream(io.StringIO())
+    for name in names:
+        latencies = []
+        failures = 0
+        state.reset_counters()
+        lambda_function.metrics.reset()
+        for i in range(iterations):
+            request = make_request(recorded, name, i, endpoint_ids)
+            if cold_cache:
+                lambda_function.current_tenant().cache.clear()
+            start = time.perf_counter()
+            try:
+                response = lambda_function.lambda_handler(request, LambdaContext(timeout_ms))
+                if response['event']['header']['name'] == 'ErrorResponse':
+                    failures += 1
+            except Exception:
+                failures += 1
+            latencies.append((time.perf_counter() - start) * 1000.0)
+        counters = state.counters()
+        snapshot = lambda_function.metrics.snapshot()
+        own = snapshot['histograms'].get('own:' + name)
+        hits = snapshot['counters'].get('CacheHits', 0)
+        lookups = hits + snapshot['counters'].get('CacheMisses', 0)
+        results.append({
+            'directive': name,
+            'iterations': iterations,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'calls_per_directive': sum(counters['calls'].values()) / float(iterations),
+            'bytes_per_directive': (counters['bytes_in'] + counters['bytes_out']) / float(iterations),
+            'failures': failures,
+            'own_ms': own['mean'] if own else None,
+            'retries': snapshot['counters'].get('UpstreamRetries', 0),
+            'cache_hit_rate': hits / float(lookups) if lookups else None,
+            'calls': counters['calls'],
+            'errors': counters['errors'],
+        })
+    return results
+
+
+def print_report(results):
+    print('%-24s %8s %8s %8s %8s %12s %8s %8s %8s %8s' % ('directive', 'p50 ms', 'p95 ms', 'p99 ms', 'calls', 'bytes', 'failed', 'own ms', 'retries', 'hit %'))
+    for r in results:
+        print('%-24s %8.1f %8.1f %8.1f %8.2f %12.0f %8d %8s %8d %8s' % (
+            r['directive'], r['p50_ms'], r['p95_ms'], r['p99_ms'], r['calls_per_directive'], r['bytes_per_directive'], r['failures'],
+            '-' if r['own_ms'] is None else '%.2f' % r['own_ms'], r['retries'],
+            '-' if r['cache_hit_rate'] is None else '%.0f' % (r['cache_hit_rate'] * 100)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark lambda_handler against the myicomfort stand-in')
+    parser.add_argument('--directives', default=os.path.join(BENCHMARK_DIR, 'directives.json'))
+    parser.add_argument('--only', action='append', choices=DIRECTIVE_ORDER, help='Directive type to run (repeatable)')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--gateways', type=int, default=2)
+    parser.add_argument('--zones', type=int, default=2)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--timeout-ms', type=int, default=8000, help='Lambda time budget per directive')
+    parser.add_argument('--cold-cache', action='store_true', help='Clear the state cache before every directive')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    state = StandinState(args.gateways, args.zones, 'standin', args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+    server = StandinServer(state)
+    os.environ['MYICOMFORT_URL'] = server.start()
+    os.environ.setdefault('USERID', state.userid)
+    os.environ.setdefault('PASSWORD', 'standin')
+    os.environ.setdefault('METRICS', 'memory')
+
+    import lambda_function
+
+    results = run(lambda_function, state, load_directives(args.directives), args.only or DIRECTIVE_ORDER, args.iterations, args.cold_cache, args.timeout_ms)
+    server.shutdown()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
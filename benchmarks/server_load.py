@@ -0,0 +1,95 @@
+'''
+Load benchmark for the self-hosted server (server.py).
+
+Starts the myicomfort stand-in and a DirectiveServer in this process, then
+sends directives over HTTP from many concurrent clients. Reports throughput,
+p50/p95/p99 latency, failures and upstream calls, and how long the server
+took to drain at the end.
+
+    python benchmarks/server_load.py --concurrency 64 --requests 2000 --latency-ms 80
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import requests
+
+from myicomfort_standin import StandinServer, StandinState
+from run_benchmark import DIRECTIVE_ORDER, load_directives, make_request, percentile
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark server.py with concurrent clients against the myicomfort stand-in')
+    parser.add_argument('--directives', default=os.path.join(BENCHMARK_DIR, 'directives.json'))
+    parser.add_argument('--only', action='append', choices=DIRECTIVE_ORDER, help='Directive type to send (repeatable, default ReportState and SetThermostatMode)')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=32, help='Server worker threads')
+    parser.add_argument('--gateways', type=int, default=4)
+    parser.add_argument('--zones', type=int, default=2)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    args = parser.parse_args()
+
+    state = StandinState(args.gateways, args.zones, 'standin', args.latency_ms, args.jitter_ms, seed=1)
+    standin = StandinServer(state)
+    os.environ['MYICOMFORT_URL'] = standin.start()
+    os.environ.setdefault('USERID', state.userid)
+    os.environ.setdefault('PASSWORD', 'standin')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    import lambda_function
+    from server import DirectiveServer
+
+    server = DirectiveServer(('127.0.0.1', 0), args.workers, 8000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    recorded = load_directives(args.directives)
+    names = args.only or ['ReportState', 'SetThermostatMode']
+    endpoint_ids = state.endpoint_ids()
+    bodies = [json.dumps(make_request(recorded, names[i % len(names)], i, endpoint_ids)) for i in range(args.requests)]
+    sessions = threading.local()
+
+    def send(body):
+        session = getattr(sessions, 'session', None)
+        if session is None:
+            session = sessions.session = requests.Session()
+        start = time.perf_counter()
+        r = session.post(url, data=body, headers={'Content-Type': 'application/json'})
+        ok = r.status_code == 200 and r.json()['event']['header']['name'] != 'ErrorResponse'
+        return ((time.perf_counter() - start) * 1000.0, ok)
+
+    state.reset_counters()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, bodies))
+    elapsed = time.perf_counter() - start
+
+    drain_start = time.perf_counter()
+    server.drain(10)
+    drain_ms = (time.perf_counter() - drain_start) * 1000.0
+    lambda_function.shutdown()
+    standin.shutdown()
+
+    latencies = [latency for (latency, ok) in results]
+    calls = sum(state.counters()['calls'].values())
+    print('Directives            %10d (%s)' % (len(results), ', '.join(names)))
+    print('Concurrency           %10d clients, %d workers' % (args.concurrency, args.workers))
+    print('Throughput            %10.1f directives/s' % (len(results) / elapsed))
+    print('Latency p50/p95/p99   %10.1f / %.1f / %.1f ms' % (percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99)))
+    print('Failures              %10d' % sum(1 for (latency, ok) in results if not ok))
+    print('Upstream calls        %10d (%.2f per directive)' % (calls, calls / float(len(results))))
+    print('Drain                 %10.1f ms' % drain_ms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Telemetry recorder benchmark.
+
+Fills a TelemetryRecorder file with simulated zone samples (a day/night
+temperature swing, setpoint changes and mode switches), then times recording
+and each query over the full history. Reports the file size per sample.
+
+    python benchmarks/telemetry_queries.py --endpoints 8 --days 100 --interval 300
+'''
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lennox import HVAC_MODES
+from lennox.telemetry import TelemetryRecorder
+
+
+def simulate(recorder, endpointId, start, samples, interval, rng):
+    (gatewaysn, zone) = endpointId.split(':')
+    tStatInfo = {'GatewaySN': gatewaysn, 'Zone_Number': int(zone), 'Heat_Set_Point': 66, 'Cool_Set_Point': 74,
+                 'Operation_Mode': 3, 'Pref_Temp_Units': '0'}
+    for i in range(samples):
+        now = start + i * interval
+        tStatInfo['Indoor_Temp'] = round(70 + 4 * math.sin(now / 86400.0 * 2 * math.pi) + rng.uniform(-1, 1))
+        if rng.random() < 0.01:
+            tStatInfo['Operation_Mode'] = rng.randrange(len(HVAC_MODES))
+        if rng.random() < 0.01:
+            tStatInfo['Heat_Set_Point'] = rng.randint(62, 70)
+        recorder.record(tStatInfo, now=now)
+
+
+def bench(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark TelemetryRecorder recording and queries')
+    parser.add_argument('--endpoints', type=int, default=4)
+    parser.add_argument('--days', type=float, default=90)
+    parser.add_argument('--interval', type=float, default=300, help='Seconds between samples')
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args()
+
+    samples = int(args.days * 86400 / args.interval)
+    path = os.path.join(tempfile.mkdtemp(), 'telemetry.bin')
+    # min_interval=0 records every sample, so each endpoint gets exactly 'samples' of them.
+    recorder = TelemetryRecorder(path, capacity=samples, max_endpoints=args.endpoints, min_interval=0)
+    endpoint_ids = ['BENCH%06d:0' % i for i in range(args.endpoints)]
+    rng = random.Random(1)
+    start = int(time.time()) - samples * int(args.interval)
+
+    record_start = time.perf_counter()
+    for endpointId in endpoint_ids:
+        simulate(recorder, endpointId, start, samples, int(args.interval), rng)
+    record_us = (time.perf_counter() - record_start) / (samples * args.endpoints) * 1e6
+    recorder.flush()
+
+    endpointId = endpoint_ids[0]
+    # A second recorder on the same file, as another process would open it
+    reader = TelemetryRecorder(path)
+    end = start + samples * int(args.interval)
+    week = end - 7 * 86400
+    queries = [
+        ('samples (all)', lambda: reader.samples(endpointId)),
+        ('summary (all)', lambda: reader.summary(endpointId)),
+        ('summary (last week)', lambda: reader.summary(endpointId, start=week)),
+        ('summary (hourly)', lambda: reader.summary(endpointId, interval=3600)),
+        ('mode_durations', lambda: reader.mode_durations(endpointId, end=end)),
+        ('setpoint_drift', lambda: reader.setpoint_drift(endpointId)),
+    ]
+
+    print('Samples per endpoint  %10d (%.0f days every %.0f s)' % (samples, args.days, args.interval))
+    print('File size             %10.1f MiB (%.1f bytes per sample)' % (
+        os.path.getsize(path) / 1048576.0, os.path.getsize(path) / float(samples * args.endpoints)))
+    print('Record                %10.1f us per sample' % record_us)
+    for (name, query) in queries:
+        print('%-21s %10.2f ms' % (name, bench(query, args.number)))
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,78 @@
+import time
+_MODULE_START = time.perf_counter()
+
+import contextvars
+import copy
+import functools
+import itertools
 import json
-import math
-import random
-import uuid
 import logging
-import datetime
-import requests
 import os
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timezone
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+from lennox import FAN_MODES, HVAC_MODES, JSON_HEADERS, TEMPS, UpstreamError, ZoneNotFoundError
+from lennox import telemetry, tenancy, upstream
+from lennox.lazy import asyncio, random, startup_timings, uuid
+# metrics is re-exported for server.py and the benchmarks, which report
+# lambda_function.metrics.snapshot().
+from lennox.observability import (
+    METRICS_ENABLED, _batch_id, _correlation_id, count, log_payload, logger, metrics,
+    start_invocation, trace_directive)
+from lennox.schedule import (
+    SCHEDULE_MODE_PROGRAM, SCHEDULE_PERIODS, getSchedulePeriod, getSchedulePeriodProperty,
+    loadPrograms, loadProgramsAsync)
+from lennox.telemetry import record_telemetry
+from lennox.tenancy import (
+    ADJUST_DEBOUNCE_MS, FLEET_MAX_CONCURRENCY, HTTP_POOL_SIZE, _tenant, current_tenant,
+    get_credential_store, get_directive_token, leave_tenant, use_tenant_for)
+from lennox.upstream import (
+    async_myicomfort_get, async_myicomfort_put, get_session, myicomfort_get, myicomfort_put,
+    on_client_loop, remaining_time, request_timeout, run_async, set_deadline)
+
+# Cleared once the first invocation has logged the startup timing report
+_first_invocation = True
+
+# Asyncio client. With ASYNC_HANDLER set, lambda_handler routes discovery, state
+# reports and thermostat control through async_lambda_handler. Requires aiohttp.
+ASYNC_HANDLER = os.environ.get('ASYNC_HANDLER', 'false').lower() == 'true'
 
-USERID = os.environ.get('USERID')
-PASSWORD = os.environ.get('PASSWORD')
-auth = (USERID,PASSWORD)
+# Maximum number of gateways queried at once during discovery (by either client).
+DISCOVERY_MAX_WORKERS = int(os.environ.get('DISCOVERY_MAX_WORKERS', '8'))
 
-# URLs
-MYICOMFORT_URL = "https://services.myicomfort.com/DBAcessService.svc/"
+# When true, control directives read the thermostat back after writing and report
+# what it returns. Otherwise the response is built from the state just written.
+VERIFY_WRITES = os.environ.get('VERIFY_WRITES', 'false').lower() == 'true'
 
-# Constants and arrays to convert from Lennox numbers to Alexa words
-TEMPS = ['FAHRENHEIT', 'CELCIUS']
-FAN_MODES = ['AUTO','ON','CIRCULATE']
-HVAC_MODES = ['OFF', 'HEAT','COOL', 'AUTO'] 
+# Proactive state reporting. With CHANGE_REPORTS set, the temperature and thermostat
+# properties are discovered as proactivelyReported, and a ChangeReportPoller sends an
+# Alexa.ChangeReport whenever a zone's temperature, mode or setpoints change. The poll
+# interval starts at POLL_MIN_INTERVAL seconds, grows by POLL_BACKOFF after each poll
+# that finds no change, up to POLL_MAX_INTERVAL, and drops back to the minimum after a
+# change or a write. An account's list of gateways is re-read every POLL_GATEWAYS_TTL
+# seconds. Events are POSTed to CHANGE_REPORT_URL with the account's own bearer token
+# from its AcceptGrant: with LWA_CLIENT_ID and LWA_CLIENT_SECRET (the skill's Login
+# With Amazon credentials) set, the grant code is exchanged at LWA_TOKEN_URL, and the
+# tokens are kept in the credential store and refreshed as they expire.
+# CHANGE_REPORT_TOKEN is a fixed token for the USERID/PASSWORD account instead. Events
+# for an account with no token are only logged.
+CHANGE_REPORTS = os.environ.get('CHANGE_REPORTS', 'false').lower() == 'true'
+POLL_MIN_INTERVAL = float(os.environ.get('POLL_MIN_INTERVAL', '15'))
+POLL_MAX_INTERVAL = float(os.environ.get('POLL_MAX_INTERVAL', '300'))
+POLL_BACKOFF = float(os.environ.get('POLL_BACKOFF', '2'))
+POLL_GATEWAYS_TTL = float(os.environ.get('POLL_GATEWAYS_TTL', '3600'))
+CHANGE_REPORT_URL = os.environ.get('CHANGE_REPORT_URL', 'https://api.amazonalexa.com/v3/events')
+CHANGE_REPORT_TOKEN = os.environ.get('CHANGE_REPORT_TOKEN')
+LWA_CLIENT_ID = os.environ.get('LWA_CLIENT_ID')
+LWA_CLIENT_SECRET = os.environ.get('LWA_CLIENT_SECRET')
+LWA_TOKEN_URL = os.environ.get('LWA_TOKEN_URL', 'https://api.amazon.com/auth/o2/token')
+
+# One zone's state in a fleet snapshot, with Lennox numbers converted to Alexa words
+ZoneState = namedtuple('ZoneState', (
+    'endpoint_id', 'gateway_sn', 'zone_number', 'name', 'temperature', 'humidity',
+    'heat_setpoint', 'cool_setpoint', 'mode', 'fan_mode', 'scale', 'system_status', 'away'))
 
 
 def discover():
@@ -30,46 +81,32 @@ def discover():
     Returns one endpoint for each thermostat.
     If a thermostat has multiple zones, returns one endpoint for each zone.
     '''
-    
+    # Get list of thermostats        
+    systemsInfo = getSystemsInfo(current_tenant().auth)
+        
+    # Get TStat info for every thermostat concurrently. Results are collected in
+    # system order so the endpoint list is deterministic. Each worker runs in a copy
+    # of this context so it sees the invocation's deadline.
+    with ThreadPoolExecutor(max_workers=max(1, min(DISCOVERY_MAX_WORKERS, len(systemsInfo)))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, getSystemTStatInfo, system) for system in systemsInfo]
+        tStatInfoLists = [future.result() for future in futures]
+
+    return send_response(buildDiscoveryResponse(systemsInfo, tStatInfoLists).get())
+
+def buildDiscoveryResponse(systemsInfo, tStatInfoLists):
+    '''
+    Returns the Discover.Response for a list of systems and, in the same order,
+    the list of zone tStatInfo objects for each one (None for gateways that
+    could not be queried).
+    '''
     # Build response
     discovery_response = AlexaResponse(namespace='Alexa.Discovery', name='Discover.Response')
-    # Create the response and add the capabilities.
-    capability_alexa = discovery_response.create_payload_endpoint_capability()
-    capability_alexa_temperaturesensor = discovery_response.create_payload_endpoint_capability(
-        interface='Alexa.TemperatureSensor',
-        supported=[{'name': 'temperature'}],
-        retrievable=True)
-    capability_alexa_thermostatcontroller = discovery_response.create_payload_endpoint_capability(
-        interface='Alexa.ThermostatController',
-        supported=[
-            {'name': 'targetSetpoint'},
-            {'name': 'lowerSetpoint'},
-            {'name': 'upperSetpoint'},
-            {'name': 'thermostatMode'}
-            ],
-        version='3.2',
-        retrievable=True,
-        configuration = {'supportedModes' : ["OFF","HEAT","COOL","AUTO","ECO"]})
-    capability_alexa_endpointhealth = discovery_response.create_payload_endpoint_capability(
-        interface='Alexa.EndpointHealth',
-        supported=[{'name': 'connectivity'}],
-        version='3.2',
-        retrievable=True)
 
-    # Get list of thermostats        
-    r = requests.get(MYICOMFORT_URL + "GetSystemsInfo?userid=" + USERID, auth=auth)
-    # TODO - error checking
-    response = json.loads(r.text)
-    systemsInfo = response['Systems']
-    logger.debug(systemsInfo)
-        
     # Loop through thermostats
-    for system in systemsInfo:
-        # Get TStat info to see how many zones
-        r = requests.get(MYICOMFORT_URL + "GetTStatInfoList?gatewaysn=" + system['Gateway_SN'] + "&TempUnit=&Cancel_Away=-1", auth=auth)
-        response = json.loads(r.text)
-        tStatInfo = response['tStatInfo']
-        logger.debug(tStatInfo)
+    for system, tStatInfo in zip(systemsInfo, tStatInfoLists):
+        # Skip gateways that could not be queried
+        if tStatInfo is None:
+            continue
         # Loop through zones
         for zone in tStatInfo:
             if zone['Zone_Enabled'] == 1:
@@ -78,41 +115,228 @@ def discover():
                     endpoint_id = zone['GatewaySN'] + ":" + str(zone['Zone_Number']),
                     manufacturer_name = 'Lennox',
                     description = 'Wi-Fi Thermostat by Lennox',
-                    display_categories = ['THERMOSTAT','TEMPERATURE_SENSOR'],
-                    capabilities = [capability_alexa, capability_alexa_endpointhealth, capability_alexa_temperaturesensor, capability_alexa_thermostatcontroller],
+                    display_categories = DISPLAY_CATEGORIES,
+                    capabilities = DISCOVERY_CAPABILITIES,
                     additionalAttributes = {
                         'serialNumber': system['Gateway_SN'],
                         'firmwareVersion': system['Firmware_Ver'],
                         'customIdentifier': str(system['SystemID'])
                         }
                     )
-    response = discovery_response.get()
-    logger.debug(response)
-    return send_response(response)
+    return discovery_response
 
-def getAlexaResponse(endpointId, name='Response'):
+def getSystemsInfo(auth):
     '''
-    Returns an Alexa response object with the thermostat's current state
+    Returns the list of systems (thermostats) in the account.
     '''
-    tStatInfo = LennoxWiFi(endpointId, auth).getTStatInfo()
-    temp_units = TEMPS[int(tStatInfo['Pref_Temp_Units'])]
+    r = myicomfort_get("GetSystemsInfo?userid=" + auth[0], auth)
+    if not r.ok:
+        raise UpstreamError('myicomfort returned %d for GetSystemsInfo' % r.status_code)
+    response = json.loads(r.text)
+    systemsInfo = response['Systems']
+    logger.debug('Systems: %s', systemsInfo)
+    return systemsInfo
+
+def getSystemTStatInfo(system):
+    '''
+    Returns the list of zone tStatInfo objects for a system, or None if the
+    gateway could not be queried. Failures are logged so that one bad gateway
+    does not fail the whole discovery.
+    '''
+    try:
+        # Get TStat info to see how many zones
+        tStatInfo = getGatewayTStatInfo(system['Gateway_SN'], current_tenant().auth)
+    except Exception:
+        logger.exception('Failed to get TStat info for gateway %s', system.get('Gateway_SN'))
+        return None
+    logger.debug('TStat info for %s: %s', system.get('Gateway_SN'), tStatInfo)
+    return tStatInfo
+
+def getGatewayTStatInfo(gatewaysn, auth):
+    '''
+    Returns the list of tStatInfo objects for every zone on a gateway.
+    One unfiltered GetTStatInfoList call fills the state cache for all zones.
+    Concurrent calls for the same gateway share a single upstream request,
+    except that a call made after one of its zones was written never shares a
+    request that started before the write.
+    '''
+    tenant = current_tenant()
+    generation = tenant.cache.generation(gatewaysn)
+    return tenant.gateway_fetches.do((gatewaysn, generation), _fetchGatewayTStatInfo, gatewaysn, auth, generation)
+
+def _fetchGatewayTStatInfo(gatewaysn, auth, generation):
+    r = myicomfort_get("GetTStatInfoList?gatewaysn=" + gatewaysn + "&tempunit=&Cancel_Away=-1", auth, key=gatewaysn)
+    if not r.ok:
+        raise UpstreamError('myicomfort returned %d for GetTStatInfoList' % r.status_code)
+    text = r.text
+    logger.debug('GetTStatInfoList %s: %s', gatewaysn, text)
+    tStatInfo = cacheGatewayTStatInfo(json.loads(text)['tStatInfo'], generation)
+    loadPrograms(tStatInfo)
+    return tStatInfo
+
+def cacheGatewayTStatInfo(tStatInfo, generation=None):
+    '''
+    Puts each zone of a gateway's tStatInfo list into the state cache.
+    'generation' is the state cache's generation of the gateway from before it
+    was read: if one of its zones has been written since, none are cached.
+    '''
+    cache = current_tenant().cache
+    for zone in tStatInfo:
+        cache.put(zone['GatewaySN'] + ":" + str(zone['Zone_Number']), zone, generation, zone['GatewaySN'])
+        record_telemetry(zone)
+    return tStatInfo
+
+def parseEndpointId(endpointId):
+    '''
+    Splits an endpoint ID ('<gatewaysn>:<zone>') into the gateway serial
+    number and zone number. Raises ValueError if it is not in that form.
+    '''
+    parts = endpointId.split(':')
+    if len(parts) != 2:
+        raise ValueError('Malformed endpoint ID %r' % endpointId)
+    return tuple(parts)
+
+def getZoneStates(system, tStatInfo):
+    '''
+    Returns a ZoneState for each enabled zone in a gateway's tStatInfo list.
+    Zones are named as they are in discovery.
+    '''
+    return [ZoneState(
+        endpoint_id = zone['GatewaySN'] + ":" + str(zone['Zone_Number']),
+        gateway_sn = zone['GatewaySN'],
+        zone_number = zone['Zone_Number'],
+        name = zone['Zone_Name'] if zone['Zones_Installed'] > 1 else system['System_Name'],
+        temperature = zone['Indoor_Temp'],
+        humidity = zone.get('Indoor_Humidity'),
+        heat_setpoint = zone['Heat_Set_Point'],
+        cool_setpoint = zone['Cool_Set_Point'],
+        mode = HVAC_MODES[zone['Operation_Mode']],
+        fan_mode = FAN_MODES[zone['Fan_Mode']],
+        scale = TEMPS[int(zone['Pref_Temp_Units'])],
+        system_status = zone.get('System_Status'),
+        away = bool(zone.get('Away_Mode'))
+        ) for zone in tStatInfo if zone['Zone_Enabled'] == 1]
+
+def iterFleetState():
+    '''
+    Yields a ZoneState for every enabled zone in the current account, a gateway
+    at a time, as each gateway's GetTStatInfoList call returns. Only the gateways
+    being fetched (at most FLEET_MAX_CONCURRENCY) are held in memory, so a large
+    account is streamed rather than collected. Gateways that cannot be queried
+    are logged and skipped, as in discovery.
+    '''
+    tenant = current_tenant()
+    systems = iter(getSystemsInfo(tenant.auth))
+    executor = ThreadPoolExecutor(max_workers=FLEET_MAX_CONCURRENCY, thread_name_prefix='lennox-fleet')
+    pending = {}
+
+    def submit(system):
+        # Each fetch runs in a copy of this context so it sees the deadline and account.
+        pending[executor.submit(contextvars.copy_context().run, _fetchFleetGateway, tenant, system)] = system
+
+    try:
+        for system in itertools.islice(systems, FLEET_MAX_CONCURRENCY):
+            submit(system)
+        while pending:
+            (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                system = pending.pop(future)
+                # Keep the window full while the caller works through this gateway.
+                for system_next in itertools.islice(systems, 1):
+                    submit(system_next)
+                tStatInfo = future.result()
+                if tStatInfo is not None:
+                    yield from getZoneStates(system, tStatInfo)
+    finally:
+        # Also runs if the caller stops early: fetches not yet started are dropped.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _fetchFleetGateway(tenant, system):
+    with tenant.fleet_slots:
+        return getSystemTStatInfo(system)
+
+def getAlexaResponse(endpointId, name='Response', tStatInfo=None, tenant=None):
+    '''
+    Returns an Alexa response object with the thermostat's current state, for
+    'tenant' (default the current one). If tStatInfo is passed in, it is used
+    instead of reading the thermostat. The program period is reported from
+    the program cache, which is filled along with the gateway's state.
+    '''
+    tenant = tenant or current_tenant()
+    if tStatInfo is None:
+        tStatInfo = LennoxWiFi(endpointId, tenant.auth).getTStatInfo()
 
     # Build response
     alexa_response = AlexaResponse(namespace='Alexa', name=name, endpoint_id=endpointId)
-    alexa_response.add_context_property(namespace='Alexa.TemperatureSensor', name='temperature', value={'value':tStatInfo['Indoor_Temp'], 'scale':temp_units})
-    alexa_response.add_context_property(namespace='Alexa.ThermostatController', name='thermostatMode', value={'value':HVAC_MODES[tStatInfo['Operation_Mode']]})
+    for prop in getStateProperties(tStatInfo):
+        alexa_response.add_context_property(**prop)
+    period = getSchedulePeriodProperty(tStatInfo, tenant)
+    if period is not None:
+        alexa_response.add_context_property(**period)
+    return alexa_response
+
+def getStateProperties(tStatInfo):
+    '''
+    Returns the Alexa properties for a thermostat's state, as a list of
+    add_context_property() arguments.
+    '''
+    temp_units = TEMPS[int(tStatInfo['Pref_Temp_Units'])]
+    properties = [
+        {'namespace': 'Alexa.TemperatureSensor', 'name': 'temperature', 'value': {'value':tStatInfo['Indoor_Temp'], 'scale':temp_units}},
+        {'namespace': 'Alexa.ThermostatController', 'name': 'thermostatMode', 'value': {'value':HVAC_MODES[tStatInfo['Operation_Mode']]}},
+    ]
     # if mode is HEAT or COOL, return a single setpoint. Otherwise, return upper and lower setpoints.
     if tStatInfo['Operation_Mode'] == HVAC_MODES.index('COOL'):
-        alexa_response.add_context_property(namespace='Alexa.ThermostatController', name='targetSetpoint', value={'value':tStatInfo['Cool_Set_Point'], 'scale':temp_units})
+        properties.append({'namespace': 'Alexa.ThermostatController', 'name': 'targetSetpoint', 'value': {'value':tStatInfo['Cool_Set_Point'], 'scale':temp_units}})
     elif tStatInfo['Operation_Mode'] == HVAC_MODES.index('HEAT'):
-        alexa_response.add_context_property(namespace='Alexa.ThermostatController', name='targetSetpoint', value={'value':tStatInfo['Heat_Set_Point'], 'scale':temp_units})
+        properties.append({'namespace': 'Alexa.ThermostatController', 'name': 'targetSetpoint', 'value': {'value':tStatInfo['Heat_Set_Point'], 'scale':temp_units}})
     else:
-        alexa_response.add_context_property(namespace='Alexa.ThermostatController', name='lowerSetpoint', value={'value':tStatInfo['Heat_Set_Point'], 'scale':temp_units})
-        alexa_response.add_context_property(namespace='Alexa.ThermostatController', name='upperSetpoint', value={'value':tStatInfo['Cool_Set_Point'], 'scale':temp_units})
-        
-    return alexa_response
+        properties.append({'namespace': 'Alexa.ThermostatController', 'name': 'lowerSetpoint', 'value': {'value':tStatInfo['Heat_Set_Point'], 'scale':temp_units}})
+        properties.append({'namespace': 'Alexa.ThermostatController', 'name': 'upperSetpoint', 'value': {'value':tStatInfo['Cool_Set_Point'], 'scale':temp_units}})
+    return properties
+
+def getChangeReport(endpointId, before, after):
+    '''
+    Returns an Alexa.ChangeReport for a thermostat whose state went from 'before'
+    to 'after', or None if no reported property changed. Changed properties go in
+    the payload and the rest in the context.
+    '''
+    previous = {(prop['namespace'], prop['name']): prop['value'] for prop in getStateProperties(before)}
+    changed = []
+    unchanged = []
+    for prop in getStateProperties(after):
+        if previous.get((prop['namespace'], prop['name'])) == prop['value']:
+            unchanged.append(prop)
+        else:
+            changed.append(prop)
+    if not changed:
+        return None
+    # A temperature change alone was picked up by polling; anything else was
+    # changed at the thermostat or in the Lennox app.
+    if all(prop['namespace'] == 'Alexa.TemperatureSensor' for prop in changed):
+        cause = 'PERIODIC_POLL'
+    else:
+        cause = 'PHYSICAL_INTERACTION'
+    report = AlexaResponse(namespace='Alexa', name='ChangeReport', endpoint_id=endpointId)
+    report.set_payload({'change': {
+        'cause': {'type': cause},
+        'properties': [report.create_context_property(**prop) for prop in changed]}})
+    for prop in unchanged:
+        report.add_context_property(**prop)
+    return report
     
 
+def getControlResponse(tStat):
+    '''
+    Returns the Alexa response for a control directive on tStat.
+    Built from the state just written, unless VERIFY_WRITES is set, in which
+    case the thermostat is read back to confirm the change.
+    '''
+    if VERIFY_WRITES:
+        current_tenant().cache.invalidate(tStat.endpointId)
+        return getAlexaResponse(tStat.endpointId)
+    return getAlexaResponse(tStat.endpointId, tStatInfo=tStat.tStatInfo)
+
 def reportState(endpointId):
     '''
     Returns the state of the thermostat.
@@ -128,9 +352,19 @@ def setTemperature(endpointId, firstSetpoint, secondSetpoint=None):
     '''
 
     # Get current values for fields we have to pass back
-    tStat = LennoxWiFi(endpointId, auth)
+    tStat = LennoxWiFi(endpointId, current_tenant().auth)
     tStatInfo = tStat.getTStatInfo()
-    logger.debug(f'Current set points: {tStatInfo['Heat_Set_Point']} and {tStatInfo['Cool_Set_Point']}')
+    tStat.setTStatInfo(**planSetTemperature(tStatInfo, firstSetpoint, secondSetpoint))
+
+    return send_response(getControlResponse(tStat).get())
+
+def planSetTemperature(tStatInfo, firstSetpoint, secondSetpoint=None):
+    '''
+    Works out which setpoint(s) a SetTargetTemperature request changes, given the
+    thermostat's current state.
+    Returns the keyword arguments to pass to LennoxWiFi.setTStatInfo().
+    '''
+    logger.debug('Current set points: %s and %s', tStatInfo['Heat_Set_Point'], tStatInfo['Cool_Set_Point'])
     
     if secondSetpoint is None:
         # One value passed in.
@@ -144,62 +378,93 @@ def setTemperature(endpointId, firstSetpoint, secondSetpoint=None):
         # temp is close to the desired value, and this 'delta' is just a tweak.
         # E.g. If the current setpoint range is 64 and 71, and the current temp is 65, assume we 
         # are heating, so change the lower setpoint. 
-        logger.debug('Requested setpoint = %i' % firstSetpoint)
+        logger.debug('Requested setpoint = %i', firstSetpoint)
         if tStatInfo['Operation_Mode'] == HVAC_MODES.index('COOL'):
-            logger.debug(f'COOL: Setting upper setpoint to {firstSetpoint}')
-            tStat.setTStatInfo(upperSetpoint=firstSetpoint)
+            logger.debug('COOL: Setting upper setpoint to %s', firstSetpoint)
+            changes = dict(upperSetpoint=firstSetpoint)
         elif tStatInfo['Operation_Mode'] == HVAC_MODES.index('HEAT'):
-            logger.debug(f'HEAT: Setting lower setpoint to {firstSetpoint}')
-            tStat.setTStatInfo(lowerSetpoint=firstSetpoint)
+            logger.debug('HEAT: Setting lower setpoint to %s', firstSetpoint)
+            changes = dict(lowerSetpoint=firstSetpoint)
         else: # AUTO
             if firstSetpoint <= tStatInfo['Heat_Set_Point']:
                 # Requested temp is below lower set point, so change it.
-                logger.debug(f'AUTO: {firstSetpoint} is below lower setpoint. Setting lower setpoint to {firstSetpoint}')
-                tStat.setTStatInfo(lowerSetpoint=firstSetpoint)
+                logger.debug('AUTO: %s is below lower setpoint. Setting lower setpoint to %s', firstSetpoint, firstSetpoint)
+                changes = dict(lowerSetpoint=firstSetpoint)
             elif firstSetpoint >= tStatInfo['Cool_Set_Point']:
                 # Requested temp is above upper set point, to change it.
-                logger.debug(f'AUTO: {firstSetpoint} is above upper setpoint. Setting upper setpoint to {firstSetpoint}')
-                tStat.setTStatInfo(upperSetpoint=firstSetpoint)
+                logger.debug('AUTO: %s is above upper setpoint. Setting upper setpoint to %s', firstSetpoint, firstSetpoint)
+                changes = dict(upperSetpoint=firstSetpoint)
             else:
                 # Requested temp is between current setpoints. 
                 # Find which setpoint current temp is nearest and change it
                 midpoint = (tStatInfo['Heat_Set_Point'] + tStatInfo['Cool_Set_Point']) / 2.0
-                logger.debug(f'Midpoint = {midpoint}')
-                logger.debug(f'Current temp = {tStatInfo['Indoor_Temp']}')
+                logger.debug('Midpoint = %s', midpoint)
+                logger.debug('Current temp = %s', tStatInfo['Indoor_Temp'])
                 if tStatInfo['Indoor_Temp'] < midpoint:
-                    logger.debug(f'AUTO: Setting lower setpoint to {firstSetpoint}')
-                    tStat.setTStatInfo(lowerSetpoint=firstSetpoint)
+                    logger.debug('AUTO: Setting lower setpoint to %s', firstSetpoint)
+                    changes = dict(lowerSetpoint=firstSetpoint)
                 else:
-                    logger.debug(f'AUTO: Setting upper setpoint to {firstSetpoint}')
-                    tStat.setTStatInfo(upperSetpoint=firstSetpoint)
+                    logger.debug('AUTO: Setting upper setpoint to %s', firstSetpoint)
+                    changes = dict(upperSetpoint=firstSetpoint)
     else:
         # two values passed in
-        tStat.setTStatInfo(lowerSetpoint=firstSetpoint, upperSetpoint=secondSetpoint)
-        logger.debug(f'New set points: {firstSetpoint} and {secondSetpoint}')
+        changes = dict(lowerSetpoint=firstSetpoint, upperSetpoint=secondSetpoint)
+        logger.debug('New set points: %s and %s', firstSetpoint, secondSetpoint)
     
-    return send_response(getAlexaResponse(endpointId).get())
+    return changes
     
 def adjustTemperature(endpointId, delta):
     '''
     Adjusts the thermostat by 'delta' degrees (plus or minus).
     '''
 
+    # Merge bursts of adjustments into a single write
+    if ADJUST_DEBOUNCE_MS > 0:
+        tenant = current_tenant()
+        apply = functools.partial(applyAdjustment, endpointId, tenant.auth)
+        tStatInfo = tenant.adjust_writes.adjust(endpointId, delta, apply, remaining_time())
+        return send_response(getAlexaResponse(endpointId, tStatInfo=tStatInfo).get())
+
     # Get current values for fields we have to pass back
+    tStat = LennoxWiFi(endpointId, current_tenant().auth)
+    tStatInfo = tStat.getTStatInfo()
+    tStat.setTStatInfo(**planAdjustTemperature(tStatInfo, delta))
+
+    return send_response(getControlResponse(tStat).get())
+
+def applyAdjustment(endpointId, auth, delta):
+    '''
+    Makes a merged adjustment of the endpoint's setpoints with one
+    read-modify-write, for AdjustCoalescer. Returns the tStatInfo written (or
+    read back, with VERIFY_WRITES).
+    '''
     tStat = LennoxWiFi(endpointId, auth)
     tStatInfo = tStat.getTStatInfo()
+    tStat.setTStatInfo(**planAdjustTemperature(tStatInfo, delta))
+    if VERIFY_WRITES:
+        current_tenant().cache.invalidate(endpointId)
+        tStat.getTStatInfo()
+    return tStat.tStatInfo
+
+def planAdjustTemperature(tStatInfo, delta):
+    '''
+    Works out the new setpoints for an AdjustTargetTemperature request, given the
+    thermostat's current state.
+    Returns the keyword arguments to pass to LennoxWiFi.setTStatInfo().
+    '''
     upperSetpoint = tStatInfo['Cool_Set_Point']
     lowerSetpoint = tStatInfo['Heat_Set_Point']
-    logger.debug(f'Current set points: {lowerSetpoint} and {upperSetpoint}')
+    logger.debug('Current set points: %s and %s', lowerSetpoint, upperSetpoint)
     
     # If system is in COOL or HEAT mode, set corresponding set point.
     # Otherwise (in AUTO), if delta is negative, adjusts upper (cool) setpoint, otherwise adjust lower (heat) setpoint.
-    logger.debug('Requested setpoint adjustment = %i' % delta)
-    if tStatInfo['Operation_Mode'] == 'COOL':
+    logger.debug('Requested setpoint adjustment = %i', delta)
+    if tStatInfo['Operation_Mode'] == HVAC_MODES.index('COOL'):
         upperSetpoint += delta
-        tStat.setTStatInfo(upperSetpoint=upperSetpoint)
-    elif tStatInfo['Operation_Mode'] == 'HEAT':
+        changes = dict(upperSetpoint=upperSetpoint)
+    elif tStatInfo['Operation_Mode'] == HVAC_MODES.index('HEAT'):
         lowerSetpoint += delta
-        tStat.setTStatInfo(lowerSetpoint=lowerSetpoint)
+        changes = dict(lowerSetpoint=lowerSetpoint)
     else:
         # If delta is negative, adjust upper. Otherwise, lower.
         if delta > 0:
@@ -207,43 +472,210 @@ def adjustTemperature(endpointId, delta):
             # if difference between upper and lower is < 3 degrees, make it 3.
             if upperSetpoint - lowerSetpoint < 3:
                 upperSetpoint = lowerSetpoint + 3
-            logger.debug(f'AUTO: Adjusted heat/lower setpoint by {delta}')
+            logger.debug('AUTO: Adjusted heat/lower setpoint by %s', delta)
         else:
             upperSetpoint += delta
             # if difference between upper and lower is < 3 degrees, make it 3.
             if upperSetpoint - lowerSetpoint < 3:
                 lowerSetpoint = upperSetpoint - 3
-            logger.debug(f'AUTO: Adjusted cool/upper setpoint by {delta}')
+            logger.debug('AUTO: Adjusted cool/upper setpoint by %s', delta)
         # Set both (in case both changed)
-        tStat.setTStatInfo(lowerSetpoint=lowerSetpoint, upperSetpoint=upperSetpoint)
-    logger.debug(f'New set points: {lowerSetpoint} and {upperSetpoint}')
+        changes = dict(lowerSetpoint=lowerSetpoint, upperSetpoint=upperSetpoint)
+    logger.debug('New set points: %s and %s', lowerSetpoint, upperSetpoint)
 
-    return send_response(getAlexaResponse(endpointId).get())
+    return changes
     
 def setOperatingMode(endpointId, mode):
     '''
     Sets mode (heat, cool, away/eco, off, auto).
     'mode' is one of "OFF", "HEAT", "COOL", "AUTO", or "ECO" (which sets Away mode)
     '''
-    tStat = LennoxWiFi(endpointId, auth)
+    tStat = LennoxWiFi(endpointId, current_tenant().auth)
     tStatInfo = tStat.getTStatInfo()
-    logger.debug('Current operating mode: %s' % HVAC_MODES[tStatInfo['Operation_Mode']])
-    tStat.setTStatInfo(operating_mode=HVAC_MODES.index(mode))
-    logger.debug('Set operating mode to %s' % mode)
+    tStat.setTStatInfo(**planOperatingMode(tStatInfo, mode))
 
-    return send_response(getAlexaResponse(endpointId).get())
-    
+    return send_response(getControlResponse(tStat).get())
 
-def lambda_handler(request, context):
+def planOperatingMode(tStatInfo, mode):
+    '''
+    Returns the keyword arguments to pass to LennoxWiFi.setTStatInfo() to switch
+    the thermostat to 'mode'.
+    '''
+    logger.debug('Current operating mode: %s', HVAC_MODES[tStatInfo['Operation_Mode']])
+    logger.debug('Set operating mode to %s', mode)
+    return dict(operating_mode=HVAC_MODES.index(mode))
 
-    # Dump the request for logging - check the CloudWatch logs.
-    print('lambda_handler request  -----')
-    print(json.dumps(request))
+def resumeSchedule(endpointId):
+    '''
+    Puts the zone back on its program. The thermostat returns to the setpoints
+    of the period in effect and follows the program from then on.
+    '''
+    tStat = LennoxWiFi(endpointId, current_tenant().auth)
+    tStat.resumeSchedule()
+    return send_response(getControlResponse(tStat).get())
+
+
+async def discoverAsync():
+    '''
+    Asyncio version of discover(). At most DISCOVERY_MAX_WORKERS gateways are
+    queried at once.
+    '''
+    auth = current_tenant().auth
+    systemsInfo = await getSystemsInfoAsync(auth)
+    slots = asyncio.Semaphore(DISCOVERY_MAX_WORKERS)
+
+    async def fetch(system):
+        async with slots:
+            return await getGatewayTStatInfoAsync(system['Gateway_SN'], auth)
 
+    results = await asyncio.gather(*[fetch(system) for system in systemsInfo], return_exceptions=True)
+    tStatInfoLists = []
+    for system, result in zip(systemsInfo, results):
+        if isinstance(result, Exception):
+            logger.error('Failed to get TStat info for gateway %s: %r', system.get('Gateway_SN'), result)
+            result = None
+        tStatInfoLists.append(result)
+    return send_response(buildDiscoveryResponse(systemsInfo, tStatInfoLists).get())
+
+async def reportStateAsync(endpointId):
+    '''
+    Asyncio version of reportState().
+    '''
+    tStatInfo = await AsyncLennoxWiFi(endpointId, current_tenant().auth).getTStatInfo()
+    return send_response(getAlexaResponse(endpointId, 'StateReport', tStatInfo=tStatInfo).get())
+
+async def controlAsync(endpointId, plan, *args):
+    '''
+    Asyncio version of the thermostat control directives. 'plan' is one of
+    planSetTemperature, planAdjustTemperature or planOperatingMode.
+    '''
+    tStat = AsyncLennoxWiFi(endpointId, current_tenant().auth)
+    tStatInfo = await tStat.getTStatInfo()
+    tStatInfo = await tStat.setTStatInfo(**plan(tStatInfo, *args))
+    if VERIFY_WRITES:
+        current_tenant().cache.invalidate(endpointId)
+        tStatInfo = await AsyncLennoxWiFi(endpointId, current_tenant().auth).getTStatInfo()
+    return send_response(getAlexaResponse(endpointId, tStatInfo=tStatInfo).get())
+
+# Directives that async_lambda_handler handles itself
+ASYNC_DIRECTIVES = frozenset({
+    ('Alexa.Discovery', 'Discover'),
+    ('Alexa', 'ReportState'),
+    ('Alexa.ThermostatController', 'SetTargetTemperature'),
+    ('Alexa.ThermostatController', 'AdjustTargetTemperature'),
+    ('Alexa.ThermostatController', 'SetThermostatMode'),
+})
+
+async def async_lambda_handler(request, context):
+    '''
+    Asyncio entry point. Handles the directives in ASYNC_DIRECTIVES with the async
+    client, so their network waits can overlap. Anything else is passed to
+    lambda_handler on a worker thread.
+    '''
+    directive = request.get('directive', {})
+    header = directive.get('header', {})
+    namespace = header.get('namespace')
+    name = header.get('name')
+    if (namespace, name) not in ASYNC_DIRECTIVES:
+        return await asyncio.to_thread(lambda_handler, request, context)
+
+    set_deadline(context)
+    start_invocation(request, context)
+    log_payload('async_lambda_handler request', request)
+    return await _dispatch_request_async(directive, request)
+
+async def _dispatch_request_async(directive, request):
+    '''
+    Handles a directive in ASYNC_DIRECTIVES for an invocation whose deadline,
+    correlation ID and payload sampling are already set.
+    '''
+    token = use_tenant_for(directive)
+    if token is None:
+        return send_response(getInvalidCredentialResponse(directive).get())
+    try:
+        with trace_directive(request):
+            try:
+                return await on_client_loop(dispatch_directive_async(directive))
+            except (UpstreamError, LookupError, ValueError) as e:
+                return send_response(getErrorResponse(directive, e).get())
+    finally:
+        leave_tenant(token)
+
+async def dispatch_directive_async(directive):
+    name = directive['header']['name']
+    if name == 'Discover':
+        return await discoverAsync()
+    endpointId = directive['endpoint']['endpointId']
+    if name == 'ReportState':
+        return await reportStateAsync(endpointId)
+    (plan, args) = getControlPlan(directive)
+    return await controlAsync(endpointId, plan, *args)
+
+def getControlPlan(directive):
+    '''
+    Returns a tuple of (plan function, arguments) for a ThermostatController
+    directive that changes setpoints or mode, or None for any other directive.
+    '''
+    header = directive['header']
+    if header['namespace'] != 'Alexa.ThermostatController':
+        return None
+    payload = directive['payload']
+    if header['name'] == 'SetTargetTemperature':
+        if 'targetSetpoint' in payload.keys():
+            return (planSetTemperature, (payload['targetSetpoint']['value'],))
+        else:
+            return (planSetTemperature, (payload['lowerSetpoint']['value'], payload['upperSetpoint']['value']))
+    if header['name'] == 'AdjustTargetTemperature':
+        return (planAdjustTemperature, (payload['targetSetpointDelta']['value'],))
+    if header['name'] == 'SetThermostatMode':
+        return (planOperatingMode, (payload['thermostatMode']['value'],))
+    return None
 
+def log_startup_timing(handler):
+    '''
+    Wraps a handler so the first invocation in this container logs a startup
+    timing report: module load time, time spent in the first invocation, and
+    the modules imported lazily along the way.
+    '''
+    @functools.wraps(handler)
+    def wrapper(request, context):
+        global _first_invocation
+        if not _first_invocation:
+            return handler(request, context)
+        _first_invocation = False
+        start = time.perf_counter()
+        try:
+            return handler(request, context)
+        finally:
+            startup_timings['first_invocation_ms'] = round((time.perf_counter() - start) * 1000, 1)
+            logger.info('Startup timing: %s', json.dumps(startup_timings))
+    return wrapper
+
+def trace_invocation(handler):
+    '''
+    Wraps a handler so each invocation is traced as one directive (see
+    trace_directive()). Returns the handler unchanged when metrics are off.
+    '''
+    if not METRICS_ENABLED:
+        return handler
+    @functools.wraps(handler)
+    def wrapper(request, context):
+        with trace_directive(request):
+            return handler(request, context)
+    return wrapper
+
+@log_startup_timing
+@trace_invocation
+def lambda_handler(request, context):
+
+    # Bound every upstream call by the time this invocation has left.
+    set_deadline(context)
+    start_invocation(request, context)
+
+    # Dump the request for logging - check the CloudWatch logs.
+    log_payload('lambda_handler request', request)
     if context is not None:
-        print('lambda_handler context  -----')
-        print(context)
+        logger.debug('lambda_handler context: %s', context)
 
     # Validate the request is an Alexa smart home directive.
     if 'directive' not in request:
@@ -266,15 +698,44 @@ def lambda_handler(request, context):
     # Crack open the request to see the request.
     name = directive['header']['name']
     namespace = directive['header']['namespace']
-    auth = (USERID, PASSWORD)
+
+    # Let the asyncio client handle what it can. It finds the account itself.
+    if ASYNC_HANDLER and (namespace, name) in ASYNC_DIRECTIVES:
+        return run_async(_dispatch_request_async(directive, request))
+
+    # Find the account this directive is for.
+    token = use_tenant_for(directive)
+    if token is None:
+        return send_response(getInvalidCredentialResponse(directive).get())
+    try:
+        return dispatch_directive(directive)
+    except (UpstreamError, LookupError, ValueError) as e:
+        return send_response(getErrorResponse(directive, e).get())
+    finally:
+        leave_tenant(token)
+
+def dispatch_directive(directive):
+    name = directive['header']['name']
+    namespace = directive['header']['namespace']
 
     # Handle the incoming request from Alexa based on the namespace.
     if namespace == 'Alexa.Authorization':
         if name == 'AcceptGrant':
-            # Note: This example code accepts any grant request.
-            # In your implementation, invoke Login With Amazon with the grant code to get access and refresh tokens.
+            # Keep the grant, and exchange the code with Login With Amazon for the
+            # tokens used to send events for this account.
             grant_code = directive['payload']['grant']['code']
             grantee_token = directive['payload']['grantee']['token']
+            try:
+                store = get_credential_store()
+                store.save_grant(grant_code, grantee_token)
+                if LWA_CLIENT_ID:
+                    store.save_event_tokens(current_tenant().auth[0], request_lwa_tokens({'grant_type': 'authorization_code', 'code': grant_code}))
+            except Exception as e:
+                logger.exception('Failed to store grant')
+                return send_response(AlexaResponse(
+                    namespace='Alexa.Authorization',
+                    name='ErrorResponse',
+                    payload={'type': 'ACCEPT_GRANT_FAILED', 'message': 'Failed to store grant: %s' % e}).get())
             auth_response = AlexaResponse(namespace='Alexa.Authorization', name='AcceptGrant.Response')
             return send_response(auth_response.get())
 
@@ -297,15 +758,365 @@ def lambda_handler(request, context):
         if name == 'SetThermostatMode':
             return setOperatingMode(directive['endpoint']['endpointId'], directive['payload']['thermostatMode']['value'])
         if name == 'ResumeSchedule':
-            return None;
+            return resumeSchedule(directive['endpoint']['endpointId'])
+
+# Directives lambda_batch_handler groups by gateway. Anything else in a batch is
+# handled on its own by lambda_handler.
+BATCH_DIRECTIVES = frozenset({
+    ('Alexa', 'ReportState'),
+    ('Alexa.ThermostatController', 'SetTargetTemperature'),
+    ('Alexa.ThermostatController', 'AdjustTargetTemperature'),
+    ('Alexa.ThermostatController', 'SetThermostatMode'),
+})
+
+@trace_invocation
+def lambda_batch_handler(events, context):
+    '''
+    Handles a list of directive events in one call and returns their Alexa
+    responses in input order.
+    Directives are grouped by gateway: each gateway's state is read once, and the
+    setpoint and mode changes aimed at one zone are applied in order and merged
+    into a single SetTStatInfo PUT. Each response reports the zone's state as of
+    that directive. A directive that fails gets an error response of its own
+    without failing the rest of the batch.
+    '''
+    set_deadline(context)
+    start_invocation({}, context)
+    token = _batch_id.set(_correlation_id.get())
+    try:
+        return _handleBatch(events, context)
+    finally:
+        _batch_id.reset(token)
+
+def _handleBatch(events, context):
+    # Directives for different accounts are handled as separate batches.
+    accounts = OrderedDict()
+    for index, event in enumerate(events):
+        accounts.setdefault(get_directive_token(event.get('directive', {})), []).append(index)
+    if len(accounts) > 1:
+        responses = [None] * len(events)
+        for indices in accounts.values():
+            for index, response in zip(indices, _handleBatch([events[index] for index in indices], context)):
+                responses[index] = response
+        return responses
+    responses = [None] * len(events)
 
+    # Pick out the directives that can be grouped
+    zone_directives = []
+    for index, event in enumerate(events):
+        directive = event.get('directive', {})
+        header = directive.get('header', {})
+        if 'endpoint' in directive and (header.get('namespace'), header.get('name')) in BATCH_DIRECTIVES:
+            zone_directives.append((index, directive))
+        else:
+            # In a context of its own, so its correlation ID and account stay with it
+            responses[index] = contextvars.copy_context().run(lambda_handler, event, context)
+
+    if not zone_directives:
+        return responses
+    token = use_tenant_for(zone_directives[0][1])
+    if token is None:
+        for index, directive in zone_directives:
+            responses[index] = send_response(getInvalidCredentialResponse(directive).get())
+        return responses
+    try:
+        _handleZoneDirectives(zone_directives, responses)
+    finally:
+        leave_tenant(token)
+    return responses
+
+def _handleZoneDirectives(zone_directives, responses):
+    '''
+    Handles the batch's directives for the current account's zones, filling in
+    their responses.
+    '''
+    auth = current_tenant().auth
+
+    # A malformed endpoint ID fails its own directive only
+    parsed = []
+    for index, directive in zone_directives:
+        endpointId = directive['endpoint']['endpointId']
+        try:
+            (gatewaysn, zone_num) = parseEndpointId(endpointId)
+        except ValueError as e:
+            responses[index] = send_response(getErrorResponse(directive, e).get())
+            continue
+        parsed.append((index, directive, endpointId, gatewaysn, zone_num))
+
+    # Read each gateway once, concurrently
+    gateways = list(dict.fromkeys(gatewaysn for (index, directive, endpointId, gatewaysn, zone_num) in parsed))
+    gateway_zones = {}
+    if gateways:
+        with ThreadPoolExecutor(max_workers=min(DISCOVERY_MAX_WORKERS, len(gateways))) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, getGatewayTStatInfo, gatewaysn, auth) for gatewaysn in gateways]
+            for gatewaysn, future in zip(gateways, futures):
+                try:
+                    gateway_zones[gatewaysn] = {str(zone['Zone_Number']): zone for zone in future.result()}
+                except Exception as e:
+                    gateway_zones[gatewaysn] = e
+
+    # Apply changes in input order, tracking each zone's state as it goes
+    tStats = OrderedDict()
+    changes = {}
+    snapshots = []
+    for index, directive, endpointId, gatewaysn, zone_num in parsed:
+        zones = gateway_zones[gatewaysn]
+        if isinstance(zones, Exception):
+            responses[index] = send_response(getErrorResponse(directive, zones).get())
+            continue
+        if zone_num not in zones:
+            error = ZoneNotFoundError('Zone %s not found on gateway %s' % (zone_num, gatewaysn))
+            responses[index] = send_response(getErrorResponse(directive, error).get())
+            continue
+        if endpointId not in tStats:
+            tStats[endpointId] = LennoxWiFi(endpointId, auth)
+            tStats[endpointId].tStatInfo = zones[zone_num]
+            changes[endpointId] = {}
+        try:
+            control = getControlPlan(directive)
+            if control is not None:
+                (plan, args) = control
+                current = _batchState(tStats[endpointId], changes[endpointId])
+                changes[endpointId].update(plan(current, *args))
+        except Exception as e:
+            responses[index] = send_response(getErrorResponse(directive, e).get())
+            continue
+        snapshots.append((index, endpointId, _batchState(tStats[endpointId], changes[endpointId]), directive))
+
+    # One PUT per changed zone
+    written = [endpointId for endpointId in tStats if changes[endpointId]]
+    failures = {}
+    if written:
+        with ThreadPoolExecutor(max_workers=min(HTTP_POOL_SIZE, len(written))) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, tStats[endpointId].setTStatInfo, **changes[endpointId]) for endpointId in written]
+            for endpointId, future in zip(written, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[endpointId] = e
+    if VERIFY_WRITES:
+        for endpointId in written:
+            current_tenant().cache.invalidate(endpointId)
+
+    for index, endpointId, tStatInfo, directive in snapshots:
+        try:
+            if endpointId in failures:
+                response = getErrorResponse(directive, failures[endpointId])
+            elif directive['header']['name'] == 'ReportState':
+                response = getAlexaResponse(endpointId, 'StateReport', tStatInfo=tStatInfo)
+            elif VERIFY_WRITES:
+                response = getAlexaResponse(endpointId)
+            else:
+                response = getAlexaResponse(endpointId, tStatInfo=tStatInfo)
+        except Exception as e:
+            response = getErrorResponse(directive, e)
+        responses[index] = send_response(response.get())
+
+def _batchState(tStat, changes):
+    '''
+    Returns tStat's state with pending batch changes applied.
+    '''
+    return dict(tStat.tStatInfo, **tStat.buildTStatData(**changes))
+
+def lambda_poll_handler(event, context):
+    '''
+    Entry point for a scheduled invocation (e.g. an EventBridge rule). Runs one
+    change report poll and returns the number of ChangeReports sent.
+    The last state seen is kept in the container, so the first poll after a
+    cold start only records a baseline.
+    '''
+    set_deadline(context)
+    start_invocation({}, context)
+    tenant = tenancy.default_tenant
+    if tenant.change_poller is None:
+        tenant.change_poller = ChangeReportPoller(get_change_report_sink(tenant), tenant)
+    return {'changeReports': tenant.change_poller.poll_once()}
+
+def start_change_reports(sink=None, tenant=None):
+    '''
+    Starts the change report poller for an account (by default the USERID/PASSWORD
+    one) on a background thread, for long-running hosts. 'sink' is called with
+    each ChangeReport; it defaults to get_change_report_sink(). Returns the poller.
+    '''
+    tenant = tenant or tenancy.default_tenant
+    if tenant.change_poller is None:
+        tenant.change_poller = ChangeReportPoller(sink or get_change_report_sink(tenant), tenant)
+    tenant.change_poller.start()
+    return tenant.change_poller
+
+def get_change_report_sink(tenant=None):
+    '''
+    Returns the default ChangeReport sink for an account (by default the
+    USERID/PASSWORD one): the Alexa event gateway if event tokens can be had
+    (LWA_CLIENT_ID or CHANGE_REPORT_TOKEN is set), otherwise the log.
+    '''
+    if LWA_CLIENT_ID or CHANGE_REPORT_TOKEN:
+        return EventGatewaySink(CHANGE_REPORT_URL, tenant=tenant or tenancy.default_tenant)
+    return log_change_report
+
+def get_event_token(tenant):
+    '''
+    Returns the bearer token for sending an account's events: the access token
+    from its AcceptGrant (refreshed first if it is about to expire), or else
+    CHANGE_REPORT_TOKEN for the USERID/PASSWORD account. Returns None if there
+    is neither.
+    '''
+    userid = tenant.auth[0]
+    store = get_credential_store()
+    tokens = store.event_tokens(userid)
+    if tokens is None:
+        return CHANGE_REPORT_TOKEN if tenant.auth == tenancy.default_tenant.auth else None
+    if tokens['expires_at'] - 60 < time.time() and tokens.get('refresh_token'):
+        tokens = request_lwa_tokens({'grant_type': 'refresh_token', 'refresh_token': tokens['refresh_token']})
+        store.save_event_tokens(userid, tokens)
+    return tokens['access_token']
+
+def request_lwa_tokens(params):
+    '''
+    Gets event gateway tokens from Login With Amazon for an authorization code
+    or a refresh token. Returns a dict of the access token, the refresh token
+    and the epoch time at which the access token expires.
+    '''
+    r = get_session().post(LWA_TOKEN_URL, data=dict(params, client_id=LWA_CLIENT_ID, client_secret=LWA_CLIENT_SECRET), timeout=request_timeout())
+    if r.status_code >= 400:
+        raise UpstreamError('Login With Amazon returned %d' % r.status_code)
+    body = r.json()
+    return {
+        'access_token': body['access_token'],
+        'refresh_token': body.get('refresh_token', params.get('refresh_token')),
+        'expires_at': time.time() + body.get('expires_in', 3600),
+    }
+
+def shutdown(timeout=5):
+    '''
+    Stops every change report poller, closes every account's connection pools
+    and stops the asyncio client's loop. For long-running hosts, once no more
+    directives will be handled.
+    '''
+    for tenant in [tenancy.default_tenant] + tenancy.tenants.clear():
+        tenant.close(timeout)
+    upstream.stop()
+    telemetry.stop(timeout)
+
+def getInvalidCredentialResponse(directive):
+    endpoint = directive.get('endpoint') or {}
+    return AlexaResponse(
+        name='ErrorResponse',
+        endpoint_id=endpoint.get('endpointId', 'INVALID'),
+        payload={'type': 'INVALID_AUTHORIZATION_CREDENTIAL', 'message': 'No myicomfort account is linked to this token'})
+
+def log_change_report(event):
+    log_payload('ChangeReport', event)
+
+def getErrorResponse(directive, error):
+    '''
+    Returns the response to a directive that failed with 'error': an
+    ENDPOINT_UNREACHABLE ErrorResponse when myicomfort could not be reached in
+    time, NO_SUCH_ENDPOINT for a zone the gateway does not have, and
+    INTERNAL_ERROR when myicomfort's answer could not be understood.
+    Discovery has no error response, so a failed Discover finds no endpoints.
+    '''
+    if isinstance(error, UpstreamError):
+        logger.error('Upstream failure: %s', error)
+        count('UpstreamFailures')
+        error_type = 'ENDPOINT_UNREACHABLE'
+    elif isinstance(error, ZoneNotFoundError):
+        logger.warning('%s', error)
+        error_type = 'NO_SUCH_ENDPOINT'
+    else:
+        logger.error('Failed to handle %s: %r', directive['header']['name'], error, exc_info=error)
+        error_type = 'INTERNAL_ERROR'
+    if directive['header']['namespace'] == 'Alexa.Discovery':
+        return AlexaResponse(namespace='Alexa.Discovery', name='Discover.Response', payload={'endpoints': []})
+    endpoint = directive.get('endpoint')
+    if endpoint is None:
+        return AlexaResponse(
+            name='ErrorResponse',
+            payload={'type': error_type, 'message': str(error)})
+    return AlexaResponse(
+        name='ErrorResponse',
+        endpoint_id=endpoint['endpointId'],
+        correlation_token=directive['header'].get('correlationToken'),
+        payload={'type': error_type, 'message': str(error)})
         
 # Send the response
 def send_response(response):
-    print('lambda_handler response -----')
-    print(json.dumps(response))
+    log_payload('lambda_handler response', response)
     return response
 
+async def getSystemsInfoAsync(auth):
+    '''
+    Asyncio version of getSystemsInfo().
+    '''
+    text = await async_myicomfort_get("GetSystemsInfo?userid=" + auth[0], auth)
+    systemsInfo = json.loads(text)['Systems']
+    logger.debug('Systems: %s', systemsInfo)
+    return systemsInfo
+
+async def getGatewayTStatInfoAsync(gatewaysn, auth):
+    '''
+    Asyncio version of getGatewayTStatInfo(). Concurrent calls for the same
+    gateway share one in-flight request.
+    '''
+    tenant = current_tenant()
+    fetches = tenant.async_gateway_fetches
+    key = (gatewaysn, tenant.cache.generation(gatewaysn))
+    call = fetches.get(key)
+    if call is None:
+        call = asyncio.ensure_future(_fetchGatewayTStatInfoAsync(gatewaysn, auth, key[1]))
+        fetches[key] = call
+        call.add_done_callback(lambda f: fetches.pop(key, None))
+    # Shield the shared call so one caller being cancelled does not cancel the others.
+    return await asyncio.shield(call)
+
+async def _fetchGatewayTStatInfoAsync(gatewaysn, auth, generation):
+    text = await async_myicomfort_get("GetTStatInfoList?gatewaysn=" + gatewaysn + "&tempunit=&Cancel_Away=-1", auth, key=gatewaysn)
+    logger.debug('GetTStatInfoList %s: %s', gatewaysn, text)
+    tStatInfo = cacheGatewayTStatInfo(json.loads(text)['tStatInfo'], generation)
+    await loadProgramsAsync(tStatInfo)
+    return tStatInfo
+
+
+async def iterFleetStateAsync():
+    '''
+    Asyncio version of iterFleetState(), for use as 'async for zone in
+    iterFleetStateAsync()' on any event loop.
+    '''
+    tenant = current_tenant()
+    systems = iter(await on_client_loop(getSystemsInfoAsync(tenant.auth)))
+    pending = {}
+
+    async def fetch(system):
+        async with tenant.get_async_fleet_slots():
+            return await getGatewayTStatInfoAsync(system['Gateway_SN'], tenant.auth)
+
+    # The fetches run on the async client's loop, whichever loop the caller is on.
+    def submit(system):
+        pending[asyncio.ensure_future(on_client_loop(fetch(system)))] = system
+
+    try:
+        for system in itertools.islice(systems, FLEET_MAX_CONCURRENCY):
+            submit(system)
+        while pending:
+            (done, _) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                system = pending.pop(task)
+                for system_next in itertools.islice(systems, 1):
+                    submit(system_next)
+                # A fetch is cancelled if a shared in-flight fetch it joined was;
+                # exception() would raise CancelledError into the caller.
+                if task.cancelled():
+                    logger.error('TStat info fetch for gateway %s was cancelled', system.get('Gateway_SN'))
+                    continue
+                if task.exception() is not None:
+                    logger.error('Failed to get TStat info for gateway %s: %r', system.get('Gateway_SN'), task.exception())
+                    continue
+                for zone in getZoneStates(system, task.result()):
+                    yield zone
+    finally:
+        for task in pending:
+            task.cancel()
+
 # Make the call to your device cloud for control
 def update_device_state(endpoint_id, state, value):
     attribute_key = state + 'Value'
@@ -316,12 +1127,35 @@ def update_device_state(endpoint_id, state, value):
 def get_utc_timestamp(seconds=None):
     return datetime.now(timezone.utc).isoformat()
 
+class ResponseDict(dict):
+    '''
+    The dict form of an AlexaResponse, as returned to Lambda (whose runtime
+    encodes it itself). to_json() is for logging and for writing the response
+    out directly, as server.py does: it reuses the JSON text of pre-serialized
+    structures such as the discovery capabilities. The text is built from the
+    dict as it is at the time, so changes made to the dict are included.
+    '''
+    __slots__ = ()
+
+    def to_json(self):
+        payload = self['event']['payload']
+        endpoints = payload.get('endpoints')
+        if not endpoints:
+            return json.dumps(self)
+        payload_json = _json_with(payload, 'endpoints', '[' + ', '.join(map(_endpoint_json, endpoints)) + ']')
+        return _json_with(self, 'event', _json_with(self['event'], 'payload', payload_json))
+
+
 class AlexaResponse:
+    __slots__ = ('context', 'event', 'context_properties', 'payload_endpoints', 'cookies', 'time_of_sample')
 
     def __init__(self, **kwargs):
 
         self.context_properties = []
         self.payload_endpoints = []
+        self.cookies = None
+        # Every property in a response shares one timestamp
+        self.time_of_sample = None
 
         # Set up the response structure.
         self.context = {}
@@ -342,14 +1176,14 @@ class AlexaResponse:
             'payload': kwargs.get('payload', {})
         }
 
-        if 'correlation_token' in kwargs:
-            self.event['header']['correlation_token'] = kwargs.get('correlation_token', 'INVALID')
+        if kwargs.get('correlation_token') is not None:
+            self.event['header']['correlationToken'] = kwargs['correlation_token']
 
         if 'cookie' in kwargs:
             self.event['endpoint']['cookie'] = kwargs.get('cookie', '{}')
 
         # No endpoint property in an AcceptGrant or Discover request.
-        if self.event['header']['name'] == 'AcceptGrant.Response' or self.event['header']['name'] == 'Discover.Response':
+        if self.event['header']['namespace'] == 'Alexa.Authorization' or self.event['header']['name'] == 'Discover.Response':
             self.event.pop('endpoint')
 
     def add_context_property(self, **kwargs):
@@ -370,13 +1204,21 @@ class AlexaResponse:
 
 
     def create_context_property(self, **kwargs):
-        return {
+        prop = {
             'namespace': kwargs.get('namespace', 'Alexa.EndpointHealth'),
             'name': kwargs.get('name', 'connectivity'),
             'value': kwargs.get('value', {'value': 'OK'}),
-            'timeOfSample': get_utc_timestamp(),
+            'timeOfSample': self.get_time_of_sample(),
             'uncertaintyInMilliseconds': kwargs.get('uncertainty_in_milliseconds', 0)
         }
+        if 'instance' in kwargs:
+            prop['instance'] = kwargs['instance']
+        return prop
+
+    def get_time_of_sample(self):
+        if self.time_of_sample is None:
+            self.time_of_sample = get_utc_timestamp()
+        return self.time_of_sample
 
     def create_payload_endpoint(self, **kwargs):
         # Return the proper structure expected for the endpoint.
@@ -405,13 +1247,20 @@ class AlexaResponse:
 
         return endpoint
 
-    def create_payload_endpoint_capability(self, **kwargs):
+    @staticmethod
+    def create_payload_endpoint_capability(**kwargs):
         # All discovery responses must include the Alexa interface
         capability = {
             'type': kwargs.get('type', 'AlexaInterface'),
             'interface': kwargs.get('interface', 'Alexa'),
             'version': kwargs.get('version', '3')
         }
+        instance = kwargs.get('instance', None)
+        if instance:
+            capability['instance'] = instance
+        capability_resources = kwargs.get('capability_resources', None)
+        if capability_resources:
+            capability['capabilityResources'] = capability_resources
         configuration = kwargs.get('configuration', None)
         if configuration:
             capability['configuration'] = configuration
@@ -421,6 +1270,8 @@ class AlexaResponse:
             capability['properties']['supported'] = supported
             capability['properties']['proactivelyReported'] = kwargs.get('proactively_reported', False)
             capability['properties']['retrievable'] = kwargs.get('retrievable', False)
+            if kwargs.get('non_controllable', False):
+                capability['properties']['nonControllable'] = True
         return capability
 
     def get(self, remove_empty=True):
@@ -440,7 +1291,13 @@ class AlexaResponse:
             if len(response['context']) < 1:
                 response.pop('context')
 
-        return response
+        return ResponseDict(response)
+
+    def serialize(self):
+        '''
+        Returns the response as JSON text (see ResponseDict.to_json()).
+        '''
+        return self.get().to_json()
 
     def set_payload(self, payload):
         self.event['payload'] = payload
@@ -455,41 +1312,28 @@ class AlexaResponse:
         self.event['payload']['endpoints'] = payload_endpoints
 
 
-class LennoxWiFi:
+class LennoxZone:
+    '''
+    A thermostat zone and its last known state: what the blocking and asyncio
+    clients share, apart from the calls that go upstream.
+    '''
     def __init__(self, endpointId, auth):
         '''
-        Creates an instance of LennoxWiFi representing a thermostat and zone.
+        Creates an instance representing a thermostat and zone.
         endpointID is the form '<serialNumber>:<zoneId>'
         auth is a tuple of (userid,password)
         '''
-        (self.gatewaysn, self.zone_num) = endpointId.split(':')
+        (self.gatewaysn, self.zone_num) = parseEndpointId(endpointId)
+        self.endpointId = endpointId
         self.auth = auth
-        
-    def getTStatInfo(self):
-        '''
-        Returns a tStatInfo object about the thermostat/zone.
-        '''
-        r = requests.get(MYICOMFORT_URL + "GetTStatInfoList?gatewaysn=" + self.gatewaysn + "&tempunit=&Cancel_Away=-1&Zone_number=" + self.zone_num, auth=self.auth)
-        # TODO error handling!
-        logger.debug(r.text)
-        response = json.loads(r.text)
-        self.tStatInfo = response['tStatInfo'][0]
-        return self.tStatInfo
+        self.tStatInfo = None
 
-    def setTStatInfo(self, operating_mode=None, lowerSetpoint=None, upperSetpoint=None, fan_mode=None, temp_units=None):
+    def buildTStatData(self, operating_mode=None, lowerSetpoint=None, upperSetpoint=None, fan_mode=None, temp_units=None):
         '''
-        Sets thermostat settings based on passed-in values.
+        Returns the SetTStatInfo body: the current state with passed-in values applied.
         '''
-
-        logger.debug('Operating Mode: %s, Lower Setpoint: %s, Upper Setpoint: %s, Fan Mode: %s, Temp Units: %s' % (str(operating_mode), str(lowerSetpoint), str(upperSetpoint), str(fan_mode), str(temp_units)))
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        # If we don't have current state, get it.
-        if not self.tStatInfo:
-            self.getTStatInfo()
-        logger.debug('--- self.tStatInfo:')
-        logger.debug(self.tStatInfo)
+        logger.debug('Operating Mode: %s, Lower Setpoint: %s, Upper Setpoint: %s, Fan Mode: %s, Temp Units: %s', operating_mode, lowerSetpoint, upperSetpoint, fan_mode, temp_units)
+        logger.debug('--- self.tStatInfo: %s', self.tStatInfo)
         
         # Build new data object
         data = {
@@ -501,8 +1345,411 @@ class LennoxWiFi:
             'Operation_Mode' : operating_mode if operating_mode is not None else self.tStatInfo['Operation_Mode'],
             'Pref_Temp_Units' : temp_units if temp_units is not None else self.tStatInfo['Pref_Temp_Units']
         }
+        logger.debug('SetTStatInfo data: %s', data)
+        return data
+
+    def recordWrite(self, data, ok):
+        '''
+        Updates local and cached state after a SetTStatInfo PUT and returns the
+        resulting tStatInfo object.
+        '''
+        # Write through to the cache so later reads see what we just set.
+        # If the PUT failed we no longer know the thermostat's state, so drop the entry.
+        # Either way, gateway reads already in flight may predate the write, so
+        # they must not cache what they return.
+        tenant = current_tenant()
+        tenant.cache.bump(self.gatewaysn)
+        if ok:
+            self.tStatInfo = dict(self.tStatInfo, **data)
+            tenant.cache.put(self.endpointId, self.tStatInfo)
+            record_telemetry(self.tStatInfo)
+            if tenant.change_poller is not None:
+                tenant.change_poller.notify_write(self.endpointId, self.tStatInfo)
+        else:
+            tenant.cache.invalidate(self.endpointId)
+        return self.tStatInfo
+
+
+class LennoxWiFi(LennoxZone):
+    '''
+    Blocking client for a thermostat zone.
+    '''
+    def getTStatInfo(self):
+        '''
+        Returns a tStatInfo object about the thermostat/zone.
+        Served from the state cache if a fresh entry exists, otherwise
+        fetched with the rest of the gateway's zones.
+        '''
+        cached = current_tenant().cache.get(self.endpointId)
+        if cached is not None:
+            self.tStatInfo = cached
+            return self.tStatInfo
+        # Fetch the whole gateway so sibling zones are cached too.
+        for zone in getGatewayTStatInfo(self.gatewaysn, self.auth):
+            if str(zone['Zone_Number']) == self.zone_num:
+                self.tStatInfo = zone
+                return self.tStatInfo
+        raise ZoneNotFoundError('Zone %s not found on gateway %s' % (self.zone_num, self.gatewaysn))
+
+    def setTStatInfo(self, operating_mode=None, lowerSetpoint=None, upperSetpoint=None, fan_mode=None, temp_units=None):
+        '''
+        Sets thermostat settings based on passed-in values.
+        Returns the resulting tStatInfo object, or raises UpstreamError if the
+        write was not accepted.
+        '''
+
+        # If we don't have current state, get it.
+        if not self.tStatInfo:
+            self.getTStatInfo()
+        data = self.buildTStatData(operating_mode, lowerSetpoint, upperSetpoint, fan_mode, temp_units)
                 
-        # TODO error handling
-        logger.debug(data)
-        r = requests.put(MYICOMFORT_URL + "SetTStatInfo", json=data, auth=self.auth, headers=headers)
-        logger.debug(r.text)
+        try:
+            r = myicomfort_put("SetTStatInfo", data, self.auth, headers=JSON_HEADERS, key=self.gatewaysn)
+        except UpstreamError:
+            self.recordWrite(data, False)
+            raise
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('SetTStatInfo %s: %s', self.endpointId, r.text)
+        self.recordWrite(data, r.ok)
+        if not r.ok:
+            raise UpstreamError('myicomfort returned %d for SetTStatInfo' % r.status_code)
+        return self.tStatInfo
+
+    def resumeSchedule(self):
+        '''
+        Puts the zone back on its selected program with SetProgramInfoNewString.
+        Returns the resulting tStatInfo object, with the setpoints of the period
+        now in effect, or raises UpstreamError if the write was not accepted.
+        '''
+        if not self.tStatInfo:
+            self.getTStatInfo()
+        path = 'SetProgramInfoNewString?GatewaySN=%s&ZoneNumber=%s&Program_Schedule_Selection=%s&Program_Schedule_Mode=%s&Operation_Mode=%s' % (
+            self.gatewaysn, self.zone_num, self.tStatInfo['Program_Schedule_Selection'], SCHEDULE_MODE_PROGRAM, self.tStatInfo['Operation_Mode'])
+        data = {'Program_Schedule_Mode': SCHEDULE_MODE_PROGRAM}
+        try:
+            r = myicomfort_put(path, None, self.auth, key=self.gatewaysn)
+        except UpstreamError:
+            self.recordWrite(data, False)
+            raise
+        if not r.ok:
+            self.recordWrite(data, False)
+            raise UpstreamError('myicomfort returned %d for SetProgramInfoNewString' % r.status_code)
+        # The thermostat applies the period's setpoints itself; look them up
+        # in the program rather than reading the thermostat back.
+        try:
+            period = getSchedulePeriod(dict(self.tStatInfo, **data))[0]
+        except Exception:
+            logger.exception('Failed to get the program for %s', self.endpointId)
+            period = None
+        if period is not None:
+            data.update(Heat_Set_Point=period['Heat_Set_Point'], Cool_Set_Point=period['Cool_Set_Point'])
+        return self.recordWrite(data, True)
+
+
+class AsyncLennoxWiFi(LennoxZone):
+    '''
+    Asyncio client for a thermostat zone, the counterpart of LennoxWiFi.
+    getTStatInfo() and setTStatInfo() are coroutines that go through the shared
+    async connection pool; the state cache is shared with the blocking client.
+    '''
+    async def getTStatInfo(self):
+        '''
+        Returns a tStatInfo object about the thermostat/zone.
+        '''
+        cached = current_tenant().cache.get(self.endpointId)
+        if cached is not None:
+            self.tStatInfo = cached
+            return self.tStatInfo
+        for zone in await getGatewayTStatInfoAsync(self.gatewaysn, self.auth):
+            if str(zone['Zone_Number']) == self.zone_num:
+                self.tStatInfo = zone
+                return self.tStatInfo
+        raise ZoneNotFoundError('Zone %s not found on gateway %s' % (self.zone_num, self.gatewaysn))
+
+    async def setTStatInfo(self, operating_mode=None, lowerSetpoint=None, upperSetpoint=None, fan_mode=None, temp_units=None):
+        '''
+        Sets thermostat settings based on passed-in values.
+        Returns the resulting tStatInfo object, or raises UpstreamError if the
+        write was not accepted.
+        '''
+        if not self.tStatInfo:
+            await self.getTStatInfo()
+        data = self.buildTStatData(operating_mode, lowerSetpoint, upperSetpoint, fan_mode, temp_units)
+        try:
+            (ok, text) = await async_myicomfort_put("SetTStatInfo", data, self.auth, headers=JSON_HEADERS, key=self.gatewaysn)
+        except UpstreamError:
+            self.recordWrite(data, False)
+            raise
+        logger.debug('SetTStatInfo %s: %s', self.endpointId, text)
+        self.recordWrite(data, ok)
+        if not ok:
+            raise UpstreamError('myicomfort rejected SetTStatInfo')
+        return self.tStatInfo
+
+
+class ChangeReportPoller:
+    '''
+    Polls every gateway of an account with one GetTStatInfoList call each, compares
+    the reported fields with the last poll, and passes an Alexa.ChangeReport to
+    'sink' for each endpoint that changed. The sink is any callable taking the
+    event; see EventGatewaySink.
+    '''
+    REPORTED_FIELDS = ('Indoor_Temp', 'Operation_Mode', 'Heat_Set_Point', 'Cool_Set_Point', 'Pref_Temp_Units')
+
+    def __init__(self, sink, tenant=None, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL, backoff=POLL_BACKOFF, gateways_ttl=POLL_GATEWAYS_TTL):
+        self.sink = sink
+        self.tenant = tenant or tenancy.default_tenant
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.gateways_ttl = gateways_ttl
+        self.interval = min_interval
+        self.gateways = None
+        self.gateways_expire = None
+        self.polls = 0
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll_once(self):
+        '''
+        Fetches every gateway once, sends ChangeReports for endpoints whose state
+        changed and adjusts the interval. Returns the number of reports sent.
+        '''
+        token = _tenant.set(self.tenant)
+        try:
+            return self._poll()
+        finally:
+            _tenant.reset(token)
+
+    def _poll(self):
+        zones = self.fetch_zones()
+        sent = 0
+        for zone in zones:
+            if zone['Zone_Enabled'] != 1:
+                continue
+            endpointId = zone['GatewaySN'] + ":" + str(zone['Zone_Number'])
+            fields = tuple(zone.get(field) for field in self.REPORTED_FIELDS)
+            with self._lock:
+                previous = self._snapshots.get(endpointId)
+                self._snapshots[endpointId] = (fields, zone)
+            if previous is None or previous[0] == fields:
+                continue
+            report = getChangeReport(endpointId, previous[1], zone)
+            if report is None:
+                continue
+            try:
+                self.sink(report.get())
+            except Exception:
+                logger.exception('Failed to send ChangeReport for %s', endpointId)
+                continue
+            count('ChangeReports')
+            sent += 1
+        self.polls += 1
+        with self._lock:
+            self.interval = self.min_interval if sent else min(self.max_interval, self.interval * self.backoff)
+        logger.debug('Change report poll %d: %d sent, next in %ss', self.polls, sent, self.interval)
+        return sent
+
+    def fetch_zones(self):
+        auth = self.tenant.auth
+        if self.gateways is None or time.monotonic() >= self.gateways_expire:
+            self.refresh_gateways()
+        zones = []
+        if self.gateways:
+            with ThreadPoolExecutor(max_workers=max(1, min(DISCOVERY_MAX_WORKERS, len(self.gateways)))) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, getGatewayTStatInfo, gatewaysn, auth) for gatewaysn in self.gateways]
+                for gatewaysn, future in zip(self.gateways, futures):
+                    try:
+                        zones.extend(future.result())
+                    except Exception:
+                        logger.exception('Change report poll failed for gateway %s', gatewaysn)
+        return zones
+
+    def refresh_gateways(self):
+        '''
+        Re-reads the account's gateways, so gateways added or removed since the
+        last read are picked up. Removed gateways' zones are forgotten. If the
+        list cannot be read, the last one is kept and tried again next poll.
+        '''
+        try:
+            gateways = [system['Gateway_SN'] for system in getSystemsInfo(self.tenant.auth)]
+        except Exception:
+            if self.gateways is None:
+                raise
+            logger.exception('Failed to refresh the gateways to poll')
+            return
+        with self._lock:
+            for endpointId in list(self._snapshots):
+                if endpointId.split(':')[0] not in gateways:
+                    del self._snapshots[endpointId]
+        self.gateways = gateways
+        self.gateways_expire = time.monotonic() + self.gateways_ttl
+
+    def notify_write(self, endpointId, tStatInfo):
+        '''
+        Records a state this skill just wrote, so it is not reported back as a
+        change, and polls again soon to catch what the thermostat does next.
+        '''
+        with self._lock:
+            if endpointId in self._snapshots:
+                self._snapshots[endpointId] = (tuple(tStatInfo.get(field) for field in self.REPORTED_FIELDS), tStatInfo)
+            self.interval = self.min_interval
+        self._wake.set()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception:
+                logger.exception('Change report poll failed')
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name='lennox-change-reports', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+class EventGatewaySink:
+    '''
+    Sends an account's events to the Alexa event gateway (or a stand-in at
+    another URL), with its event token (see get_event_token()) as both the
+    bearer token and the endpoint scope token. A fixed 'token' can be given
+    instead. Events for an account with no token are only logged.
+    '''
+    def __init__(self, url, token=None, tenant=None):
+        self.url = url
+        self.token = token
+        self.tenant = tenant
+
+    def __call__(self, event):
+        token = self.token or get_event_token(self.tenant or current_tenant())
+        if token is None:
+            log_change_report(event)
+            return
+        endpoint = event['event'].get('endpoint')
+        if endpoint is not None:
+            endpoint['scope']['token'] = token
+        headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + token}
+        r = get_session().post(self.url, data=json.dumps(event), headers=headers, timeout=request_timeout())
+        if r.status_code >= 400:
+            raise UpstreamError('Event gateway returned %d' % r.status_code)
+
+
+class FrozenDict(dict):
+    '''
+    A dict that cannot be changed after it is built. Still a dict, so it
+    serializes to JSON like any other. Copies are plain, writable dicts.
+    '''
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('FrozenDict is read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {key: copy.deepcopy(value, memo) for key, value in self.items()}
+
+
+def freeze(value):
+    '''
+    Returns a read-only deep copy of a structure of dicts and lists.
+    '''
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+# JSON text of frozen structures that appear in many responses, by id(). Each entry
+# holds the structure itself, so the id cannot be reused while it is registered,
+# and a frozen structure cannot change after its text is built.
+_preserialized = {}
+
+def preserialize(value):
+    '''
+    Registers a frozen structure (see freeze()) so that responses containing it
+    reuse its JSON text instead of encoding it again. Returns the structure.
+    '''
+    if not isinstance(value, (FrozenDict, tuple)):
+        raise TypeError('Only frozen structures can be preserialized')
+    _preserialized[id(value)] = (value, json.dumps(value))
+    return value
+
+def _json_with(value, key, text):
+    '''
+    Returns the JSON text of dict 'value' with 'key' set to the already encoded
+    'text'. The rest of the dict goes through json.dumps and the key is added at
+    the end of the object, so no text inside it is searched or replaced.
+    '''
+    rest = json.dumps({k: v for k, v in value.items() if k != key})
+    return (rest[:-1] + ', ' if rest != '{}' else '{') + json.dumps(key) + ': ' + text + '}'
+
+def _endpoint_json(endpoint):
+    '''
+    Returns a discovery endpoint as JSON text, reusing the text of its
+    capabilities if they were preserialized.
+    '''
+    capabilities = endpoint.get('capabilities')
+    fragment = _preserialized.get(id(capabilities))
+    if fragment is None or fragment[0] is not capabilities:
+        return json.dumps(endpoint)
+    return _json_with(endpoint, 'capabilities', fragment[1])
+
+
+# Discovery capabilities are the same for every endpoint, so they are built and
+# serialized once.
+DISPLAY_CATEGORIES = freeze(['THERMOSTAT','TEMPERATURE_SENSOR'])
+DISCOVERY_CAPABILITIES = preserialize(freeze([
+    AlexaResponse.create_payload_endpoint_capability(),
+    AlexaResponse.create_payload_endpoint_capability(
+        interface='Alexa.EndpointHealth',
+        supported=[{'name': 'connectivity'}],
+        version='3.2',
+        retrievable=True),
+    AlexaResponse.create_payload_endpoint_capability(
+        interface='Alexa.TemperatureSensor',
+        supported=[{'name': 'temperature'}],
+        proactively_reported=CHANGE_REPORTS,
+        retrievable=True),
+    AlexaResponse.create_payload_endpoint_capability(
+        interface='Alexa.ThermostatController',
+        supported=[
+            {'name': 'targetSetpoint'},
+            {'name': 'lowerSetpoint'},
+            {'name': 'upperSetpoint'},
+            {'name': 'thermostatMode'}
+            ],
+        version='3.2',
+        proactively_reported=CHANGE_REPORTS,
+        retrievable=True,
+        configuration = {'supportedModes' : ["OFF","HEAT","COOL","AUTO","ECO"], 'supportsScheduling': True}),
+    # The program period in effect, reported but not settable
+    AlexaResponse.create_payload_endpoint_capability(
+        interface='Alexa.ModeController',
+        instance='Thermostat.SchedulePeriod',
+        supported=[{'name': 'mode'}],
+        retrievable=True,
+        non_controllable=True,
+        capability_resources={'friendlyNames': [{'@type': 'text', 'value': {'text': 'Schedule Period', 'locale': 'en-US'}}]},
+        configuration={'ordered': False, 'supportedModes': [
+            {'value': 'SchedulePeriod.' + period, 'modeResources': {'friendlyNames': [{'@type': 'text', 'value': {'text': period, 'locale': 'en-US'}}]}}
+            for period in SCHEDULE_PERIODS + ['Hold']]}),
+]))
+
+startup_timings['module_load_ms'] = round((time.perf_counter() - _MODULE_START) * 1000, 1)
@@ -0,0 +1,26 @@
+'''
+The modules lambda_function is built from, and the constants and exceptions
+they share.
+'''
+
+# Constants and arrays to convert from Lennox numbers to Alexa words
+TEMPS = ['FAHRENHEIT', 'CELCIUS']
+FAN_MODES = ['AUTO','ON','CIRCULATE']
+HVAC_MODES = ['OFF', 'HEAT','COOL', 'AUTO']
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+class UpstreamError(Exception):
+    '''
+    Raised when myicomfort cannot be reached before the deadline, keeps failing,
+    or its circuit breaker is open.
+    '''
+    pass
+
+
+class ZoneNotFoundError(LookupError):
+    '''
+    Raised when a gateway has no zone with the number in an endpoint ID.
+    '''
+    pass
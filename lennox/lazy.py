@@ -0,0 +1,35 @@
+'''
+Lazily imported modules and the startup timing report.
+'''
+import importlib
+import time
+
+
+class LazyModule:
+    '''
+    Stands in for a module that is only imported when one of its attributes is
+    first used, so directives that never need it do not pay for it on a cold
+    start. Import times are recorded for the startup report.
+    '''
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            start = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            startup_timings['lazy_imports_ms'][self._name] = round((time.perf_counter() - start) * 1000, 1)
+        return getattr(self._module, attr)
+
+
+# Startup timing report, logged once after the first invocation
+startup_timings = {'module_load_ms': None, 'lazy_imports_ms': {}}
+
+asyncio = LazyModule('asyncio')
+fcntl = LazyModule('fcntl')
+random = LazyModule('random')
+numpy = LazyModule('numpy')
+requests = LazyModule('requests')
+uuid = LazyModule('uuid')
+zoneinfo = LazyModule('zoneinfo')
@@ -0,0 +1,399 @@
+'''
+Logging, tracing and metrics for the skill.
+'''
+import bisect
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from lennox.lazy import random, uuid
+
+# Logging. LOG_LEVEL sets the level. Full request/response dumps are logged at INFO
+# for a LOG_PAYLOAD_SAMPLE_RATE fraction of invocations, and only serialized when they
+# will actually be written. LOG_FORMAT=json writes one JSON object per line; every
+# line carries the invocation's correlation ID. Directives handled as part of a batch
+# get IDs derived from the batch's ('<batch ID>/<messageId>').
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOG_PAYLOAD_SAMPLE_RATE', '1.0'))
+_correlation_id = contextvars.ContextVar('correlation_id', default='-')
+_log_payloads = contextvars.ContextVar('log_payloads', default=True)
+_batch_id = contextvars.ContextVar('batch_id', default=None)
+
+# Tracing and metrics. METRICS=emf writes one CloudWatch Embedded Metric Format line
+# per directive with its spans, upstream call counters and latencies; METRICS=memory
+# only collects them for metrics.snapshot(). Off by default, in which case the
+# instrumentation hooks do nothing.
+METRICS = os.environ.get('METRICS', 'off').lower()
+METRICS_ENABLED = METRICS in ('emf', 'memory')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'LennoxMyiComfort')
+_trace = contextvars.ContextVar('trace', default=None)
+
+
+class CorrelationFilter(logging.Filter):
+    '''
+    Adds the current invocation's correlation ID to every log record.
+    '''
+    def filter(self, record):
+        record.correlation_id = _correlation_id.get()
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    '''
+    Formats records as one JSON object per line (or plain text with LOG_FORMAT=text).
+    A 'payload' passed in 'extra' is serialized here, so it costs nothing unless
+    the record is emitted. Responses reuse the JSON text of their pre-serialized parts.
+    '''
+    def __init__(self, structured=True):
+        super().__init__()
+        self.structured = structured
+
+    def format(self, record):
+        payload = getattr(record, 'payload', None)
+        if payload is not None:
+            payload = payload.to_json() if hasattr(payload, 'to_json') else json.dumps(payload)
+        if not self.structured:
+            line = '%s %s %s' % (record.levelname, record.correlation_id, record.getMessage())
+            if payload is not None:
+                line += ' ' + payload
+            if record.exc_info:
+                line += '\n' + self.formatException(record.exc_info)
+            return line
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'correlationId': record.correlation_id,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        line = json.dumps(entry)
+        if payload is not None:
+            line = line[:-1] + ', "payload": ' + payload + '}'
+        return line
+
+
+# Every module logs through the handler module's logger, so one handler and
+# level cover the whole skill.
+logger = logging.getLogger('lambda_function')
+logger.setLevel(LOG_LEVEL)
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.addFilter(CorrelationFilter())
+_log_handler.setFormatter(StructuredFormatter(LOG_FORMAT == 'json'))
+logger.addHandler(_log_handler)
+logger.propagate = False
+
+
+def start_invocation(request, context):
+    '''
+    Sets the correlation ID used in log lines for this invocation, and decides
+    whether its request and response are dumped to the log.
+    The ID is the directive's messageId, or else the Lambda request ID. Inside a
+    batch it is derived from the batch's ID, and the batch's sampling decision
+    is kept.
+    '''
+    header = request.get('directive', {}).get('header', {})
+    batch_id = _batch_id.get()
+    if batch_id is not None:
+        _correlation_id.set(batch_id + '/' + (header.get('messageId') or str(uuid.uuid4())))
+        return
+    correlation_id = header.get('messageId') or getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+    _correlation_id.set(correlation_id)
+    _log_payloads.set(LOG_PAYLOAD_SAMPLE_RATE >= 1 or random.random() < LOG_PAYLOAD_SAMPLE_RATE)
+
+def log_payload(label, payload):
+    '''
+    Logs a full request or response if this invocation is sampled and INFO is
+    enabled. The payload is only serialized when the line is written.
+    '''
+    if _log_payloads.get() and logger.isEnabledFor(logging.INFO):
+        logger.info(label, extra={'payload': payload})
+
+def span(name, **attrs):
+    '''
+    Returns a context manager that times a block as a span of the current trace.
+    Use as "with span('upstream:GetTStatInfoList', gateway=sn) as s: ...", and
+    s.set(...) to add attributes. A shared no-op when metrics are off.
+    '''
+    if not METRICS_ENABLED:
+        return NULL_SPAN
+    return Span(name, attrs)
+
+def count(name, value=1):
+    '''
+    Adds value to a counter, both process-wide and for the current trace.
+    Does nothing when metrics are off.
+    '''
+    if METRICS_ENABLED:
+        metrics.incr(name, value)
+        trace = _trace.get()
+        if trace is not None:
+            trace.incr(name, value)
+
+def trace_directive(request):
+    '''
+    Returns a context manager that traces one directive: a span for the whole
+    directive plus the spans and counters recorded while it runs. When the
+    trace ends its metrics are written as an EMF line (METRICS=emf).
+    Inside an existing trace, the directive is just another span.
+    '''
+    if not METRICS_ENABLED:
+        return NULL_SPAN
+    if isinstance(request, dict):
+        name = request.get('directive', {}).get('header', {}).get('name', 'Unknown')
+    else:
+        name = 'Batch'
+    if _trace.get() is not None:
+        return Span('directive:' + name, {})
+    return Trace(name)
+
+
+class Histogram:
+    '''
+    Latency histogram in milliseconds with fixed buckets, so memory stays
+    bounded however many samples it sees. Percentiles are bucket upper bounds.
+    '''
+    BOUNDS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    __slots__ = ('buckets', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, pct):
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(self.BOUNDS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'mean': round(self.sum / self.count, 3) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'buckets': dict(zip([str(b) for b in self.BOUNDS] + ['+Inf'], self.buckets)),
+        }
+
+
+class Metrics:
+    '''
+    Process-wide counters and latency histograms, accumulated across
+    invocations until reset(). snapshot() is the in-process view used by tests
+    and the benchmark harness.
+    '''
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.last_trace = None
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        '''
+        Returns the counters, a summary of each histogram, and the most
+        recent completed trace.
+        '''
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {name: h.to_dict() for name, h in self.histograms.items()},
+                'last_trace': self.last_trace,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.last_trace = None
+
+
+class Span:
+    '''
+    Times a block and records it in the current trace and in the histogram
+    of the same name.
+    '''
+    __slots__ = ('name', 'attrs', 'start')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = (time.perf_counter() - self.start) * 1000.0
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        metrics.observe(self.name, duration)
+        trace = _trace.get()
+        if trace is not None:
+            trace.add_span(self.name, self.start, duration, self.attrs)
+        return False
+
+
+class _NullSpan:
+    '''
+    Stands in for Span and Trace when metrics are off.
+    '''
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    '''
+    Spans and counters for one directive. Entering makes it the current trace
+    for this context (and copies of it, such as discovery worker threads).
+    '''
+    __slots__ = ('directive', 'start', 'spans', 'counters', '_lock', '_token')
+
+    def __init__(self, directive):
+        self.directive = directive
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_span(self, name, start, duration, attrs):
+        span = {'name': name, 'startMs': round((start - self.start) * 1000.0, 3), 'durationMs': round(duration, 3)}
+        span.update(attrs)
+        with self._lock:
+            self.spans.append(span)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self._token = _trace.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = (time.perf_counter() - self.start) * 1000.0
+        _trace.reset(self._token)
+        if exc_type is not None:
+            self.incr('Exceptions')
+        upstream_wait = self.upstream_wait()
+        metrics.observe('directive:' + self.directive, duration)
+        metrics.observe('own:' + self.directive, max(0.0, duration - upstream_wait))
+        record = self.to_dict(duration, upstream_wait)
+        metrics.last_trace = record
+        if METRICS == 'emf':
+            sys.stdout.write(json.dumps(self.to_emf(record)) + '\n')
+        return False
+
+    def upstream_wait(self):
+        '''
+        Returns the milliseconds during which at least one upstream call was in
+        flight. Overlapping calls (e.g. during discovery) are only counted once.
+        '''
+        total = 0.0
+        end = None
+        for (start, stop) in sorted((s['startMs'], s['startMs'] + s['durationMs']) for s in self.spans if s['name'].startswith('upstream:')):
+            if end is None or start > end:
+                total += stop - start
+                end = stop
+            elif stop > end:
+                total += stop - end
+                end = stop
+        return total
+
+    def to_dict(self, duration, upstream_wait):
+        return {
+            'directive': self.directive,
+            'correlationId': _correlation_id.get(),
+            'durationMs': round(duration, 3),
+            'upstreamWaitMs': round(upstream_wait, 3),
+            'ownMs': round(max(0.0, duration - upstream_wait), 3),
+            'counters': dict(self.counters),
+            'spans': list(self.spans),
+        }
+
+    def to_emf(self, record):
+        '''
+        Returns the trace as a CloudWatch Embedded Metric Format document, with
+        the directive name as the dimension.
+        '''
+        values = {
+            'DirectiveLatency': record['durationMs'],
+            'UpstreamWaitTime': record['upstreamWaitMs'],
+            'OwnTime': record['ownMs'],
+        }
+        units = dict.fromkeys(values, 'Milliseconds')
+        for span in record['spans']:
+            if span['name'].startswith('upstream:'):
+                name = span['name'][len('upstream:'):] + 'Latency'
+                values.setdefault(name, []).append(span['durationMs'])
+                units[name] = 'Milliseconds'
+        for name, value in record['counters'].items():
+            values[name] = value
+            units[name] = 'Bytes' if name.startswith('UpstreamBytes') else 'Count'
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Directive']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()],
+                }],
+            },
+            'Directive': record['directive'],
+            'correlationId': record['correlationId'],
+            'spans': record['spans'],
+        }
+        document.update(values)
+        return document
+
+
+metrics = Metrics()
@@ -0,0 +1,216 @@
+'''
+Thermostat programs (schedules): fetching and caching a gateway's programs,
+compiling them for lookups, and finding the period in effect.
+'''
+import bisect
+import json
+import os
+from datetime import datetime
+
+from lennox import JSON_HEADERS, UpstreamError
+from lennox.lazy import asyncio, zoneinfo
+from lennox.observability import logger
+from lennox.tenancy import current_tenant, get_credential_store
+from lennox.upstream import async_myicomfort_get, myicomfort_get, myicomfort_put
+
+# Thermostat programs (schedules). The programs of zones following one are fetched
+# with GetProgramInfo along with their gateway's state, and kept in the account's
+# program cache (see SCHEDULE_CACHE_TTL). Program times are local to the
+# thermostats: SCHEDULE_TIMEZONES is a JSON object of IANA time zones by gateway
+# serial number, and SCHEDULE_TIMEZONE applies to gateways not in it. A credential
+# store can also give a gateway's time zone (see CredentialStore.schedule_timezone).
+SCHEDULE_TIMEZONE = os.environ.get('SCHEDULE_TIMEZONE', 'UTC')
+SCHEDULE_TIMEZONES = json.loads(os.environ.get('SCHEDULE_TIMEZONES') or '{}')
+
+# Program_Schedule_Mode of a zone that is following its program, and the names of
+# a program's periods by Period_Number
+SCHEDULE_MODE_PROGRAM = '1'
+SCHEDULE_PERIODS = ['Wake', 'Leave', 'Return', 'Sleep']
+
+
+def getProgramIndex(gatewaysn, schedulenum, tenant=None, fetch=True):
+    '''
+    Returns the ProgramIndex for one of a gateway's programs, from the program
+    cache of 'tenant' (default the current one) or fetched with GetProgramInfo.
+    Concurrent fetches of the same program share one upstream request. With
+    fetch False, raises LookupError if the program is not cached.
+    '''
+    key = programKey(gatewaysn, schedulenum)
+    tenant = tenant or current_tenant()
+    index = tenant.programs.get(key)
+    if index is None:
+        if not fetch:
+            raise LookupError('Program %s is not cached' % key)
+        index = tenant.program_fetches.do(key, _fetchProgramIndex, gatewaysn, schedulenum, tenant)
+    return index
+
+def _fetchProgramIndex(gatewaysn, schedulenum, tenant):
+    key = programKey(gatewaysn, schedulenum)
+    # Taken before the request, so a program written meanwhile is not overwritten
+    # in the cache by the copy read before the write.
+    generation = tenant.programs.generation(key)
+    r = myicomfort_get(programInfoPath(gatewaysn, schedulenum), tenant.auth, key=gatewaysn)
+    if not r.ok:
+        raise UpstreamError('myicomfort returned %d for GetProgramInfo' % r.status_code)
+    return cacheProgramInfo(tenant, key, r.text, generation)
+
+def programKey(gatewaysn, schedulenum):
+    '''
+    Returns the program cache key for one of a gateway's programs.
+    '''
+    return gatewaysn + ":" + str(schedulenum)
+
+def programInfoPath(gatewaysn, schedulenum):
+    '''
+    Returns the GetProgramInfo call for one of a gateway's programs.
+    '''
+    return "GetProgramInfo?gatewaysn=" + gatewaysn + "&schedulenum=" + str(schedulenum) + "&tempunit="
+
+def cacheProgramInfo(tenant, key, text, generation):
+    '''
+    Compiles a GetProgramInfo response into a ProgramIndex and caches it,
+    unless the program was written since 'generation'. Returns the index.
+    '''
+    logger.debug('GetProgramInfo %s: %s', key, text)
+    index = ProgramIndex(json.loads(text)['ProgramInfo'])
+    tenant.programs.put(key, index, generation)
+    return index
+
+def programsToLoad(tStatInfo, tenant):
+    '''
+    Returns the (gateway, program) pairs followed by zones of a gateway's
+    tStatInfo list that are not in the program cache.
+    '''
+    programs = dict.fromkeys(
+        (zone['GatewaySN'], zone['Program_Schedule_Selection']) for zone in tStatInfo
+        if str(zone.get('Program_Schedule_Mode')) == SCHEDULE_MODE_PROGRAM)
+    return [program for program in programs if tenant.programs.get(programKey(*program)) is None]
+
+def loadPrograms(tStatInfo, tenant=None):
+    '''
+    Fetches the programs followed by zones of a gateway's tStatInfo list into
+    the program cache, so that responses for those zones can report the
+    period without another round trip. A program that cannot be read is
+    logged and left out.
+    '''
+    tenant = tenant or current_tenant()
+    for (gatewaysn, schedulenum) in programsToLoad(tStatInfo, tenant):
+        try:
+            getProgramIndex(gatewaysn, schedulenum, tenant)
+        except Exception:
+            logger.exception('Failed to get program %s', programKey(gatewaysn, schedulenum))
+
+async def loadProgramsAsync(tStatInfo):
+    '''
+    Asyncio version of loadPrograms(). The programs are fetched concurrently.
+    '''
+    tenant = current_tenant()
+
+    async def load(gatewaysn, schedulenum):
+        key = programKey(gatewaysn, schedulenum)
+        generation = tenant.programs.generation(key)
+        try:
+            text = await async_myicomfort_get(programInfoPath(gatewaysn, schedulenum), tenant.auth, key=gatewaysn)
+            cacheProgramInfo(tenant, key, text, generation)
+        except Exception:
+            logger.exception('Failed to get program %s', key)
+
+    await asyncio.gather(*[load(*program) for program in programsToLoad(tStatInfo, tenant)])
+
+def setProgramInfo(gatewaysn, schedulenum, program, tenant=None):
+    '''
+    Replaces one of a gateway's programs with a list of periods, in the form
+    GetProgramInfo returns them, and drops the cached copy.
+    '''
+    tenant = tenant or current_tenant()
+    data = {'GatewaySN': gatewaysn, 'Schedule_Number': schedulenum, 'ProgramInfo': program}
+    try:
+        r = myicomfort_put("SetProgramInfo", data, tenant.auth, headers=JSON_HEADERS, key=gatewaysn)
+    finally:
+        tenant.programs.invalidate(programKey(gatewaysn, schedulenum))
+    if not r.ok:
+        raise UpstreamError('myicomfort returned %d for SetProgramInfo' % r.status_code)
+
+def getSchedulePeriod(tStatInfo, when=None, fetch=True, tenant=None):
+    '''
+    Returns (period in effect, next period, minutes until it starts) from the
+    zone's program at 'when' (default now in the gateway's time zone), or None
+    if the zone is not following its program. Only the first lookup of a
+    program goes upstream; with fetch False, raises LookupError if the
+    program is not cached.
+    '''
+    if str(tStatInfo.get('Program_Schedule_Mode')) != SCHEDULE_MODE_PROGRAM:
+        return None
+    index = getProgramIndex(tStatInfo['GatewaySN'], tStatInfo['Program_Schedule_Selection'], tenant, fetch)
+    if when is None:
+        when = datetime.now(getScheduleTimezone(tStatInfo['GatewaySN']))
+    return index.lookup(when.isoweekday() % 7, when.hour * 60 + when.minute)
+
+def getScheduleTimezone(gatewaysn):
+    '''
+    Returns the time zone a gateway's programs run in, from the credential
+    store, SCHEDULE_TIMEZONES or SCHEDULE_TIMEZONE.
+    '''
+    name = get_credential_store().schedule_timezone(gatewaysn)
+    return zoneinfo.ZoneInfo(name or SCHEDULE_TIMEZONES.get(gatewaysn, SCHEDULE_TIMEZONE))
+
+def getSchedulePeriodProperty(tStatInfo, tenant=None):
+    '''
+    Returns the Alexa.ModeController property for the zone's program period,
+    as add_context_property() arguments: the period in effect, or Hold if the
+    zone is not following its program. Returns None if the program is not
+    cached (it could not be read with the gateway's state), so that the rest
+    of the state can still be reported.
+    '''
+    try:
+        period = getSchedulePeriod(tStatInfo, fetch=False, tenant=tenant)
+    except LookupError:
+        return None
+    except Exception:
+        logger.exception('Failed to get the program for %s:%s', tStatInfo.get('GatewaySN'), tStatInfo.get('Zone_Number'))
+        return None
+    if period is None or period[0] is None:
+        value = 'SchedulePeriod.Hold'
+    else:
+        value = 'SchedulePeriod.' + SCHEDULE_PERIODS[int(period[0]['Period_Number'])]
+    return {'namespace': 'Alexa.ModeController', 'instance': 'Thermostat.SchedulePeriod', 'name': 'mode', 'value': value}
+
+
+class ProgramIndex:
+    '''
+    A thermostat program compiled for lookups. For each day of the week (0 is
+    Sunday) it keeps the start times of that day's periods, in minutes after
+    midnight and in order, so finding the period in effect is a binary search.
+    '''
+    __slots__ = ('starts', 'periods')
+
+    def __init__(self, program):
+        self.starts = [[] for day in range(7)]
+        self.periods = [[] for day in range(7)]
+        for period in sorted(program, key=lambda p: (int(p['Day_Of_Week']), int(p['Start_Time']))):
+            day = int(period['Day_Of_Week'])
+            self.starts[day].append(int(period['Start_Time']))
+            self.periods[day].append(period)
+
+    def lookup(self, day, minute):
+        '''
+        Returns (period in effect, next period, minutes until it starts) at a
+        minute of a day of the week. Until a day's first period starts, the
+        last period of an earlier day is in effect. Returns None for periods
+        an empty program does not have.
+        '''
+        i = bisect.bisect_right(self.starts[day], minute) - 1
+        current = self.periods[day][i] if i >= 0 else None
+        for back in range(1, 8):
+            if current is not None:
+                break
+            periods = self.periods[(day - back) % 7]
+            if periods:
+                current = periods[-1]
+        if i + 1 < len(self.starts[day]):
+            return (current, self.periods[day][i + 1], self.starts[day][i + 1] - minute)
+        for ahead in range(1, 8):
+            starts = self.starts[(day + ahead) % 7]
+            if starts:
+                return (current, self.periods[(day + ahead) % 7][0], ahead * 1440 + starts[0] - minute)
+        return (current, None, None)
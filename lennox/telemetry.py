@@ -0,0 +1,359 @@
+'''
+Zone telemetry: samples of each zone's state in memory-mapped ring buffers,
+written by a background thread and queried with numpy.
+'''
+import contextlib
+import os
+import queue
+import threading
+import time
+
+from lennox import HVAC_MODES
+from lennox.lazy import fcntl, numpy
+from lennox.observability import count, logger
+
+# Zone telemetry. With TELEMETRY_FILE set, each zone's temperature, setpoints and mode
+# are recorded whenever they are read or written, into a ring of TELEMETRY_CAPACITY
+# samples for each of up to TELEMETRY_MAX_ENDPOINTS endpoints in that memory-mapped
+# file. A sample is only added when something changed or TELEMETRY_INTERVAL seconds
+# have passed since the last one. Processes on the same host can share the file.
+# Samples are queued and written by a background thread, so directives never wait on
+# the file lock; up to TELEMETRY_QUEUE_SIZE samples wait to be written, and any more
+# are dropped. Requires numpy.
+TELEMETRY_FILE = os.environ.get('TELEMETRY_FILE')
+TELEMETRY_CAPACITY = int(os.environ.get('TELEMETRY_CAPACITY', '32768'))
+TELEMETRY_MAX_ENDPOINTS = int(os.environ.get('TELEMETRY_MAX_ENDPOINTS', '64'))
+TELEMETRY_INTERVAL = float(os.environ.get('TELEMETRY_INTERVAL', '300'))
+TELEMETRY_QUEUE_SIZE = int(os.environ.get('TELEMETRY_QUEUE_SIZE', '1024'))
+
+
+def get_telemetry_recorder():
+    '''
+    Returns the TelemetryRecorder for TELEMETRY_FILE, opening it on first use.
+    '''
+    global telemetry_recorder
+    if telemetry_recorder is None:
+        with _telemetry_lock:
+            if telemetry_recorder is None:
+                telemetry_recorder = TelemetryRecorder(TELEMETRY_FILE)
+    return telemetry_recorder
+
+def get_telemetry_writer():
+    '''
+    Returns the TelemetryWriter for the telemetry recorder, creating it on first use.
+    '''
+    global telemetry_writer
+    if telemetry_writer is None:
+        with _telemetry_lock:
+            if telemetry_writer is None:
+                telemetry_writer = TelemetryWriter(get_telemetry_recorder)
+    return telemetry_writer
+
+def record_telemetry(tStatInfo):
+    '''
+    Queues a zone's state for the telemetry recorder if TELEMETRY_FILE is set.
+    Recording never fails or holds up a directive.
+    '''
+    if not TELEMETRY_FILE:
+        return
+    try:
+        get_telemetry_writer().submit(tStatInfo)
+    except Exception:
+        logger.exception('Failed to record telemetry for %s:%s', tStatInfo.get('GatewaySN'), tStatInfo.get('Zone_Number'))
+
+def stop(timeout=None):
+    '''
+    Writes the queued samples, stops the writer thread and flushes the file.
+    '''
+    if telemetry_writer is not None:
+        telemetry_writer.stop(timeout)
+    if telemetry_recorder is not None:
+        telemetry_recorder.flush()
+
+
+class TelemetryRecorder:
+    '''
+    Zone samples (time, temperature, setpoints and mode) in fixed-width ring
+    buffers, one per endpoint, in a memory-mapped file. A sample takes 12
+    bytes, with temperatures in tenths of a degree in the thermostat's own
+    units. The file starts with a header and an index of endpoint slots, each
+    holding the endpoint ID and the number of samples ever written to it.
+
+    Any number of processes on a host can record into and query the same file;
+    writers take an exclusive lock on it. An existing file keeps the capacity
+    and endpoint count it was created with.
+    '''
+    MAGIC = b'LNXTELE1'
+    VERSION = 1
+
+    def __init__(self, path, capacity=TELEMETRY_CAPACITY, max_endpoints=TELEMETRY_MAX_ENDPOINTS, min_interval=TELEMETRY_INTERVAL):
+        self.path = path
+        self.min_interval = min_interval
+        self.header_dtype = numpy.dtype([('magic', 'S8'), ('version', '<u4'), ('capacity', '<u4'), ('max_endpoints', '<u4'), ('reserved', 'V44')])
+        self.slot_dtype = numpy.dtype([('endpoint', 'S32'), ('head', '<u8')])
+        self.sample_dtype = numpy.dtype([
+            ('time', '<u4'), ('temperature', '<i2'), ('heat_setpoint', '<i2'), ('cool_setpoint', '<i2'),
+            ('mode', 'u1'), ('scale', 'u1')])
+        self._slots = {}
+        self._unrecorded = set()
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._locked():
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, self.header_dtype.itemsize + max_endpoints * (self.slot_dtype.itemsize + capacity * self.sample_dtype.itemsize))
+                header = numpy.memmap(path, self.header_dtype, 'r+', shape=(1,))
+                header[0] = (self.MAGIC, self.VERSION, capacity, max_endpoints, b'')
+                header.flush()
+            header = numpy.memmap(path, self.header_dtype, 'r', shape=(1,))[0]
+            if header['magic'] != self.MAGIC or header['version'] != self.VERSION:
+                raise ValueError('%s is not a telemetry file' % path)
+            self.capacity = int(header['capacity'])
+            self.max_endpoints = int(header['max_endpoints'])
+        offset = self.header_dtype.itemsize
+        self._index = numpy.memmap(path, self.slot_dtype, 'r+', offset, (self.max_endpoints,))
+        offset += self.slot_dtype.itemsize * self.max_endpoints
+        self._data = numpy.memmap(path, self.sample_dtype, 'r+', offset, (self.max_endpoints, self.capacity))
+
+    @contextlib.contextmanager
+    def _locked(self, shared=False):
+        '''
+        Locks the file against other processes: exclusively for writers, shared
+        for readers. Threads of this process share the file descriptor, and so
+        its flock, and take turns on a thread lock as well.
+        '''
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _slot(self, endpointId, create=False):
+        '''
+        Returns the index slot for an endpoint, or None if it has none. Other
+        processes may have added slots, so the index is re-read on a miss.
+        '''
+        slot = self._slots.get(endpointId)
+        if slot is None:
+            key = endpointId.encode('utf-8')
+            endpoints = self._index['endpoint']
+            found = numpy.flatnonzero(endpoints == key)
+            if len(found):
+                slot = self._slots[endpointId] = int(found[0])
+            elif create:
+                free = numpy.flatnonzero(endpoints == b'')
+                if not len(free) or len(key) > self.slot_dtype['endpoint'].itemsize:
+                    if endpointId not in self._unrecorded:
+                        self._unrecorded.add(endpointId)
+                        logger.warning('No telemetry slot for %s', endpointId)
+                    return None
+                slot = self._slots[endpointId] = int(free[0])
+                self._index[slot] = (key, 0)
+        return slot
+
+    @staticmethod
+    def make_sample(tStatInfo, now=None):
+        '''
+        Returns (endpoint ID, sample) for a zone's tStatInfo, for record_many().
+        '''
+        return (tStatInfo['GatewaySN'] + ":" + str(tStatInfo['Zone_Number']), (
+            int(time.time() if now is None else now),
+            round(float(tStatInfo['Indoor_Temp']) * 10),
+            round(float(tStatInfo['Heat_Set_Point']) * 10),
+            round(float(tStatInfo['Cool_Set_Point']) * 10),
+            int(tStatInfo['Operation_Mode']),
+            int(tStatInfo['Pref_Temp_Units'])))
+
+    def record(self, tStatInfo, now=None):
+        '''
+        Adds a sample for a zone's tStatInfo. Returns False if it was skipped
+        because nothing changed within min_interval seconds of the last sample.
+        '''
+        return self.record_many([self.make_sample(tStatInfo, now)]) == 1
+
+    def record_many(self, samples):
+        '''
+        Adds (endpoint ID, sample) pairs from make_sample() in order, under one
+        lock. Returns the number added.
+        '''
+        added = 0
+        with self._locked():
+            for endpointId, sample in samples:
+                slot = self._slot(endpointId, create=True)
+                if slot is None:
+                    continue
+                head = int(self._index[slot]['head'])
+                if head:
+                    last = self._data[slot, (head - 1) % self.capacity].item()
+                    if last[1:] == sample[1:] and sample[0] - last[0] < self.min_interval:
+                        continue
+                self._data[slot, head % self.capacity] = sample
+                # Count the sample only once it is written, for readers in other processes
+                self._index[slot] = (self._index[slot]['endpoint'], head + 1)
+                added += 1
+        return added
+
+    def samples(self, endpointId, start=None, end=None):
+        '''
+        Returns an endpoint's samples with times from 'start' to 'end' (epoch
+        seconds, either may be None) as a structured array in time order.
+        '''
+        # Under a shared lock, so a writer cannot move the head or wrap the
+        # ring while the samples are copied out.
+        with self._locked(shared=True):
+            slot = self._slot(endpointId)
+            if slot is None:
+                return numpy.empty(0, self.sample_dtype)
+            head = int(self._index[slot]['head'])
+            ring = self._data[slot]
+            if head <= self.capacity:
+                ordered = numpy.array(ring[:head])
+            else:
+                split = head % self.capacity
+                ordered = numpy.concatenate((ring[split:], ring[:split]))
+        times = ordered['time']
+        lo = 0 if start is None else numpy.searchsorted(times, start, 'left')
+        hi = len(times) if end is None else numpy.searchsorted(times, end, 'right')
+        return ordered[lo:hi]
+
+    def summary(self, endpointId, start=None, end=None, field='temperature', interval=None):
+        '''
+        Returns the count, min, max and mean of 'field' (temperature,
+        heat_setpoint or cool_setpoint) in degrees. With 'interval' (seconds),
+        each is an array with one value per interval that has samples, along
+        with each interval's start time.
+        '''
+        samples = self.samples(endpointId, start, end)
+        values = samples[field] / 10.0
+        if interval is None:
+            if not len(values):
+                return {'count': 0, 'min': None, 'max': None, 'mean': None}
+            return {'count': len(values), 'min': float(values.min()), 'max': float(values.max()), 'mean': float(values.mean())}
+        buckets = samples['time'].astype('i8') // interval
+        starts = numpy.flatnonzero(numpy.diff(buckets, prepend=-1))
+        counts = numpy.diff(numpy.append(starts, len(values)))
+        return {
+            'start': buckets[starts] * interval,
+            'count': counts,
+            'min': numpy.minimum.reduceat(values, starts) if len(values) else values,
+            'max': numpy.maximum.reduceat(values, starts) if len(values) else values,
+            'mean': numpy.add.reduceat(values, starts) / counts if len(values) else values,
+        }
+
+    def mode_durations(self, endpointId, start=None, end=None):
+        '''
+        Returns the seconds spent in each mode, by HVAC_MODES name. Each sample's
+        mode is taken to last until the next sample, and the last one until
+        'end' (or now).
+        '''
+        samples = self.samples(endpointId, start, end)
+        times = samples['time'].astype('i8')
+        durations = numpy.diff(times, append=int(time.time() if end is None else end))
+        seconds = numpy.bincount(samples['mode'], weights=numpy.maximum(durations, 0), minlength=len(HVAC_MODES))
+        return {mode: float(seconds[i]) for i, mode in enumerate(HVAC_MODES)}
+
+    def setpoint_drift(self, endpointId, start=None, end=None):
+        '''
+        Returns how far the temperature strayed from the setpoint in effect, in
+        degrees: above the cool setpoint or below the heat setpoint, depending
+        on the mode. Positive is warmer than the setpoint. Samples with the
+        thermostat off are left out.
+        '''
+        samples = self.samples(endpointId, start, end)
+        samples = samples[samples['mode'] != HVAC_MODES.index('OFF')]
+        temperature = samples['temperature'] / 10.0
+        heat = samples['heat_setpoint'] / 10.0
+        cool = samples['cool_setpoint'] / 10.0
+        mode = samples['mode']
+        heating = (mode == HVAC_MODES.index('HEAT')) | ((mode == HVAC_MODES.index('AUTO')) & (temperature < heat))
+        cooling = (mode == HVAC_MODES.index('COOL')) | ((mode == HVAC_MODES.index('AUTO')) & (temperature > cool))
+        drift = numpy.select([heating, cooling], [temperature - heat, temperature - cool], 0.0)
+        if not len(drift):
+            return {'count': 0, 'mean': None, 'mean_abs': None, 'max_abs': None}
+        magnitude = numpy.abs(drift)
+        return {'count': len(drift), 'mean': float(drift.mean()), 'mean_abs': float(magnitude.mean()), 'max_abs': float(magnitude.max())}
+
+    def flush(self):
+        self._index.flush()
+        self._data.flush()
+
+
+class TelemetryWriter:
+    '''
+    Writes zone samples to a TelemetryRecorder on a background thread, so the
+    file lock and memory-mapped writes stay off directive threads and the
+    event loop. Samples waiting when the thread wakes are written under one
+    lock. Once 'maxsize' samples are waiting, new ones are dropped and counted
+    as TelemetryDropped. 'open_recorder' is called on the thread to get the
+    recorder.
+    '''
+    def __init__(self, open_recorder, maxsize=TELEMETRY_QUEUE_SIZE):
+        self.open_recorder = open_recorder
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, tStatInfo, now=None):
+        '''
+        Queues a sample of a zone's tStatInfo. Returns False if it was dropped.
+        '''
+        try:
+            self._queue.put_nowait(TelemetryRecorder.make_sample(tStatInfo, now))
+        except queue.Full:
+            count('TelemetryDropped')
+            return False
+        if self._thread is None:
+            self.start()
+        return True
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            samples = [sample for sample in batch if sample is not None]
+            try:
+                if samples:
+                    self.open_recorder().record_many(samples)
+            except Exception:
+                logger.exception('Failed to record %d telemetry samples', len(samples))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if len(samples) < len(batch):
+                return
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='lennox-telemetry', daemon=True)
+                self._thread.start()
+
+    def drain(self):
+        '''
+        Waits until every queued sample has been written.
+        '''
+        self._queue.join()
+
+    def stop(self, timeout=None):
+        '''
+        Writes the queued samples and stops the thread, waiting up to 'timeout'
+        seconds for it.
+        '''
+        with self._lock:
+            (thread, self._thread) = (self._thread, None)
+        if thread is not None:
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                logger.warning('Timed out stopping the telemetry writer')
+                return
+            thread.join(timeout)
+
+
+telemetry_recorder = None
+telemetry_writer = None
+_telemetry_lock = threading.Lock()
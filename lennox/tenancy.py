@@ -0,0 +1,592 @@
+'''
+Accounts: mapping a directive's bearer token to myicomfort credentials, and
+the state kept for each account between invocations (connection pools,
+caches, circuit breakers and in-flight requests).
+'''
+import abc
+import contextvars
+import importlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timezone
+
+from lennox import UpstreamError
+from lennox.lazy import asyncio, requests
+from lennox.observability import count, logger
+
+USERID = os.environ.get('USERID')
+PASSWORD = os.environ.get('PASSWORD')
+auth = (USERID,PASSWORD)
+
+# Credentials per request. CREDENTIAL_STORE picks how the bearer token on a directive
+# is mapped to myicomfort credentials: 'env' (every token uses USERID/PASSWORD), 'file'
+# (a JSON file at CREDENTIALS_FILE), or 'package.module:Class' for your own
+# CredentialStore. Each account gets its own connection pool, state cache and circuit
+# breakers; at most TENANT_CACHE_SIZE accounts are kept, least recently used first out.
+CREDENTIAL_STORE = os.environ.get('CREDENTIAL_STORE', 'env')
+CREDENTIALS_FILE = os.environ.get('CREDENTIALS_FILE', 'credentials.json')
+TENANT_CACHE_SIZE = int(os.environ.get('TENANT_CACHE_SIZE', '32'))
+_tenant = contextvars.ContextVar('tenant', default=None)
+
+# HTTP connection pool settings. The session is created once per container and
+# shared by every call, so warm invocations reuse keep-alive connections instead of
+# paying for a DNS lookup and TLS handshake on each request.
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '10'))
+
+# Connection pool of the asyncio client (see ASYNC_HANDLER).
+ASYNC_POOL_SIZE = int(os.environ.get('ASYNC_POOL_SIZE', '20'))
+ASYNC_LIMIT_PER_HOST = int(os.environ.get('ASYNC_LIMIT_PER_HOST', '8'))
+
+# After BREAKER_FAILURE_THRESHOLD consecutive failures a gateway's circuit opens and
+# calls to it fail fast for BREAKER_RESET_SECONDS.
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', '30'))
+
+# Maximum number of gateways an account's fleet snapshots (iterFleetState and
+# iterFleetStateAsync) query at once, across all snapshots running for that account.
+FLEET_MAX_CONCURRENCY = int(os.environ.get('FLEET_MAX_CONCURRENCY', '4'))
+
+# AdjustTargetTemperature requests for the same endpoint that arrive within this many
+# milliseconds of each other are added up and sent as one write. 0 disables this.
+# It only applies to long-running hosts such as server.py: a Lambda container handles
+# one invocation at a time, so nothing could arrive to be merged and the wait would
+# only add latency.
+ADJUST_DEBOUNCE_MS = 0 if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else int(os.environ.get('ADJUST_DEBOUNCE_MS', '0'))
+
+# Thermostat state cache. Entries are keyed by endpoint ID ('<gatewaysn>:<zone>') and
+# live for STATE_CACHE_TTL seconds. A TTL of 0 disables the cache. Thermostat
+# programs are kept for SCHEDULE_CACHE_TTL seconds or until they are written.
+STATE_CACHE_TTL = float(os.environ.get('STATE_CACHE_TTL', '30'))
+STATE_CACHE_SIZE = int(os.environ.get('STATE_CACHE_SIZE', '64'))
+SCHEDULE_CACHE_TTL = float(os.environ.get('SCHEDULE_CACHE_TTL', '3600'))
+
+
+def get_directive_token(directive):
+    '''
+    Returns the bearer token a directive was sent with, or None.
+    '''
+    payload = directive.get('payload', {})
+    for holder in (directive.get('endpoint'), payload.get('scope'), payload.get('grantee')):
+        if holder:
+            token = holder.get('token') or holder.get('scope', {}).get('token')
+            if token:
+                return token
+    return None
+
+def use_tenant_for(directive):
+    '''
+    Makes the account that a directive's bearer token maps to the current tenant
+    and marks it in use. Returns the token to pass to leave_tenant() once the
+    directive is handled, or None if the bearer token is not known.
+    '''
+    tenant = get_tenant(get_directive_token(directive))
+    if tenant is None:
+        return None
+    return _tenant.set(tenant)
+
+def leave_tenant(token):
+    '''
+    Undoes use_tenant_for(): restores the previous current tenant and releases
+    this one, closing it if it was evicted while in use.
+    '''
+    tenant = _tenant.get()
+    _tenant.reset(token)
+    tenant.release()
+
+def get_tenant(token):
+    '''
+    Returns the Tenant for a bearer token, acquired for the caller to release(),
+    or None if the credential store does not know it. The account in
+    USERID/PASSWORD always maps to default_tenant.
+    '''
+    credentials = get_credential_store().lookup(token)
+    if credentials is None:
+        return None
+    if tuple(credentials) == default_tenant.auth:
+        default_tenant.acquire()
+        return default_tenant
+    return tenants.get(*credentials)
+
+def current_tenant():
+    '''
+    Returns the tenant for the current invocation, or default_tenant.
+    '''
+    return _tenant.get() or default_tenant
+
+def get_credential_store():
+    '''
+    Returns the credential store named by CREDENTIAL_STORE, creating it on first use.
+    '''
+    global credential_store
+    if credential_store is None:
+        if CREDENTIAL_STORE == 'env':
+            credential_store = EnvCredentialStore()
+        elif CREDENTIAL_STORE == 'file':
+            credential_store = FileCredentialStore(CREDENTIALS_FILE)
+        else:
+            (module, _, name) = CREDENTIAL_STORE.partition(':')
+            credential_store = getattr(importlib.import_module(module), name)()
+    return credential_store
+
+
+class CircuitBreaker:
+    '''
+    Fails calls fast after 'threshold' consecutive failures. Once 'reset_timeout'
+    seconds have passed a trial call is let through; if it succeeds the circuit
+    closes again, otherwise it stays open for another 'reset_timeout'.
+    '''
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: let this call through, and hold off others for another period.
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class TStatCache:
+    '''
+    Bounded LRU cache of tStatInfo objects with a time-to-live.
+    Lives at module level so it survives across warm Lambda invocations.
+    '''
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # How many times each key has been invalidated, to fence out puts of
+        # values read before an invalidation
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Returns the cached value for key, or None if missing or expired.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                count('CacheMisses')
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            count('CacheHits')
+            return entry[1]
+
+    def generation(self, key):
+        '''
+        Returns a token to pass to put() for a value about to be read, so that
+        the put is dropped if the key is invalidated in the meantime.
+        '''
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def put(self, key, value, generation=None, fence=None):
+        '''
+        Caches value under key. 'generation' is what generation() returned for
+        'fence' (by default key itself) before the value was read; the put is
+        dropped if fence has been bumped or invalidated since.
+        '''
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and self._generations.get(fence or key, 0) != generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def bump(self, key):
+        '''
+        Fences out puts of values read under key before now, without dropping
+        what is cached.
+        '''
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        Returns hit/miss counters and current size.
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class SingleFlight:
+    '''
+    Collapses concurrent calls that share a key into one.
+    The first caller runs the function; callers arriving while it is still in
+    flight wait for it and get the same result (or exception).
+    '''
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            return call.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AdjustCoalescer:
+    '''
+    Merges setpoint adjustments for an endpoint that arrive within 'window'
+    seconds of the first one. The first caller waits out the window, applies the
+    summed delta with one read-modify-write, and every caller in the window gets
+    the resulting state.
+    '''
+    def __init__(self, window):
+        self.window = window
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def adjust(self, endpointId, delta, apply, timeout=None):
+        '''
+        Adds delta to the endpoint's pending adjustment and returns the tStatInfo
+        after the merged write, which the first caller makes with apply(total).
+        Callers wait at most 'timeout' seconds (normally the invocation's
+        remaining time).
+        '''
+        with self._lock:
+            batch = self._pending.get(endpointId)
+            leader = batch is None
+            if leader:
+                batch = self._pending[endpointId] = [0, Future()]
+            batch[0] += delta
+        if not leader:
+            try:
+                return batch[1].result(timeout=timeout)
+            except TimeoutError:
+                raise UpstreamError('Deadline exceeded waiting for merged adjustment')
+
+        time.sleep(self.window if timeout is None else max(0, min(self.window, timeout)))
+        with self._lock:
+            del self._pending[endpointId]
+            total = batch[0]
+        try:
+            logger.debug('Applying merged adjustment of %s to %s', total, endpointId)
+            tStatInfo = apply(total)
+        except BaseException as e:
+            batch[1].set_exception(e)
+            raise
+        batch[1].set_result(tStatInfo)
+        return tStatInfo
+
+
+class Tenant:
+    '''
+    One myicomfort account and everything kept for it between invocations: its
+    connection pools, state and program caches, in-flight gateway fetches,
+    pending adjustments, circuit breakers and change report poller.
+    '''
+    def __init__(self, userid, password):
+        self.auth = (userid, password)
+        self.cache = TStatCache(STATE_CACHE_TTL, STATE_CACHE_SIZE)
+        self.gateway_fetches = SingleFlight()
+        self.adjust_writes = AdjustCoalescer(ADJUST_DEBOUNCE_MS / 1000.0)
+        self.async_gateway_fetches = {}
+        self.programs = TStatCache(SCHEDULE_CACHE_TTL, STATE_CACHE_SIZE)
+        self.program_fetches = SingleFlight()
+        self.change_poller = None
+        # Bounds the gateways fetched at once by all of this account's fleet snapshots
+        self.fleet_slots = threading.BoundedSemaphore(FLEET_MAX_CONCURRENCY)
+        self._async_fleet_slots = None
+        self._session = None
+        self._async_session = None
+        self._async_loop = None
+        self._breakers = {}
+        self._lock = threading.Lock()
+        # Directives being handled for this account, and whether TenantCache
+        # has dropped it; it is closed once both say it is no longer needed.
+        self._users = 0
+        self._evicted = False
+
+    def acquire(self):
+        with self._lock:
+            self._users += 1
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            closing = self._evicted and self._users == 0
+        if closing:
+            self.close()
+
+    def evict(self):
+        '''
+        Closes the tenant now if no directive is using it, or else when the last
+        one releases it.
+        '''
+        with self._lock:
+            self._evicted = True
+            closing = self._users == 0
+        if closing:
+            self.close()
+
+    def get_session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def get_async_session(self):
+        if self._async_session is None:
+            import aiohttp
+            self._async_loop = asyncio.get_running_loop()
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE, limit_per_host=ASYNC_LIMIT_PER_HOST),
+                timeout=aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT))
+        return self._async_session
+
+    def get_async_fleet_slots(self):
+        if self._async_fleet_slots is None:
+            self._async_fleet_slots = asyncio.Semaphore(FLEET_MAX_CONCURRENCY)
+        return self._async_fleet_slots
+
+    def get_breaker(self, key):
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+            return breaker
+
+    def close(self, timeout=0):
+        '''
+        Stops the poller and closes the connection pools, waiting up to 'timeout'
+        seconds for the poller and the async pool to finish. With the default of
+        0 it does not block, so it is safe to call from the event loop.
+        '''
+        if self.change_poller is not None:
+            self.change_poller.stop(timeout)
+        (session, self._session) = (self._session, None)
+        if session is not None:
+            session.close()
+        (async_session, self._async_session) = (self._async_session, None)
+        if async_session is not None and self._async_loop.is_running():
+            closing = asyncio.run_coroutine_threadsafe(async_session.close(), self._async_loop)
+            if timeout:
+                try:
+                    closing.result(timeout)
+                except Exception:
+                    logger.warning('Timed out closing async connection pool')
+
+
+class TenantCache:
+    '''
+    Bounded LRU of Tenants keyed by myicomfort user ID. The least recently used
+    account is dropped when a new one would go over 'maxsize', and closed once
+    no directive is using it.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._tenants = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, userid, password):
+        '''
+        Returns the Tenant for an account, acquired for the caller to release().
+        '''
+        evicted = []
+        with self._lock:
+            tenant = self._tenants.get(userid)
+            if tenant is None or tenant.auth[1] != password:
+                if tenant is not None:
+                    evicted.append(tenant)
+                tenant = self._tenants[userid] = Tenant(userid, password)
+            self._tenants.move_to_end(userid)
+            while len(self._tenants) > self.maxsize:
+                evicted.append(self._tenants.popitem(last=False)[1])
+            tenant.acquire()
+        for old in evicted:
+            old.evict()
+        return tenant
+
+    def __len__(self):
+        return len(self._tenants)
+
+    def clear(self):
+        '''
+        Drops every tenant and returns them, for the caller to close.
+        '''
+        with self._lock:
+            dropped = list(self._tenants.values())
+            self._tenants.clear()
+        return dropped
+
+
+class CredentialStore(abc.ABC):
+    '''
+    Maps the bearer token on a directive to myicomfort credentials. To plug in
+    your own, subclass this and name it in CREDENTIAL_STORE ('package.module:Class').
+    '''
+    @abc.abstractmethod
+    def lookup(self, token):
+        '''
+        Returns a (userid, password) tuple for token, or None if it is not known.
+        '''
+
+    @abc.abstractmethod
+    def save_grant(self, code, token):
+        '''
+        Stores the authorization code from an AcceptGrant directive for the
+        account that 'token' belongs to.
+        '''
+
+    def schedule_timezone(self, gatewaysn):
+        '''
+        Returns the IANA time zone a gateway's programs run in, or None to use
+        SCHEDULE_TIMEZONES and SCHEDULE_TIMEZONE.
+        '''
+        return None
+
+    def event_tokens(self, userid):
+        '''
+        Returns the event gateway tokens saved for an account (see
+        request_lwa_tokens()), or None. Kept in memory unless overridden.
+        '''
+        return getattr(self, '_event_tokens', {}).get(userid)
+
+    def save_event_tokens(self, userid, tokens):
+        '''
+        Stores the event gateway tokens for an account.
+        '''
+        if not hasattr(self, '_event_tokens'):
+            self._event_tokens = {}
+        self._event_tokens[userid] = tokens
+
+
+class EnvCredentialStore(CredentialStore):
+    '''
+    One account per deployment: every token maps to USERID/PASSWORD.
+    Grants are kept in memory.
+    '''
+    def __init__(self):
+        self.grants = {}
+
+    def lookup(self, token):
+        return auth
+
+    def save_grant(self, code, token):
+        self.grants[token] = code
+
+
+class FileCredentialStore(CredentialStore):
+    '''
+    Reads accounts from a JSON file of the form
+        {"tokens": {"<bearer token>": {"userid": "...", "password": "..."}},
+         "timezones": {"<gateway serial number>": "<IANA time zone>"}}
+    and re-reads it when it changes. Grants and event gateway tokens are written
+    back to the file under "grants" and "event_tokens".
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._data = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self._mtime:
+            with open(self.path) as f:
+                self._data = json.load(f)
+            self._mtime = mtime
+        return self._data
+
+    def lookup(self, token):
+        with self._lock:
+            account = self._load().get('tokens', {}).get(token)
+        if account is None:
+            return None
+        return (account['userid'], account['password'])
+
+    def save_grant(self, code, token):
+        with self._lock:
+            data = self._load()
+            data.setdefault('grants', {})[token] = {'code': code, 'time': datetime.now(timezone.utc).isoformat()}
+            self._save(data)
+
+    def event_tokens(self, userid):
+        with self._lock:
+            return self._load().get('event_tokens', {}).get(userid)
+
+    def schedule_timezone(self, gatewaysn):
+        with self._lock:
+            return self._load().get('timezones', {}).get(gatewaysn)
+
+    def save_event_tokens(self, userid, tokens):
+        with self._lock:
+            data = self._load()
+            data.setdefault('event_tokens', {})[userid] = tokens
+            self._save(data)
+
+    def _save(self, data):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, self.path)
+        self._mtime = os.stat(self.path).st_mtime
+
+
+default_tenant = Tenant(USERID, PASSWORD)
+tenants = TenantCache(TENANT_CACHE_SIZE)
+credential_store = None
@@ -0,0 +1,320 @@
+'''
+Calls to the myicomfort service, with both clients (requests and aiohttp)
+under one request policy: a deadline from the Lambda context, retries,
+hedging and per-gateway circuit breakers.
+'''
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from lennox import UpstreamError
+from lennox.lazy import asyncio, random, requests
+from lennox.observability import METRICS_ENABLED, count, logger, span
+from lennox.tenancy import HTTP_CONNECT_TIMEOUT, HTTP_POOL_SIZE, HTTP_READ_TIMEOUT, current_tenant
+
+# URLs
+MYICOMFORT_URL = os.environ.get('MYICOMFORT_URL', "https://services.myicomfort.com/DBAcessService.svc/")
+
+# Request policy for myicomfort calls. Every call is bounded by the time the Lambda has
+# left, less DEADLINE_MARGIN_MS kept back to send an error response. Idempotent GETs
+# are retried with jittered backoff, and can be hedged with a duplicate request if the
+# first has not answered within HEDGE_DELAY_MS (0 disables hedging). Calls fail fast
+# while their gateway's circuit breaker is open (see BREAKER_FAILURE_THRESHOLD).
+DEADLINE_MARGIN_MS = int(os.environ.get('DEADLINE_MARGIN_MS', '500'))
+RETRY_ATTEMPTS = int(os.environ.get('RETRY_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', '0.1'))
+HEDGE_DELAY_MS = int(os.environ.get('HEDGE_DELAY_MS', '0'))
+_deadline = contextvars.ContextVar('deadline', default=None)
+_hedge_executor = None
+
+# The asyncio client runs on one loop, on a background thread.
+_async_loop = None
+_async_loop_lock = threading.Lock()
+
+
+def get_session():
+    '''
+    Returns the current tenant's requests.Session, creating it on first use.
+    The session keeps a pool of keep-alive connections to myicomfort that
+    survives across warm Lambda invocations.
+    '''
+    return current_tenant().get_session()
+
+# Calls to the myicomfort service
+def myicomfort_get(path, auth, key=None):
+    '''
+    GETs a myicomfort path under the request policy. 'key' names the circuit
+    breaker to use (normally the gateway serial number).
+    '''
+    return call_upstream('GET', path, auth, key=key)
+
+def myicomfort_put(path, data, auth, headers=None, key=None):
+    '''
+    PUTs data to a myicomfort path under the request policy. PUTs are not retried.
+    '''
+    return call_upstream('PUT', path, auth, data=data, headers=headers, key=key)
+
+def call_upstream(method, path, auth, data=None, headers=None, key=None):
+    '''
+    Makes a myicomfort call bounded by the invocation deadline, retrying GETs with
+    jittered backoff and failing fast while the circuit for 'key' is open.
+    Returns the response, or raises UpstreamError. A call that fails after all
+    its attempts counts as one failure towards opening the circuit.
+    '''
+    breaker = get_breaker(key)
+    url = MYICOMFORT_URL + path
+    operation = path.split('?')[0]
+    attempts = RETRY_ATTEMPTS if method == 'GET' else 1
+    error = None
+    for attempt in range(attempts):
+        if attempt > 0:
+            backoff(attempt)
+        if not breaker.allow():
+            if error is None:
+                raise UpstreamError('myicomfort circuit open for %s' % (key or 'account'))
+            break
+        if attempt > 0:
+            count('UpstreamRetries')
+        timeout = request_timeout()
+        count('UpstreamCalls')
+        with span('upstream:' + operation, method=method, gateway=key, attempt=attempt + 1) as s:
+            try:
+                if method == 'GET' and HEDGE_DELAY_MS > 0:
+                    r = hedged_get(url, auth, timeout)
+                else:
+                    r = get_session().request(method, url, json=data, auth=auth, headers=headers, timeout=timeout)
+            except requests.RequestException as e:
+                error = e
+                s.set(error=type(e).__name__)
+            else:
+                s.set(status=r.status_code)
+                if METRICS_ENABLED:
+                    count('UpstreamBytesIn', len(r.content))
+                    count('UpstreamBytesOut', len(r.request.body or b''))
+                if r.status_code < 500:
+                    breaker.record_success()
+                    return r
+                error = UpstreamError('myicomfort returned %d for %s' % (r.status_code, operation))
+        count('UpstreamErrors')
+        logger.warning('%s %s failed (attempt %d of %d): %s', method, operation, attempt + 1, attempts, error)
+    breaker.record_failure()
+    raise UpstreamError(str(error)) from error
+
+def hedged_get(url, auth, timeout):
+    '''
+    GETs url and, if there is no answer within HEDGE_DELAY_MS, sends a duplicate.
+    Returns whichever response arrives first.
+    '''
+    executor = get_hedge_executor()
+    futures = [executor.submit(get_session().get, url, auth=auth, timeout=timeout)]
+    done, pending = wait(futures, timeout=HEDGE_DELAY_MS / 1000.0)
+    if not done:
+        futures.append(executor.submit(get_session().get, url, auth=auth, timeout=timeout))
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+    # Both failed; re-raise the first request's error.
+    return futures[0].result()
+
+def get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        _hedge_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix='lennox-hedge')
+    return _hedge_executor
+
+def set_deadline(context):
+    '''
+    Sets the deadline for upstream calls made in this context from the Lambda
+    context's remaining time. With no Lambda context, calls are only bounded by
+    the HTTP timeouts.
+    '''
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        _deadline.set(time.monotonic() + (context.get_remaining_time_in_millis() - DEADLINE_MARGIN_MS) / 1000.0)
+    else:
+        _deadline.set(None)
+
+def remaining_time():
+    '''
+    Returns the seconds left before the deadline, or None if there is no deadline.
+    '''
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def request_timeout():
+    '''
+    Returns the (connect, read) timeout for the next call, capped by the deadline.
+    Raises UpstreamError if the deadline has passed.
+    '''
+    remaining = remaining_time()
+    if remaining is None:
+        return (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    if remaining <= 0:
+        raise UpstreamError('Deadline exceeded')
+    return (min(HTTP_CONNECT_TIMEOUT, remaining), min(HTTP_READ_TIMEOUT, remaining))
+
+def backoff_delay(attempt):
+    '''
+    Returns a jittered exponential backoff delay for a retry, or raises
+    UpstreamError if it would run past the deadline.
+    '''
+    delay = random.uniform(0, RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+    remaining = remaining_time()
+    if remaining is not None and delay >= remaining:
+        raise UpstreamError('Deadline exceeded')
+    return delay
+
+def backoff(attempt):
+    time.sleep(backoff_delay(attempt))
+
+def get_breaker(key):
+    return current_tenant().get_breaker(key or 'account')
+
+def get_async_loop():
+    '''
+    Returns the event loop used by the asyncio client, starting it on a
+    background thread on first use. Keeping one loop alive lets the async
+    connection pool survive across warm invocations.
+    '''
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='lennox-async', daemon=True).start()
+            _async_loop = loop
+    return _async_loop
+
+def run_async(coro):
+    '''
+    Runs a coroutine on the asyncio client's loop and returns its result.
+    Safe to call from any thread other than the loop's own. The coroutine runs
+    in a copy of the caller's context, so it sees the deadline and trace.
+    '''
+    return asyncio.run_coroutine_threadsafe(_run_in_context(coro, contextvars.copy_context()), get_async_loop()).result()
+
+async def on_client_loop(coro):
+    '''
+    Awaits a coroutine on the asyncio client's loop, from any event loop. The
+    async client's connection pools and in-flight requests belong to that loop,
+    so callers on another one (such as a loop started by asyncio.run()) hand
+    their work over to it. The coroutine runs in a copy of the caller's
+    context, and cancelling the caller cancels it.
+    '''
+    loop = get_async_loop()
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_run_in_context(coro, contextvars.copy_context()), loop))
+
+async def _run_in_context(coro, context):
+    return await asyncio.get_running_loop().create_task(coro, context=context)
+
+def get_async_session():
+    '''
+    Returns the current tenant's aiohttp.ClientSession, creating it on first use.
+    Must be called from the asyncio client's loop.
+    '''
+    return current_tenant().get_async_session()
+
+async def async_myicomfort_get(path, auth, key=None):
+    '''
+    Asyncio version of myicomfort_get(). Returns the response text.
+    '''
+    (status, text) = await call_upstream_async('GET', path, auth, key=key)
+    if status >= 400:
+        raise UpstreamError('myicomfort returned %d for %s' % (status, path.split('?')[0]))
+    return text
+
+async def async_myicomfort_put(path, data, auth, headers=None, key=None):
+    '''
+    Asyncio version of myicomfort_put(). Returns a tuple of (ok, response text).
+    '''
+    (status, text) = await call_upstream_async('PUT', path, auth, data=data, headers=headers, key=key)
+    return (status < 400, text)
+
+async def call_upstream_async(method, path, auth, data=None, headers=None, key=None):
+    '''
+    Asyncio version of call_upstream(). Returns a tuple of (status, response text).
+    '''
+    import aiohttp
+    breaker = get_breaker(key)
+    url = MYICOMFORT_URL + path
+    operation = path.split('?')[0]
+    attempts = RETRY_ATTEMPTS if method == 'GET' else 1
+    error = None
+    for attempt in range(attempts):
+        if attempt > 0:
+            await asyncio.sleep(backoff_delay(attempt))
+        if not breaker.allow():
+            if error is None:
+                raise UpstreamError('myicomfort circuit open for %s' % (key or 'account'))
+            break
+        if attempt > 0:
+            count('UpstreamRetries')
+        (connect, read) = request_timeout()
+        timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read, total=remaining_time())
+        count('UpstreamCalls')
+        with span('upstream:' + operation, method=method, gateway=key, attempt=attempt + 1) as s:
+            try:
+                if method == 'GET' and HEDGE_DELAY_MS > 0:
+                    (status, text) = await _hedged_request_async(method, url, auth, data, headers, timeout)
+                else:
+                    (status, text) = await _request_async(method, url, auth, data, headers, timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                s.set(error=type(e).__name__)
+            else:
+                s.set(status=status)
+                if METRICS_ENABLED:
+                    count('UpstreamBytesIn', len(text.encode('utf-8')))
+                    count('UpstreamBytesOut', 0 if data is None else len(json.dumps(data)))
+                if status < 500:
+                    breaker.record_success()
+                    return (status, text)
+                error = UpstreamError('myicomfort returned %d for %s' % (status, operation))
+        count('UpstreamErrors')
+        logger.warning('%s %s failed (attempt %d of %d): %r', method, operation, attempt + 1, attempts, error)
+    breaker.record_failure()
+    raise UpstreamError(str(error) or repr(error)) from error
+
+async def _request_async(method, url, auth, data, headers, timeout):
+    import aiohttp
+    async with get_async_session().request(method, url, json=data, auth=aiohttp.BasicAuth(*auth), headers=headers, timeout=timeout) as r:
+        return (r.status, await r.text())
+
+async def _hedged_request_async(method, url, auth, data, headers, timeout):
+    '''
+    Asyncio version of hedged_get().
+    '''
+    tasks = [asyncio.ensure_future(_request_async(method, url, auth, data, headers, timeout))]
+    done, pending = await asyncio.wait(tasks, timeout=HEDGE_DELAY_MS / 1000.0)
+    if not done:
+        tasks.append(asyncio.ensure_future(_request_async(method, url, auth, data, headers, timeout)))
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        return tasks[0].result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+def stop():
+    '''
+    Stops the asyncio client's loop and the threads sending hedged requests.
+    '''
+    global _async_loop, _hedge_executor
+    with _async_loop_lock:
+        if _async_loop is not None:
+            _async_loop.call_soon_threadsafe(_async_loop.stop)
+            _async_loop = None
+    if _hedge_executor is not None:
+        _hedge_executor.shutdown(wait=False)
+        _hedge_executor = None
@@ -0,0 +1,223 @@
+'''
+Runs the skill as a long-running HTTP server, for hosting outside Lambda.
+
+Alexa directives are POSTed as JSON to / (one directive) or /batch (a list of
+directives) and handled concurrently by lambda_handler and lambda_batch_handler,
+at most --workers at a time. Connection pools, state caches and change
+report pollers live as long as the process, so no request pays for a cold start.
+GET /health reports whether the server is accepting work and GET /metrics
+returns lambda_function.metrics.snapshot().
+
+On SIGTERM or SIGINT the server stops accepting connections, lets the
+directives in flight finish (for up to --drain-seconds), and then closes every
+connection pool and poller.
+
+    python server.py --port 8000 --workers 32
+'''
+import argparse
+import contextvars
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import lambda_function
+
+logger = lambda_function.logger
+
+
+class ServerContext:
+    '''
+    Stands in for the Lambda context: a time budget and a request ID for one
+    directive, so upstream calls are bounded as they are in Lambda.
+    '''
+    def __init__(self, timeout_ms):
+        self.deadline = time.monotonic() + timeout_ms / 1000.0
+        self.aws_request_id = str(uuid.uuid4())
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+class DirectiveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    # Seconds an idle keep-alive connection is kept open
+    timeout = 30
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s', self.address_string(), format % args)
+
+    def do_GET(self):
+        if self.path == '/health':
+            status = 503 if self.server.draining else 200
+            self.send_json(status, json.dumps({'status': 'draining' if self.server.draining else 'ok', 'inFlight': self.server.in_flight}))
+        elif self.path == '/metrics':
+            self.send_json(200, json.dumps(lambda_function.metrics.snapshot()))
+        else:
+            self.send_json(404, json.dumps({'error': 'Not found'}))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.path == '/':
+            handler = lambda_function.lambda_handler
+        elif self.path == '/batch':
+            handler = lambda_function.lambda_batch_handler
+        else:
+            self.send_json(404, json.dumps({'error': 'Not found'}))
+            return
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self.send_json(400, json.dumps({'error': 'Body is not JSON'}))
+            return
+        if (handler is lambda_function.lambda_batch_handler) != isinstance(request, list):
+            self.send_json(400, json.dumps({'error': '/batch takes a list of directives, / takes one'}))
+            return
+        if not self.server.begin():
+            self.close_connection = True
+            self.send_json(503, json.dumps({'error': 'Server is shutting down'}))
+            return
+        # The directive counts as in flight until its response is written, so a
+        # drain does not close the connection under it.
+        try:
+            try:
+                # Each directive starts from an empty context, so nothing set for one
+                # (deadline, account, correlation ID) leaks into the next on this thread.
+                response = contextvars.Context().run(handler, request, ServerContext(self.server.request_timeout_ms))
+                (status, text) = (200, to_json(response))
+            except Exception:
+                logger.exception('Unhandled error handling %s', self.path)
+                (status, text) = (500, json.dumps({'error': 'Internal error'}))
+            if self.server.draining:
+                self.close_connection = True
+            self.send_json(status, text)
+        finally:
+            self.server.end()
+
+    def send_json(self, status, text):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def to_json(response):
+    '''
+    Returns a handler's response as JSON text, reusing the text already built
+    for Alexa responses.
+    '''
+    if isinstance(response, list):
+        return '[' + ', '.join(map(to_json, response)) + ']'
+    if isinstance(response, lambda_function.ResponseDict):
+        return response.to_json()
+    return json.dumps(response)
+
+
+class DirectiveServer(ThreadingHTTPServer):
+    '''
+    HTTP server with a thread per connection, of which at most 'workers' handle
+    a directive at once; idle keep-alive connections cost a thread but no
+    worker. It can drain: stop taking new directives and wait for those in flight.
+    '''
+    daemon_threads = True
+    # The default backlog of 5 drops connections under a burst of new clients
+    request_queue_size = 128
+
+    def __init__(self, address, workers, request_timeout_ms):
+        super().__init__(address, DirectiveHandler)
+        self.request_timeout_ms = request_timeout_ms
+        self.draining = False
+        self.in_flight = 0
+        self._workers = threading.Semaphore(workers)
+        self._connections = set()
+        self._idle = threading.Condition()
+
+    def process_request(self, request, client_address):
+        with self._idle:
+            self._connections.add(request)
+        super().process_request(request, client_address)
+
+    def shutdown_request(self, request):
+        with self._idle:
+            self._connections.discard(request)
+        super().shutdown_request(request)
+
+    def begin(self):
+        '''
+        Counts a directive as in flight and waits for a free worker. Returns
+        False if the server is draining.
+        '''
+        with self._idle:
+            if self.draining:
+                return False
+            self.in_flight += 1
+        self._workers.acquire()
+        return True
+
+    def end(self):
+        self._workers.release()
+        with self._idle:
+            self.in_flight -= 1
+            self._idle.notify_all()
+
+    def drain(self, timeout):
+        '''
+        Stops accepting connections and waits up to 'timeout' seconds for the
+        directives in flight. Idle keep-alive connections are then closed.
+        Returns True if everything in flight finished.
+        '''
+        self.shutdown()
+        with self._idle:
+            self.draining = True
+            finished = self._idle.wait_for(lambda: self.in_flight == 0, timeout)
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.server_close()
+        return finished
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve Alexa directives over HTTP with a long-running process')
+    parser.add_argument('--host', default=os.environ.get('SERVER_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SERVER_PORT', '8000')))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SERVER_WORKERS', '32')), help='Directives handled at once')
+    parser.add_argument('--request-timeout-ms', type=int, default=int(os.environ.get('SERVER_REQUEST_TIMEOUT_MS', '8000')), help='Time budget per directive')
+    parser.add_argument('--drain-seconds', type=float, default=float(os.environ.get('SERVER_DRAIN_SECONDS', '10')), help='How long to wait for directives in flight at shutdown')
+    args = parser.parse_args()
+
+    # Pay the startup costs now rather than on the first directive.
+    lambda_function.get_session()
+    if lambda_function.CHANGE_REPORTS:
+        lambda_function.start_change_reports()
+
+    server = DirectiveServer((args.host, args.port), args.workers, args.request_timeout_ms)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    threading.Thread(target=server.serve_forever, name='lennox-server-accept', daemon=True).start()
+    logger.info('Serving Alexa directives at http://%s:%d/', args.host, server.server_address[1])
+
+    stop.wait()
+    logger.info('Draining %d directives in flight', server.in_flight)
+    if not server.drain(args.drain_seconds):
+        logger.warning('Directives still in flight after %ss', args.drain_seconds)
+    lambda_function.shutdown()
+    logger.info('Stopped')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''
+Shared fixtures. The skill is configured from the environment when it is
+imported, so the environment is set up here before lambda_function is loaded,
+pointing it at the myicomfort stand-in from benchmarks/.
+'''
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from myicomfort_standin import StandinServer, StandinState
+
+_server = StandinServer(StandinState())
+os.environ['MYICOMFORT_URL'] = _server.start()
+os.environ['USERID'] = 'standin'
+os.environ['PASSWORD'] = 'standin'
+os.environ['LOG_LEVEL'] = 'WARNING'
+os.environ['METRICS'] = 'memory'
+os.environ['RETRY_BASE_DELAY'] = '0.001'
+
+import lambda_function
+from lennox import tenancy
+
+
+@pytest.fixture
+def lf():
+    return lambda_function
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    '''
+    A fresh stand-in account with two gateways of two zones each, and a fresh
+    default tenant so no state carries over from another test.
+    '''
+    state = StandinState(gateways=2, zones=2, userid='standin')
+    _server.state = state
+    tenant = tenancy.Tenant('standin', 'standin')
+    monkeypatch.setattr(tenancy, 'default_tenant', tenant)
+    lambda_function.metrics.reset()
+    yield state
+    tenant.close()
+
+
+@pytest.fixture
+def directive():
+    '''
+    Returns a function that builds an Alexa directive request.
+    '''
+    def build(namespace, name, endpointId=None, payload=None, token='token'):
+        request = {'directive': {
+            'header': {'namespace': namespace, 'name': name, 'payloadVersion': '3', 'messageId': 'message-' + name},
+            'payload': dict(payload or {}),
+        }}
+        if endpointId is not None:
+            request['directive']['endpoint'] = {'endpointId': endpointId, 'scope': {'type': 'BearerToken', 'token': token}}
+        else:
+            request['directive']['payload'].setdefault('scope', {'type': 'BearerToken', 'token': token})
+        return request
+    return build
+
+
+@pytest.fixture
+def properties():
+    '''
+    Returns a function that maps a response's context properties by
+    (namespace, name) to their values.
+    '''
+    return lambda response: {(p['namespace'], p['name']): p['value'] for p in response.get('context', {}).get('properties', [])}
@@ -0,0 +1,50 @@
+import functools
+import os
+import subprocess
+import sys
+import threading
+
+from lennox import tenancy
+
+
+def test_adjustments_are_merged(lf, standin):
+    coalescer = tenancy.AdjustCoalescer(0.1)
+    apply = functools.partial(lf.applyAdjustment, 'STANDIN0000:0', lf.current_tenant().auth)
+    results = []
+    threads = [threading.Thread(target=lambda delta: results.append(coalescer.adjust('STANDIN0000:0', delta, apply)), args=(delta,))
+               for delta in (1, 2, -1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The zone is in AUTO, so both setpoints move by the sum
+    assert standin.zones['STANDIN0000'][0]['Heat_Set_Point'] == 68
+    assert [r['Heat_Set_Point'] for r in results] == [68, 68, 68]
+    assert standin.counters()['calls'] == {'GetTStatInfoList': 1, 'SetTStatInfo': 1}
+
+
+def test_failure_reaches_every_caller(lf, standin):
+    coalescer = tenancy.AdjustCoalescer(0.05)
+    apply = functools.partial(lf.applyAdjustment, 'STANDIN0000:9', lf.current_tenant().auth)
+    errors = []
+
+    def adjust():
+        try:
+            coalescer.adjust('STANDIN0000:9', 1, apply)
+        except LookupError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=adjust) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 2
+
+
+def test_no_debounce_in_lambda():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, ADJUST_DEBOUNCE_MS='500', AWS_LAMBDA_FUNCTION_NAME='lennox')
+    output = subprocess.run([sys.executable, '-c', 'from lennox import tenancy; print(tenancy.ADJUST_DEBOUNCE_MS)'],
+                            cwd=root, env=env, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == '0'
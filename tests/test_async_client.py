@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+
+def run(lf, request):
+    return lf.run_async(lf.async_lambda_handler(request, None))
+
+
+def test_async_client_is_not_a_blocking_client(lf):
+    assert not issubclass(lf.AsyncLennoxWiFi, lf.LennoxWiFi)
+    assert asyncio.iscoroutinefunction(lf.AsyncLennoxWiFi.getTStatInfo)
+
+
+def test_report_state(lf, standin, directive, properties):
+    response = run(lf, directive('Alexa', 'ReportState', 'STANDIN0001:1'))
+    assert response['event']['header']['name'] == 'StateReport'
+    assert properties(response)[('Alexa.TemperatureSensor', 'temperature')]['value'] == 70
+
+
+def test_control(lf, standin, directive, properties):
+    response = run(lf, directive('Alexa.ThermostatController', 'SetThermostatMode', 'STANDIN0000:0',
+                                 {'thermostatMode': {'value': 'HEAT'}}))
+    assert properties(response)[('Alexa.ThermostatController', 'thermostatMode')] == {'value': 'HEAT'}
+    assert standin.zones['STANDIN0000'][0]['Operation_Mode'] == 1
+
+
+def test_rejected_write_raises(lf, standin):
+    async def write():
+        tStat = lf.AsyncLennoxWiFi('STANDIN0000:1', lf.current_tenant().auth)
+        await tStat.getTStatInfo()
+        del standin.zones['STANDIN0000'][1]
+        await tStat.setTStatInfo(operating_mode=2)
+    with pytest.raises(lf.UpstreamError):
+        lf.run_async(write())
+    assert lf.current_tenant().cache.get('STANDIN0000:1') is None
+
+
+def test_discovery_is_bounded(lf, standin, directive, monkeypatch):
+    monkeypatch.setattr(lf, 'DISCOVERY_MAX_WORKERS', 1)
+    fetch = lf.getGatewayTStatInfoAsync
+    running = []
+    peak = []
+
+    async def counted(gatewaysn, auth):
+        running.append(gatewaysn)
+        peak.append(len(running))
+        try:
+            await asyncio.sleep(0.01)
+            return await fetch(gatewaysn, auth)
+        finally:
+            running.remove(gatewaysn)
+
+    monkeypatch.setattr(lf, 'getGatewayTStatInfoAsync', counted)
+    response = run(lf, directive('Alexa.Discovery', 'Discover'))
+    assert len(response['event']['payload']['endpoints']) == 4
+    assert max(peak) == 1
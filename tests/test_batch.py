@@ -0,0 +1,67 @@
+def set_mode(directive, endpointId, mode):
+    return directive('Alexa.ThermostatController', 'SetThermostatMode', endpointId, {'thermostatMode': {'value': mode}})
+
+
+def adjust(directive, endpointId, delta):
+    return directive('Alexa.ThermostatController', 'AdjustTargetTemperature', endpointId, {'targetSetpointDelta': {'value': delta}})
+
+
+def test_changes_to_a_zone_are_merged(lf, standin, directive, properties):
+    responses = lf.lambda_batch_handler([
+        set_mode(directive, 'STANDIN0000:0', 'HEAT'),
+        adjust(directive, 'STANDIN0000:0', 2),
+        directive('Alexa', 'ReportState', 'STANDIN0000:1'),
+        adjust(directive, 'STANDIN0001:0', -1),
+    ], None)
+    assert properties(responses[0])[('Alexa.ThermostatController', 'targetSetpoint')]['value'] == 66
+    assert properties(responses[1])[('Alexa.ThermostatController', 'targetSetpoint')]['value'] == 68
+    assert responses[2]['event']['header']['name'] == 'StateReport'
+    assert standin.zones['STANDIN0000'][0]['Heat_Set_Point'] == 68
+    assert standin.counters()['calls'] == {'GetTStatInfoList': 2, 'SetTStatInfo': 2}
+
+
+def test_failed_write_fails_its_directives_only(lf, standin, directive, monkeypatch):
+    import myicomfort_standin
+    set_tstat_info = myicomfort_standin.StandinHandler.set_tstat_info
+
+    def reject_zone_1(handler, data):
+        if data['Zone_Number'] == 1:
+            raise LookupError('Rejected')
+        return set_tstat_info(handler, data)
+
+    monkeypatch.setattr(myicomfort_standin.StandinHandler, 'set_tstat_info', reject_zone_1)
+    responses = lf.lambda_batch_handler([
+        set_mode(directive, 'STANDIN0000:1', 'HEAT'),
+        adjust(directive, 'STANDIN0000:1', 1),
+        set_mode(directive, 'STANDIN0000:0', 'COOL'),
+    ], None)
+    assert [r['event']['payload'].get('type') for r in responses] == ['ENDPOINT_UNREACHABLE', 'ENDPOINT_UNREACHABLE', None]
+    assert standin.zones['STANDIN0000'][0]['Operation_Mode'] == 2
+    assert lf.current_tenant().cache.get('STANDIN0000:1') is None
+
+
+def test_unknown_zone_and_bad_directive(lf, standin, directive):
+    responses = lf.lambda_batch_handler([
+        directive('Alexa', 'ReportState', 'STANDIN0000:7'),
+        set_mode(directive, 'STANDIN0000:0', 'SIDEWAYS'),
+        directive('Alexa', 'ReportState', 'STANDIN0000:0'),
+    ], None)
+    assert [r['event']['payload'].get('type') for r in responses] == ['NO_SUCH_ENDPOINT', 'INTERNAL_ERROR', None]
+
+
+def test_unreachable_gateway(lf, standin, directive):
+    responses = lf.lambda_batch_handler([
+        directive('Alexa', 'ReportState', 'MISSING:0'),
+        directive('Alexa', 'ReportState', 'STANDIN0001:0'),
+    ], None)
+    assert [r['event']['header']['name'] for r in responses] == ['ErrorResponse', 'StateReport']
+
+
+def test_malformed_endpoint_fails_its_directive_only(lf, standin, directive):
+    responses = lf.lambda_batch_handler([
+        directive('Alexa', 'ReportState', 'BADID'),
+        directive('Alexa', 'ReportState', 'STANDIN0000:0'),
+    ], None)
+    assert [r['event']['header']['name'] for r in responses] == ['ErrorResponse', 'StateReport']
+    assert responses[0]['event']['endpoint']['endpointId'] == 'BADID'
+    assert standin.counters()['calls'] == {'GetTStatInfoList': 1}
@@ -0,0 +1,98 @@
+import pytest
+
+from event_gateway_standin import EventGatewayStandin
+from lennox import tenancy
+
+
+@pytest.fixture
+def gateway():
+    server = EventGatewayStandin()
+    server.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def store(lf, monkeypatch):
+    store = tenancy.EnvCredentialStore()
+    monkeypatch.setattr(tenancy, 'credential_store', store)
+    return store
+
+
+def change_zone(standin, gatewaysn='STANDIN0000', zone_number=0, **fields):
+    with standin.lock:
+        standin.zones[gatewaysn][zone_number].update(fields)
+
+
+def test_gateways_are_reread_after_ttl(lf, standin):
+    events = []
+    poller = lf.ChangeReportPoller(events.append, tenancy.default_tenant, gateways_ttl=60)
+    poller.poll_once()
+    assert poller.gateways == ['STANDIN0000', 'STANDIN0001']
+
+    removed = standin.systems.pop()
+    standin.zones.pop(removed['Gateway_SN'])
+    poller.poll_once()
+    assert poller.gateways == ['STANDIN0000', 'STANDIN0001']
+
+    poller.gateways_expire = 0
+    poller.poll_once()
+    assert poller.gateways == ['STANDIN0000']
+    assert all(endpointId.startswith('STANDIN0000:') for endpointId in poller._snapshots)
+
+
+def test_gateway_refresh_failure_keeps_list(lf, standin, monkeypatch):
+    poller = lf.ChangeReportPoller(lambda event: None, tenancy.default_tenant, gateways_ttl=0)
+    poller.poll_once()
+
+    def fail(auth):
+        raise lf.UpstreamError('down')
+    monkeypatch.setattr(lf, 'getSystemsInfo', fail)
+    poller.poll_once()
+    assert poller.gateways == ['STANDIN0000', 'STANDIN0001']
+
+
+def test_default_account_uses_change_report_token(lf, standin, store, gateway, monkeypatch):
+    monkeypatch.setattr(lf, 'CHANGE_REPORT_TOKEN', 'fixed')
+    poller = lf.ChangeReportPoller(lf.EventGatewaySink(gateway.url, tenant=tenancy.default_tenant), tenancy.default_tenant)
+    poller.poll_once()
+    change_zone(standin, Indoor_Temp=72)
+    assert poller.poll_once() == 1
+    assert gateway.tokens == ['fixed']
+    assert gateway.events[0]['event']['endpoint']['scope']['token'] == 'fixed'
+
+
+def test_accept_grant_token_is_used_per_account(lf, standin, store, gateway, directive, monkeypatch):
+    monkeypatch.setattr(lf, 'CHANGE_REPORT_TOKEN', 'fixed')
+    monkeypatch.setattr(lf, 'LWA_CLIENT_ID', 'client')
+    monkeypatch.setattr(lf, 'LWA_CLIENT_SECRET', 'secret')
+    monkeypatch.setattr(lf, 'LWA_TOKEN_URL', gateway.token_url)
+    monkeypatch.setattr(lf, 'CHANGE_REPORT_URL', gateway.url)
+    grant = directive('Alexa.Authorization', 'AcceptGrant', payload={'grant': {'code': 'standin'}, 'grantee': {'token': 'token'}})
+    response = lf.lambda_handler(grant, None)
+    assert response['event']['header']['name'] == 'AcceptGrant.Response'
+    assert gateway.token_requests[0]['code'] == 'standin'
+    assert store.event_tokens('standin')['access_token'] == 'access-standin'
+
+    poller = lf.ChangeReportPoller(lf.get_change_report_sink(tenancy.default_tenant), tenancy.default_tenant)
+    poller.poll_once()
+    change_zone(standin, Indoor_Temp=72)
+    assert poller.poll_once() == 1
+    assert gateway.tokens == ['access-standin']
+
+    # An expiring token is refreshed before it is used
+    store.event_tokens('standin')['expires_at'] = 0
+    change_zone(standin, Indoor_Temp=73)
+    assert poller.poll_once() == 1
+    assert gateway.token_requests[-1]['grant_type'] == 'refresh_token'
+    assert store.event_tokens('standin')['expires_at'] > 0
+
+
+def test_account_without_token_only_logs(lf, standin, store, gateway, monkeypatch):
+    monkeypatch.setattr(lf, 'CHANGE_REPORT_TOKEN', 'fixed')
+    other = tenancy.Tenant('other', 'other')
+    try:
+        lf.EventGatewaySink(gateway.url, tenant=other)({'event': {'header': {}, 'payload': {}}})
+    finally:
+        other.close()
+    assert gateway.events == []
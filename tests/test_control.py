@@ -0,0 +1,17 @@
+def test_response_is_built_from_the_write(lf, standin, directive, properties):
+    response = lf.lambda_handler(directive('Alexa.ThermostatController', 'SetThermostatMode', 'STANDIN0000:0',
+                                           {'thermostatMode': {'value': 'COOL'}}), None)
+    assert properties(response)[('Alexa.ThermostatController', 'thermostatMode')] == {'value': 'COOL'}
+    assert standin.zones['STANDIN0000'][0]['Operation_Mode'] == 2
+    assert standin.counters()['calls'] == {'GetTStatInfoList': 1, 'SetTStatInfo': 1}
+
+
+def test_rejected_write_is_an_error(lf, standin, directive):
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:1'), None)
+    # The stand-in answers 404 for a zone it does not have
+    del standin.zones['STANDIN0000'][1]
+    response = lf.lambda_handler(directive('Alexa.ThermostatController', 'SetThermostatMode', 'STANDIN0000:1',
+                                           {'thermostatMode': {'value': 'COOL'}}), None)
+    assert response['event']['header']['name'] == 'ErrorResponse'
+    assert response['event']['payload']['type'] == 'ENDPOINT_UNREACHABLE'
+    assert lf.current_tenant().cache.get('STANDIN0000:1') is None
@@ -0,0 +1,22 @@
+def test_discovers_every_zone_in_order(lf, standin, directive):
+    response = lf.lambda_handler(directive('Alexa.Discovery', 'Discover'), None)
+    endpoints = response['event']['payload']['endpoints']
+    assert [e['endpointId'] for e in endpoints] == standin.endpoint_ids()
+    assert endpoints[0]['friendlyName'] == 'Zone 1'
+    assert standin.counters()['calls'] == {'GetSystemsInfo': 1, 'GetTStatInfoList': 2}
+
+
+def test_gateway_failure_is_skipped(lf, standin, directive):
+    standin.systems.insert(1, dict(standin.systems[0], Gateway_SN='MISSING'))
+    response = lf.lambda_handler(directive('Alexa.Discovery', 'Discover'), None)
+    assert [e['endpointId'] for e in response['event']['payload']['endpoints']] == standin.endpoint_ids()
+
+
+def test_gateways_are_queried_concurrently(lf, standin, directive):
+    import time
+    standin.latency_ms = 100
+    standin.systems.extend(dict(standin.systems[0], Gateway_SN='MISSING%d' % i) for i in range(4))
+    start = time.perf_counter()
+    lf.lambda_handler(directive('Alexa.Discovery', 'Discover'), None)
+    # One GetSystemsInfo plus one round of six concurrent gateway reads
+    assert time.perf_counter() - start < 0.6
@@ -0,0 +1,38 @@
+import asyncio
+
+
+def collect_async(lf):
+    async def collect():
+        return [zone async for zone in lf.iterFleetStateAsync()]
+    return lf.run_async(collect())
+
+
+def test_iter_fleet_state(lf, standin):
+    assert sorted(zone.endpoint_id for zone in lf.iterFleetState()) == sorted(standin.endpoint_ids())
+
+
+def test_iter_fleet_state_async(lf, standin):
+    assert sorted(zone.endpoint_id for zone in collect_async(lf)) == sorted(standin.endpoint_ids())
+
+
+def test_cancelled_gateway_fetch_is_skipped(lf, standin, monkeypatch):
+    fetch = lf.getGatewayTStatInfoAsync
+
+    async def cancelled_for_one(gatewaysn, auth):
+        if gatewaysn == 'STANDIN0001':
+            raise asyncio.CancelledError()
+        return await fetch(gatewaysn, auth)
+    monkeypatch.setattr(lf, 'getGatewayTStatInfoAsync', cancelled_for_one)
+    zones = collect_async(lf)
+    assert sorted(zone.endpoint_id for zone in zones) == ['STANDIN0000:0', 'STANDIN0000:1']
+
+
+def test_iter_fleet_state_async_on_other_loops(lf, standin, directive):
+    async def collect():
+        return [zone async for zone in lf.iterFleetStateAsync()]
+    for _ in range(2):
+        lf.current_tenant().cache.clear()
+        assert sorted(zone.endpoint_id for zone in asyncio.run(collect())) == sorted(standin.endpoint_ids())
+    lf.current_tenant().cache.clear()
+    response = lf.run_async(lf.async_lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None))
+    assert response['event']['header']['name'] == 'StateReport'
@@ -0,0 +1,36 @@
+import copy
+import json
+
+import pytest
+
+from lennox import lazy
+
+
+def test_frozen_dict_is_read_only(lf):
+    frozen = lf.freeze({'a': [{'b': 1}]})
+    with pytest.raises(TypeError):
+        frozen['a'] = 2
+    with pytest.raises(TypeError):
+        frozen['a'][0].update(b=2)
+    with pytest.raises(TypeError):
+        frozen |= {'c': 3}
+
+
+def test_copies_are_writable(lf):
+    capabilities = copy.deepcopy(lf.DISCOVERY_CAPABILITIES)
+    capabilities[0]['version'] = '3.1'
+    assert lf.DISCOVERY_CAPABILITIES[0]['version'] == '3'
+    shallow = copy.copy(lf.DISCOVERY_CAPABILITIES[0])
+    shallow['version'] = '3.1'
+    assert type(shallow) is dict
+
+
+def test_serializes_like_a_dict(lf):
+    assert json.dumps(lf.DISCOVERY_CAPABILITIES) == json.dumps(copy.deepcopy(lf.DISCOVERY_CAPABILITIES))
+
+
+def test_lazy_modules_are_imported_on_first_use():
+    module = lazy.LazyModule('colorsys')
+    assert module._module is None
+    assert module.rgb_to_hsv(1, 0, 0) == (0, 1, 1)
+    assert 'colorsys' in lazy.startup_timings['lazy_imports_ms']
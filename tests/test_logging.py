@@ -0,0 +1,66 @@
+import json
+import logging
+
+import pytest
+
+from lennox import observability
+
+
+class Context:
+    aws_request_id = 'batch-1'
+
+
+@pytest.fixture
+def records(lf, monkeypatch):
+    '''
+    Collects (correlation ID, message) for every line the skill logs at INFO.
+    '''
+    collected = []
+
+    class Collector(logging.Handler):
+        def emit(self, record):
+            collected.append((record.correlation_id, record.getMessage()))
+
+    handler = Collector()
+    handler.addFilter(observability.CorrelationFilter())
+    monkeypatch.setattr(observability, 'LOG_PAYLOAD_SAMPLE_RATE', 1.0)
+    observability.logger.addHandler(handler)
+    level = observability.logger.level
+    observability.logger.setLevel(logging.INFO)
+    yield collected
+    observability.logger.setLevel(level)
+    observability.logger.removeHandler(handler)
+
+
+def test_directive_id(lf, standin, directive, records):
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), Context())
+    assert set(records) == {('message-ReportState', 'lambda_handler request'), ('message-ReportState', 'lambda_handler response')}
+
+
+def test_async_handler_logs_request_once(lf, standin, directive, records, monkeypatch):
+    monkeypatch.setattr(lf, 'ASYNC_HANDLER', True)
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), Context())
+    assert [record for record in records if record[1].endswith('request')] == [('message-ReportState', 'lambda_handler request')]
+
+
+def test_batch_ids_are_derived(lf, standin, directive, records):
+    grant = directive('Alexa.Authorization', 'AcceptGrant', payload={'grant': {'code': 'c'}, 'grantee': {'token': 'token'}})
+    lf.lambda_batch_handler([grant, directive('Alexa', 'ReportState', 'STANDIN0000:0')], Context())
+    assert ('batch-1/message-AcceptGrant', 'lambda_handler request') in records
+    assert ('batch-1/message-AcceptGrant', 'lambda_handler response') in records
+    assert ('batch-1', 'lambda_handler response') in records
+    assert {correlation_id.split('/')[0] for (correlation_id, message) in records} == {'batch-1'}
+
+
+def test_unsampled_payloads_are_not_serialized(lf, standin, directive, records, monkeypatch):
+    monkeypatch.setattr(observability, 'LOG_PAYLOAD_SAMPLE_RATE', 0.0)
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), Context())
+    assert records == []
+
+
+def test_json_lines():
+    record = logging.LogRecord('lambda_function', logging.INFO, __file__, 1, 'response', None, None)
+    record.correlation_id = 'c'
+    record.payload = {'a': 1}
+    line = json.loads(observability.StructuredFormatter().format(record))
+    assert (line['correlationId'], line['message'], line['payload']) == ('c', 'response', {'a': 1})
@@ -0,0 +1,93 @@
+import time
+
+from lennox import tenancy, upstream
+
+
+def test_failed_call_counts_once(lf, standin, directive, monkeypatch):
+    monkeypatch.setattr(tenancy, 'BREAKER_FAILURE_THRESHOLD', 2)
+    standin.error_rate = 1.0
+    response = lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None)
+    assert response['event']['payload']['type'] == 'ENDPOINT_UNREACHABLE'
+    assert standin.counters()['calls'] == {'GetTStatInfoList': upstream.RETRY_ATTEMPTS}
+    assert upstream.get_breaker('STANDIN0000').failures == 1
+
+
+def test_open_circuit_fails_fast(lf, standin, directive, monkeypatch):
+    monkeypatch.setattr(tenancy, 'BREAKER_FAILURE_THRESHOLD', 2)
+    standin.error_rate = 1.0
+    for i in range(2):
+        lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None)
+    standin.reset_counters()
+    response = lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None)
+    assert response['event']['payload']['type'] == 'ENDPOINT_UNREACHABLE'
+    assert standin.counters()['calls'] == {}
+    # Other gateways have their own circuit
+    standin.error_rate = 0
+    response = lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0001:0'), None)
+    assert response['event']['header']['name'] == 'StateReport'
+
+
+def test_retries_stop_when_the_circuit_opens(lf, standin, monkeypatch):
+    monkeypatch.setattr(tenancy, 'BREAKER_FAILURE_THRESHOLD', 1)
+    standin.error_rate = 1.0
+    breaker = upstream.get_breaker('STANDIN0000')
+    # Another call fails while this one backs off
+    monkeypatch.setattr(upstream, 'backoff', lambda attempt: breaker.record_failure())
+    try:
+        lf.myicomfort_get('GetTStatInfoList?gatewaysn=STANDIN0000', lf.current_tenant().auth, key='STANDIN0000')
+    except lf.UpstreamError:
+        pass
+    else:
+        raise AssertionError('expected UpstreamError')
+    assert standin.counters()['calls'] == {'GetTStatInfoList': 1}
+
+
+def test_half_open_trial(lf):
+    breaker = tenancy.CircuitBreaker(threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.02)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow()
+
+
+def test_deadline(lf, standin, directive):
+    class Context:
+        def get_remaining_time_in_millis(self):
+            return upstream.DEADLINE_MARGIN_MS + 50
+    standin.latency_ms = 200
+    start = time.perf_counter()
+    response = lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), Context())
+    assert response['event']['payload']['type'] == 'ENDPOINT_UNREACHABLE'
+    assert time.perf_counter() - start < 0.2
+
+
+def test_unknown_zone(lf, standin, directive):
+    response = lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:9'), None)
+    assert response['event']['header']['name'] == 'ErrorResponse'
+    assert response['event']['payload']['type'] == 'NO_SUCH_ENDPOINT'
+
+
+def test_malformed_state(lf, standin, directive):
+    del standin.zones['STANDIN0000'][0]['Indoor_Temp']
+    response = lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None)
+    assert response['event']['payload']['type'] == 'INTERNAL_ERROR'
+
+
+def test_failed_discovery_finds_nothing(lf, standin, directive):
+    standin.error_rate = 1.0
+    response = lf.lambda_handler(directive('Alexa.Discovery', 'Discover'), None)
+    assert response['event']['header']['name'] == 'Discover.Response'
+    assert response['event']['payload']['endpoints'] == []
+
+
+def test_error_response_correlation_token(lf, standin, directive):
+    standin.error_rate = 1.0
+    request = directive('Alexa', 'ReportState', 'STANDIN0000:0')
+    assert 'correlationToken' not in lf.lambda_handler(request, None)['event']['header']
+    request['directive']['header']['correlationToken'] = 'token-1'
+    header = lf.lambda_handler(request, None)['event']['header']
+    assert (header['name'], header['correlationToken']) == ('ErrorResponse', 'token-1')
+    assert 'correlation_token' not in header
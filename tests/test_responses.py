@@ -0,0 +1,41 @@
+import json
+
+
+def discovery(lf, zones=3):
+    systemsInfo = [{'Gateway_SN': 'GW', 'System_Name': 'System', 'SystemID': 1, 'Firmware_Ver': '1'}]
+    tStatInfo = [{'GatewaySN': 'GW', 'Zone_Number': z, 'Zone_Name': 'Zone %d' % z, 'Zone_Enabled': 1, 'Zones_Installed': zones}
+                 for z in range(zones)]
+    return lf.buildDiscoveryResponse(systemsInfo, [tStatInfo])
+
+
+def test_to_json_matches_dumps(lf):
+    response = discovery(lf).get()
+    assert json.loads(response.to_json()) == json.loads(json.dumps(response))
+
+
+def test_text_that_looks_like_a_placeholder_is_kept(lf):
+    response = discovery(lf)
+    response.event['payload']['note'] = '"endpoints": 0, "capabilities": 0'
+    response.context['properties'] = [{'endpoints': 0, 'capabilities': 0}]
+    response = response.get()
+    assert json.loads(response.to_json()) == json.loads(json.dumps(response))
+
+
+def test_changes_to_the_dict_are_included(lf):
+    response = discovery(lf).get()
+    response.to_json()
+    response['event']['payload']['endpoints'][0]['friendlyName'] = 'Renamed'
+    assert json.loads(response.to_json())['event']['payload']['endpoints'][0]['friendlyName'] == 'Renamed'
+
+
+def test_replaced_capabilities_are_encoded(lf):
+    response = discovery(lf).get()
+    response['event']['payload']['endpoints'][0]['capabilities'] = [{'interface': 'Alexa'}]
+    assert json.loads(response.to_json())['event']['payload']['endpoints'][0]['capabilities'] == [{'interface': 'Alexa'}]
+
+
+def test_properties_share_one_timestamp(lf):
+    response = lf.getAlexaResponse('GW:0', tStatInfo={
+        'GatewaySN': 'GW', 'Zone_Number': 0, 'Indoor_Temp': 70, 'Operation_Mode': 3,
+        'Heat_Set_Point': 66, 'Cool_Set_Point': 74, 'Pref_Temp_Units': '0'}).get()
+    assert len({p['timeOfSample'] for p in response['context']['properties']}) == 1
@@ -0,0 +1,103 @@
+import json
+from datetime import datetime
+
+import pytest
+
+import myicomfort_standin
+from lennox import schedule, tenancy
+
+PERIOD = ('Alexa.ModeController', 'mode')
+
+
+def follow_program(standin, gatewaysn='STANDIN0000'):
+    with standin.lock:
+        for zone in standin.zones[gatewaysn]:
+            zone['Program_Schedule_Mode'] = '1'
+
+
+def test_resume_schedule(lf, standin, directive, properties):
+    response = lf.lambda_handler(directive('Alexa.ThermostatController', 'ResumeSchedule', 'STANDIN0000:0'), None)
+    assert response['event']['header']['name'] == 'Response'
+    assert properties(response)[PERIOD].startswith('SchedulePeriod.')
+    assert properties(response)[PERIOD] != 'SchedulePeriod.Hold'
+    assert standin.zones['STANDIN0000'][0]['Program_Schedule_Mode'] == '1'
+
+
+def test_rejected_resume_schedule_raises(lf, standin, directive, monkeypatch):
+    def reject(self, query):
+        raise LookupError('Rejected')
+    monkeypatch.setattr(myicomfort_standin.StandinHandler, 'set_program_mode', reject)
+    tStat = lf.LennoxWiFi('STANDIN0000:0', lf.current_tenant().auth)
+    with pytest.raises(lf.UpstreamError):
+        tStat.resumeSchedule()
+    assert lf.current_tenant().cache.get('STANDIN0000:0') is None
+    response = lf.lambda_handler(directive('Alexa.ThermostatController', 'ResumeSchedule', 'STANDIN0000:0'), None)
+    assert response['event']['payload']['type'] == 'ENDPOINT_UNREACHABLE'
+
+
+def test_program_is_read_with_gateway_state(lf, standin, directive, properties):
+    follow_program(standin)
+    for endpointId in ('STANDIN0000:0', 'STANDIN0000:1'):
+        response = lf.lambda_handler(directive('Alexa', 'ReportState', endpointId), None)
+        assert properties(response)[PERIOD] != 'SchedulePeriod.Hold'
+    assert standin.counters()['calls'] == {'GetTStatInfoList': 1, 'GetProgramInfo': 1}
+
+
+def test_async_program_is_read_with_gateway_state(lf, standin, directive, properties):
+    follow_program(standin)
+    for endpointId in ('STANDIN0000:0', 'STANDIN0000:1'):
+        response = lf.run_async(lf.async_lambda_handler(directive('Alexa', 'ReportState', endpointId), None))
+        assert properties(response)[PERIOD] != 'SchedulePeriod.Hold'
+    assert standin.counters()['calls'] == {'GetTStatInfoList': 1, 'GetProgramInfo': 1}
+
+
+def test_zones_not_following_a_program_read_no_program(lf, standin, directive, properties):
+    response = lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None)
+    assert properties(response)[PERIOD] == 'SchedulePeriod.Hold'
+    assert 'GetProgramInfo' not in standin.counters()['calls']
+
+
+def test_program_written_during_fetch_is_not_cached(lf, standin, monkeypatch):
+    tenant = lf.current_tenant()
+    get = schedule.myicomfort_get
+
+    def get_then_write(path, auth, **kwargs):
+        r = get(path, auth, **kwargs)
+        if path.startswith('GetProgramInfo'):
+            schedule.setProgramInfo('STANDIN0000', 0, [], tenant)
+        return r
+    monkeypatch.setattr(schedule, 'myicomfort_get', get_then_write)
+    schedule.getProgramIndex('STANDIN0000', 0, tenant)
+    assert tenant.programs.get(schedule.programKey('STANDIN0000', 0)) is None
+
+
+def test_cache_generation_fences_puts(lf):
+    cache = tenancy.TStatCache(60, 8)
+    generation = cache.generation('key')
+    cache.invalidate('key')
+    cache.put('key', 'stale', generation)
+    assert cache.get('key') is None
+    cache.put('key', 'fresh', cache.generation('key'))
+    assert cache.get('key') == 'fresh'
+
+
+def test_schedule_timezone_per_gateway(lf, standin, monkeypatch, tmp_path):
+    monkeypatch.setattr(schedule, 'SCHEDULE_TIMEZONES', {'STANDIN0001': 'America/Chicago'})
+    assert schedule.getScheduleTimezone('STANDIN0000').key == schedule.SCHEDULE_TIMEZONE
+    assert schedule.getScheduleTimezone('STANDIN0001').key == 'America/Chicago'
+
+    path = tmp_path / 'credentials.json'
+    path.write_text(json.dumps({'tokens': {}, 'timezones': {'STANDIN0000': 'Europe/London'}}))
+    monkeypatch.setattr(tenancy, 'credential_store', tenancy.FileCredentialStore(str(path)))
+    assert schedule.getScheduleTimezone('STANDIN0000').key == 'Europe/London'
+    assert schedule.getScheduleTimezone('STANDIN0001').key == 'America/Chicago'
+
+
+def test_schedule_period_uses_gateway_timezone(lf, standin, monkeypatch):
+    follow_program(standin)
+    tStatInfo = dict(standin.zones['STANDIN0000'][0])
+    monkeypatch.setattr(schedule, 'SCHEDULE_TIMEZONES', {'STANDIN0000': 'Pacific/Kiritimati'})
+    period = schedule.getSchedulePeriod(tStatInfo)
+    now = datetime.now(schedule.getScheduleTimezone('STANDIN0000'))
+    index = schedule.getProgramIndex('STANDIN0000', 0)
+    assert period == index.lookup(now.isoweekday() % 7, now.hour * 60 + now.minute)
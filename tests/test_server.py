@@ -0,0 +1,49 @@
+import json
+import threading
+import urllib.request
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def directive_server(standin):
+    instance = server.DirectiveServer(('127.0.0.1', 0), workers=4, request_timeout_ms=5000)
+    threading.Thread(target=instance.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:%d' % instance.server_address[1], instance
+    if not instance.draining:
+        instance.drain(1)
+
+
+def post(url, body):
+    request = urllib.request.Request(url, json.dumps(body).encode('utf-8'), {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as r:
+        return json.loads(r.read())
+
+
+def test_directive(directive_server, directive):
+    (url, _) = directive_server
+    response = post(url + '/', directive('Alexa', 'ReportState', 'STANDIN0000:0'))
+    assert response['event']['header']['name'] == 'StateReport'
+
+
+def test_batch(directive_server, directive):
+    (url, _) = directive_server
+    responses = post(url + '/batch', [directive('Alexa', 'ReportState', 'STANDIN0000:0'), directive('Alexa', 'ReportState', 'STANDIN0001:1')])
+    assert [r['event']['endpoint']['endpointId'] for r in responses] == ['STANDIN0000:0', 'STANDIN0001:1']
+
+
+def test_batch_takes_a_list(directive_server, directive):
+    (url, _) = directive_server
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(url + '/batch', directive('Alexa', 'ReportState', 'STANDIN0000:0'))
+    assert e.value.code == 400
+
+
+def test_health_and_drain(directive_server):
+    (url, instance) = directive_server
+    with urllib.request.urlopen(url + '/health') as r:
+        assert json.loads(r.read()) == {'status': 'ok', 'inFlight': 0}
+    assert instance.drain(1)
+    assert instance.begin() is False
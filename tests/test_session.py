@@ -0,0 +1,13 @@
+from lennox import tenancy, upstream
+
+
+def test_session_is_reused(lf, standin, directive):
+    session = lf.get_session()
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None)
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0001:0'), None)
+    assert lf.get_session() is session
+
+
+def test_session_pool_size(lf, standin):
+    adapter = lf.get_session().get_adapter(upstream.MYICOMFORT_URL)
+    assert adapter._pool_maxsize == tenancy.HTTP_POOL_SIZE
@@ -0,0 +1,50 @@
+import threading
+import time
+
+import pytest
+
+from lennox import tenancy
+
+
+def test_concurrent_callers_share_one_call(lf):
+    flight = tenancy.SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def fetch(key):
+        calls.append(key)
+        release.wait(1)
+        return key.upper()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('a', fetch, 'a'))) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert calls == ['a']
+    assert results == ['A'] * 5
+
+
+def test_errors_are_shared_and_not_kept(lf):
+    flight = tenancy.SingleFlight()
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        flight.do('a', fail)
+    assert flight.do('a', lambda: 1) == 1
+
+
+def test_zone_reads_share_a_gateway_fetch(lf, standin, directive):
+    standin.latency_ms = 50
+    threads = [threading.Thread(target=lf.lambda_handler, args=(directive('Alexa', 'ReportState', endpointId), None))
+               for endpointId in ('STANDIN0000:0', 'STANDIN0000:1') * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert standin.counters()['calls'] == {'GetTStatInfoList': 1}
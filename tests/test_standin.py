@@ -0,0 +1,33 @@
+import json
+import urllib.request
+
+from lennox import upstream
+
+
+def get(lf, path):
+    with urllib.request.urlopen(upstream.MYICOMFORT_URL + path) as r:
+        return json.loads(r.read())
+
+
+def test_counts_calls(lf, standin):
+    get(lf, 'GetSystemsInfo?userid=standin')
+    get(lf, 'GetTStatInfoList?gatewaysn=STANDIN0000')
+    counters = standin.counters()
+    assert counters['calls'] == {'GetSystemsInfo': 1, 'GetTStatInfoList': 1}
+    assert counters['bytes_out'] > 0
+
+
+def test_zone_filter(lf, standin):
+    zones = get(lf, 'GetTStatInfoList?gatewaysn=STANDIN0000&zone_number=1')['tStatInfo']
+    assert [zone['Zone_Number'] for zone in zones] == [1]
+
+
+def test_error_injection(lf, standin):
+    standin.error_rate = 1.0
+    try:
+        get(lf, 'GetSystemsInfo?userid=standin')
+    except urllib.error.HTTPError as e:
+        assert e.code == 500
+    else:
+        raise AssertionError('expected an injected failure')
+    assert standin.counters()['errors'] == {'GetSystemsInfo': 1}
@@ -0,0 +1,61 @@
+import json
+import time
+
+from lennox import tenancy
+
+
+def test_report_state_is_cached(lf, standin, directive):
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None)
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None)
+    # The sibling zone was cached by the same gateway read
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:1'), None)
+    assert standin.counters()['calls'] == {'GetTStatInfoList': 1}
+
+
+def test_write_through(lf, standin, directive, properties):
+    lf.lambda_handler(directive('Alexa.ThermostatController', 'SetTargetTemperature', 'STANDIN0000:0',
+                                {'lowerSetpoint': {'value': 60}, 'upperSetpoint': {'value': 80}}), None)
+    response = lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None)
+    assert properties(response)[('Alexa.ThermostatController', 'lowerSetpoint')]['value'] == 60
+    assert standin.counters()['calls'] == {'GetTStatInfoList': 1, 'SetTStatInfo': 1}
+
+
+def test_expiry():
+    cache = tenancy.TStatCache(ttl=0.01, maxsize=4)
+    cache.put('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'size': 0}
+
+
+def test_least_recently_used_is_evicted(lf):
+    cache = tenancy.TStatCache(ttl=60, maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+
+
+def test_zero_ttl_disables(lf):
+    cache = tenancy.TStatCache(ttl=0, maxsize=2)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+
+
+def test_state_written_during_fetch_is_not_cached(lf, standin, directive, monkeypatch):
+    tenant = lf.current_tenant()
+    get = lf.myicomfort_get
+
+    def get_then_write(path, auth, **kwargs):
+        r = get(path, auth, **kwargs)
+        if path.startswith('GetTStatInfoList'):
+            tStat = lf.LennoxWiFi('STANDIN0000:0', auth)
+            tStat.tStatInfo = json.loads(r.text)['tStatInfo'][0]
+            tStat.setTStatInfo(lowerSetpoint=60)
+        return r
+    monkeypatch.setattr(lf, 'myicomfort_get', get_then_write)
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:1'), None)
+    assert tenant.cache.get('STANDIN0000:0')['Heat_Set_Point'] == 60
+    assert tenant.cache.get('STANDIN0000:1') is None
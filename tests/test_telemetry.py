@@ -0,0 +1,68 @@
+import fcntl
+import threading
+
+import pytest
+
+from lennox import telemetry
+
+pytest.importorskip('numpy')
+
+
+def tstat(zone=0, temp=70, mode=3):
+    return {'GatewaySN': 'STANDIN0000', 'Zone_Number': zone, 'Indoor_Temp': temp, 'Heat_Set_Point': 66,
+            'Cool_Set_Point': 74, 'Operation_Mode': mode, 'Pref_Temp_Units': '0'}
+
+
+@pytest.fixture
+def recorder(lf, tmp_path):
+    return telemetry.TelemetryRecorder(str(tmp_path / 'telemetry.bin'), capacity=8, max_endpoints=4, min_interval=300)
+
+
+def test_record_and_query(recorder):
+    assert recorder.record(tstat(temp=70), now=1000)
+    assert not recorder.record(tstat(temp=70), now=1100)
+    assert recorder.record(tstat(temp=71), now=1200)
+    samples = recorder.samples('STANDIN0000:0')
+    assert list(samples['time']) == [1000, 1200]
+    assert recorder.summary('STANDIN0000:0')['max'] == 71.0
+
+
+def test_writer_records_off_the_calling_thread(lf, recorder):
+    threads = []
+    record_many = recorder.record_many
+
+    def record_on_thread(samples):
+        threads.append(threading.current_thread())
+        return record_many(samples)
+    recorder.record_many = record_on_thread
+    writer = telemetry.TelemetryWriter(lambda: recorder)
+    for i in range(5):
+        assert writer.submit(tstat(temp=60 + i), now=1000 + i)
+    writer.drain()
+    writer.stop(1)
+    assert threading.current_thread() not in threads
+    assert list(recorder.samples('STANDIN0000:0')['temperature']) == [600, 610, 620, 630, 640]
+
+
+def test_writer_drops_when_full(lf, recorder, standin):
+    blocked = threading.Event()
+    writer = telemetry.TelemetryWriter(lambda: blocked.wait() and recorder, maxsize=2)
+    results = [writer.submit(tstat(temp=60 + i), now=1000 + i) for i in range(10)]
+    assert results.count(False) >= 7
+    assert lf.metrics.snapshot()['counters']['TelemetryDropped'] == results.count(False)
+    blocked.set()
+    writer.drain()
+    writer.stop(1)
+
+
+def test_samples_takes_a_shared_lock(recorder, monkeypatch):
+    recorder.record(tstat(), now=1000)
+    modes = []
+    flock = fcntl.flock
+
+    def spy(fd, operation):
+        modes.append(operation)
+        return flock(fd, operation)
+    monkeypatch.setattr(fcntl, 'flock', spy)
+    recorder.samples('STANDIN0000:0')
+    assert modes[0] == fcntl.LOCK_SH
@@ -0,0 +1,74 @@
+import pytest
+
+from lennox import tenancy
+
+
+@pytest.fixture
+def store(lf, monkeypatch):
+    '''
+    A credential store mapping 'token-<userid>' to the account <userid> and
+    anything else to the default account, with room for one other account.
+    '''
+    class TokenStore(tenancy.CredentialStore):
+        def lookup(self, token):
+            if token.startswith('token-'):
+                return (token[len('token-'):], 'standin')
+            return ('standin', 'standin')
+
+        def save_grant(self, code, token):
+            pass
+    store = TokenStore()
+    monkeypatch.setattr(tenancy, 'credential_store', store)
+    monkeypatch.setattr(tenancy, 'tenants', tenancy.TenantCache(1))
+    return store
+
+
+def test_handlers_do_not_leak_the_tenant(lf, standin, store, directive):
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0', token='token-other'), None)
+    assert tenancy._tenant.get() is None
+    lf.lambda_batch_handler([directive('Alexa', 'ReportState', 'STANDIN0000:0', token='token-other')], None)
+    assert tenancy._tenant.get() is None
+    lf.run_async(lf.async_lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0', token='token-other'), None))
+    assert tenancy._tenant.get() is None
+    assert lf.current_tenant() is tenancy.default_tenant
+
+
+def test_evicted_tenant_is_closed_once_released(lf, standin, store):
+    first = tenancy.tenants.get('first', 'standin')
+    session = first.get_session()
+    second = tenancy.tenants.get('second', 'standin')
+    assert first._session is session
+    first.release()
+    assert first._session is None
+    second.release()
+
+
+def test_unused_evicted_tenant_is_closed(lf, standin, store):
+    first = tenancy.tenants.get('first', 'standin')
+    first.get_session()
+    first.release()
+    tenancy.tenants.get('second', 'standin').release()
+    assert first._session is None
+
+
+def test_poll_handler_uses_default_tenant(lf, standin, store, directive, monkeypatch):
+    other = tenancy.tenants.get('other', 'standin')
+    token = tenancy._tenant.set(other)
+    try:
+        lf.lambda_poll_handler({}, None)
+    finally:
+        tenancy._tenant.reset(token)
+        other.release()
+    assert other.change_poller is None
+    assert tenancy.default_tenant.change_poller is not None
+
+
+def test_credential_store_is_abstract(lf):
+    with pytest.raises(TypeError):
+        tenancy.CredentialStore()
+
+    class Partial(tenancy.CredentialStore):
+        def lookup(self, token):
+            return None
+    with pytest.raises(TypeError):
+        Partial()
@@ -0,0 +1,42 @@
+from lennox import observability
+
+
+def test_directive_trace(lf, standin, directive):
+    lf.lambda_handler(directive('Alexa', 'ReportState', 'STANDIN0000:0'), None)
+    trace = lf.metrics.snapshot()['last_trace']
+    assert trace['directive'] == 'ReportState'
+    assert trace['correlationId'] == 'message-ReportState'
+    assert [span['name'] for span in trace['spans']] == ['upstream:GetTStatInfoList']
+    assert trace['counters']['UpstreamCalls'] == 1
+    assert trace['counters']['CacheMisses'] == 1
+    assert 0 < trace['upstreamWaitMs'] <= trace['durationMs']
+
+
+def test_overlapping_upstream_calls_count_once():
+    trace = observability.Trace('Discover')
+    trace.spans = [
+        {'name': 'upstream:A', 'startMs': 0, 'durationMs': 10},
+        {'name': 'upstream:B', 'startMs': 5, 'durationMs': 10},
+        {'name': 'upstream:C', 'startMs': 20, 'durationMs': 5},
+        {'name': 'directive:X', 'startMs': 0, 'durationMs': 100},
+    ]
+    assert trace.upstream_wait() == 20
+
+
+def test_emf_document():
+    record = {'directive': 'ReportState', 'correlationId': 'c', 'durationMs': 5.0, 'upstreamWaitMs': 4.0, 'ownMs': 1.0,
+              'counters': {'UpstreamCalls': 1, 'UpstreamBytesIn': 100},
+              'spans': [{'name': 'upstream:GetTStatInfoList', 'startMs': 0, 'durationMs': 4.0}]}
+    document = observability.Trace('ReportState').to_emf(record)
+    units = {m['Name']: m['Unit'] for m in document['_aws']['CloudWatchMetrics'][0]['Metrics']}
+    assert units['GetTStatInfoListLatency'] == 'Milliseconds'
+    assert units['UpstreamBytesIn'] == 'Bytes'
+    assert document['GetTStatInfoListLatency'] == [4.0]
+
+
+def test_histogram_percentiles():
+    histogram = observability.Histogram()
+    for value in range(1, 101):
+        histogram.observe(value)
+    assert histogram.percentile(50) == 50
+    assert histogram.percentile(99) == 100